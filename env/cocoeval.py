@@ -6,6 +6,10 @@ import time
 from collections import defaultdict
 from . import mask as maskUtils
 import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+_noRows = np.zeros(0, dtype=np.int64)
 
 # file_path = ""
 class COCOeval:
@@ -30,7 +34,18 @@ class COCOeval:
     #  iouType    - ['segm'] set iouType to 'segm', 'bbox' or 'keypoints'
     #  iouType replaced the now DEPRECATED useSegm parameter.
     #  useCats    - [1] if true use category labels for evaluation
+    #  fastMatch  - [0] if true match dts to gts with numpy, vectorized over IoU
+    #               thresholds and gts. The matches are identical to the loop's.
+    #               Images with fewer than fastMatchMin (D*G*T) pairs still use the loop.
+    #  numProc    - [1] if >1 evaluate() shards the images across numProc processes,
+    #               the evalImgs are identical to the serial ones and ious is left empty
     # Note: if useCats=0 category labels are ignored as in proposal scoring.
+    # Note: instead of a coco object, cocoDt can be the columns of the dts, a dict with 'num' (D)
+    # and numpy arrays with one row per dt: image_id, category_id, score, optionally id and area
+    # (default from bbox), and the regions of the evaluated targets (bbox, boxes_house [Dx4] in xywh,
+    # or segmentation as 'segmentation/counts' [uint8], 'segmentation/offsets' [D+1] of each rle
+    # in the counts and 'segmentation/size' [Dx2]), e.g. from _annsToColumns. All dts are kept in
+    # this form in ._dts, which only holds the rows of each image and category.
     # Note: multiple areaRngs [Ax2] and maxDets [Mx1] can be specified.
     #
     # evaluate(): evaluates detections on every image and every category and
@@ -62,7 +77,7 @@ class COCOeval:
         '''
         Initialize CocoEval using coco APIs for gt and dt
         :param cocoGt: coco object with ground truth annotations
-        :param cocoDt: coco object with detection results
+        :param cocoDt: coco object with detection results, or their columns
         :return: None
         '''
         if not iouType:
@@ -72,7 +87,8 @@ class COCOeval:
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results [KxAxI] elements
         self.eval     = {}                  # accumulated evaluation results
         self._gts = defaultdict(list)       # gt for evaluation
-        self._dts = defaultdict(list)       # dt for evaluation
+        self._dts = {}                      # rows of dt for evaluation
+        self._dtCols = None                 # columns of all dt
         self.params = Params(iouType=iouType, gtType=gtType) # parameters
         # self.gtType =
         self._paramsEval = {}               # parameters for evaluation
@@ -94,17 +110,25 @@ class COCOeval:
                 rle = coco.annToRLE(ann)
                 ann['segmentation'] = rle
         p = self.params
+        useSegm = any(iouType == 'segm' for iouType, _ in self._targets())
         if p.useCats:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
         else:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
+        if self.cocoDt is None or isinstance(self.cocoDt, dict):
+            dtCols = self.cocoDt
+        else:
+            if p.useCats:
+                dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+            else:
+                dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
+            if useSegm:
+                _toMask(dts, self.cocoDt)
+            dtCols = _annsToColumns(dts, self._dtKeys())
 
         # convert ground truth to mask if iouType == 'segm'
-        if p.iouType == 'segm':
+        if useSegm:
             _toMask(gts, self.cocoGt)
-            _toMask(dts, self.cocoDt)
         # set ignore flag
         for gt in gts:
             gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
@@ -112,14 +136,72 @@ class COCOeval:
             if p.iouType == 'keypoints':
                 gt['ignore'] = (gt['num_keypoints'] == 0) or gt['ignore']
         self._gts = defaultdict(list)       # gt for evaluation
-        self._dts = defaultdict(list)       # dt for evaluation
         for gt in gts:
             self._gts[gt['image_id'], gt['category_id']].append(gt)
-        for dt in dts:
-            self._dts[dt['image_id'], dt['category_id']].append(dt)
+        self._setDts(dtCols)
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
+    def _setDts(self, cols):
+        '''
+        Set the columns of the dts, and index the rows of each image and category in ._dts
+        :param cols: columns of the dts, or None for no dts
+        :return: None
+        '''
+        p = self.params
+        cols = dict(cols) if cols is not None else _annsToColumns([], self._dtKeys())
+        if 'id' not in cols:
+            cols['id'] = np.arange(1, cols['num'] + 1)
+        if 'area' not in cols:
+            cols['area'] = cols['bbox'][:, 2] * cols['bbox'][:, 3] if cols['num'] else np.zeros(0)
+        self._dtCols = cols
+        self._dts = {}
+        if cols['num'] == 0:
+            return
+        imgIds, catIds = cols['image_id'], cols['category_id']
+        keep = np.isin(imgIds, p.imgIds)
+        if p.useCats:
+            keep &= np.isin(catIds, p.catIds)
+        rows = np.flatnonzero(keep)
+        # a stable sort, the dts of an image and category stay in their order
+        rows = rows[np.lexsort((catIds[rows], imgIds[rows]))]
+        imgIds, catIds = imgIds[rows], catIds[rows]
+        bounds = np.flatnonzero((imgIds[1:] != imgIds[:-1]) | (catIds[1:] != catIds[:-1])) + 1
+        for start, group in zip(np.concatenate([[0], bounds]).tolist(), np.split(rows, bounds)):
+            self._dts[imgIds[start].item(), catIds[start].item()] = group
+
+    def _dtRows(self, imgId, catId, maxDet=None):
+        '''
+        :return: rows of the dt columns of the image and category, highest score first, at most maxDet
+        '''
+        p = self.params
+        if p.useCats:
+            rows = self._dts.get((imgId, catId), _noRows)
+        else:
+            rows = np.concatenate([self._dts.get((imgId, cId), _noRows) for cId in p.catIds])
+        inds = np.argsort(-self._dtCols['score'][rows], kind='mergesort')
+        return rows[inds[0:maxDet]]
+
+    def _dtRegions(self, rows, key):
+        cols = self._dtCols
+        if key == 'segmentation':
+            counts, offsets = cols['segmentation/counts'], cols['segmentation/offsets']
+            sizes = cols['segmentation/size']
+            return [{'size': sizes[i].tolist(), 'counts': counts[offsets[i]:offsets[i+1]].tobytes()} for i in rows]
+        return cols[key][rows]
+
+    def _targets(self):
+        return [(self.params.iouType, self.params.gtType)]
+
+    def _dtKeys(self):
+        # the keys of the dts used by the evaluation
+        keys = ['id', 'image_id', 'category_id', 'area', 'score']
+        for iouType, gtType in self._targets():
+            key = 'keypoints' if iouType == 'keypoints' else self._regionKeys(iouType, gtType)[1]
+            if key not in keys:
+                keys.append(key)
+        return keys
+
     def evaluate(self):
         '''
         Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
@@ -127,6 +209,17 @@ class COCOeval:
         '''
         tic = time.time()
         print('Running per image evaluation...')
+        p = self._checkParams()
+        self._prepare()
+        if p.numProc > 1 and p.iouType != 'keypoints':
+            self._evaluateParallel(p.numProc)
+        else:
+            self._evaluateImgs()
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def _checkParams(self):
         p = self.params
         # add backward compatibility if useSegm is specified in params
         if not p.useSegm is None:
@@ -138,8 +231,14 @@ class COCOeval:
             p.catIds = list(np.unique(p.catIds))
         p.maxDets = sorted(p.maxDets)
         self.params=p
+        return p
 
-        self._prepare()
+    def _evaluateImgs(self):
+        '''
+        Compute self.ious and self.evalImgs of the prepared ._gts and ._dts
+        :return: None
+        '''
+        p = self.params
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
@@ -158,43 +257,87 @@ class COCOeval:
                  for areaRng in p.areaRng
                  for imgId in p.imgIds
              ]
-        self._paramsEval = copy.deepcopy(self.params)
-        toc = time.time()
-        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def _evaluateParallel(self, numProc):
+        '''
+        Compute self.evalImgs of the prepared ._gts and ._dts in a pool of numProc processes.
+        The images are sharded across the workers, which receive the gts and dts of their shard as
+        numpy columns, and the evalImgs of the shards are merged back in the order of the serial evaluate.
+        :return: None
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        I, A, K = len(p.imgIds), len(p.areaRng), len(catIds)
+        # more shards than workers, strided over the images, to balance the load
+        numShards = min(I, 4 * numProc)
+        shards = [list(range(s, I, numShards)) for s in range(numShards)]
+
+        # the workers get a copy of this evaluator without the coco apis and annotations
+        E = copy.copy(self)
+        E.cocoGt = E.cocoDt = None
+        E._gts = E._dts = None
+        E.ious, E.evalImgs, E.eval, E._paramsEval, E.stats = {}, [], {}, {}, []
+        E.params = copy.deepcopy(p)
+        E.params.numProc = 1
+        E._dtCols = None
+        gtKeys = ['id', 'image_id', 'category_id', 'area', 'iscrowd', 'ignore']
+        for iouType, gtType in self._targets():
+            gKey = self._regionKeys(iouType, gtType)[0]
+            gtKeys += [gKey] if gKey not in gtKeys else []
+        gtsPerImg, dtsPerImg = defaultdict(list), defaultdict(list)
+        for (imgId, _), gts in self._gts.items():
+            gtsPerImg[imgId].extend(gts)
+        for (imgId, _), rows in self._dts.items():
+            dtsPerImg[imgId].append(rows)
+
+        self.ious = {}
+        self.evalImgs = [None] * (K*A*I)
+        # spawn, as the caller may have started threads (e.g. tensorflow) which do not survive a fork
+        with ProcessPoolExecutor(numProc, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = []
+            for inds in shards:
+                imgIds = [p.imgIds[i] for i in inds]
+                gtCols = _annsToColumns([g for imgId in imgIds for g in gtsPerImg[imgId]], gtKeys)
+                dtCols = _takeColumns(self._dtCols, np.concatenate([_noRows] + [r for imgId in imgIds for r in dtsPerImg[imgId]]))
+                futures.append(pool.submit(_evaluateShard, E, imgIds, gtCols, dtCols))
+            for inds, future in zip(shards, futures):
+                evalImgs = future.result()
+                n = len(inds)
+                for ka in range(K*A):
+                    for j, i in enumerate(inds):
+                        self.evalImgs[ka*I + i] = evalImgs[ka*n + j]
 
     def computeIoU(self, imgId, catId):
         p = self.params
         if p.useCats:
             gt = self._gts[imgId,catId]
-            dt = self._dts[imgId,catId]
         else:
             gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
-            dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
+        dt = self._dtRows(imgId, catId, p.maxDets[-1])
         if len(gt) == 0 and len(dt) ==0:
             return []
-        inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
-        dt = [dt[i] for i in inds]
-        if len(dt) > p.maxDets[-1]:
-            dt=dt[0:p.maxDets[-1]]
-
-        if p.iouType == 'segm':
-            g = [g['segmentation'] for g in gt]
-            d = [d['segmentation'] for d in dt]
-        elif p.iouType == 'bbox':
-            # TODO: Test
-            # for g in gt:
-                # print("g = ", g)
-            # print("end_loop")
-            if p.gtType == 'd':
-                g = [g['damage_bbox'] for g in gt]
-                d = [d['bbox'] for d in dt]
-            else:
-                g = [g['house_bbox'] for g in gt]
-                d = [d['boxes_house'] for d in dt]
 
+        return self._computeIoU(gt, dt, p.iouType, p.gtType)
+
+    @staticmethod
+    def _regionKeys(iouType, gtType):
+        # the keys of the gt and dt regions compared for iouType and gtType
+        if iouType == 'segm':
+            return 'segmentation', 'segmentation'
+        elif iouType == 'bbox':
+            if gtType == 'd':
+                return 'damage_bbox', 'bbox'
+            else:
+                return 'house_bbox', 'boxes_house'
         else:
             raise Exception('unknown iouType for iou computation')
 
+    def _computeIoU(self, gt, dt, iouType, gtType):
+        # dt are rows of the dt columns
+        gKey, dKey = self._regionKeys(iouType, gtType)
+        g = [g[gKey] for g in gt]
+        d = self._dtRegions(dt, dKey)
+
         # compute iou between each dt and gt region
         iscrowd = [int(o['iscrowd']) for o in gt]
         ious = maskUtils.iou(d,g,iscrowd)
@@ -204,11 +347,7 @@ class COCOeval:
         p = self.params
         # dimention here should be Nxm
         gts = self._gts[imgId, catId]
-        dts = self._dts[imgId, catId]
-        inds = np.argsort([-d['score'] for d in dts], kind='mergesort')
-        dts = [dts[i] for i in inds]
-        if len(dts) > p.maxDets[-1]:
-            dts = dts[0:p.maxDets[-1]]
+        dts = self._dtRows(imgId, catId, p.maxDets[-1])
         # if len(gts) == 0 and len(dts) == 0:
         if len(gts) == 0 or len(dts) == 0:
             return []
@@ -225,8 +364,7 @@ class COCOeval:
             bb = gt['bbox']
             x0 = bb[0] - bb[2]; x1 = bb[0] + bb[2] * 2
             y0 = bb[1] - bb[3]; y1 = bb[1] + bb[3] * 2
-            for i, dt in enumerate(dts):
-                d = np.array(dt['keypoints'])
+            for i, d in enumerate(self._dtRegions(dts, 'keypoints')):
                 xd = d[0::3]; yd = d[1::3]
                 if k1>0:
                     # measure the per-keypoint distance if keypoints visible
@@ -248,13 +386,21 @@ class COCOeval:
         perform evaluation for single category and image
         :return: dict (single image results)
         '''
+        return self._evaluateImg(imgId, catId, aRng, maxDet, [self.ious[imgId, catId]])
+
+    def _evaluateImg(self, imgId, catId, aRng, maxDet, iousList):
+        '''
+        perform evaluation for single category and image with X ious matrices of the same gts and dts,
+        the results of each matrix are stacked along the first axis of the TxD and TxG arrays
+        :return: dict (single image results)
+        '''
         p = self.params
         if p.useCats:
             gt = self._gts[imgId,catId]
-            dt = self._dts[imgId,catId]
         else:
             gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
-            dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
+        # rows of the dt columns, highest score first
+        dt = self._dtRows(imgId, catId, maxDet)
         if len(gt) == 0 and len(dt) ==0:
             return None
 
@@ -264,65 +410,138 @@ class COCOeval:
             else:
                 g['_ignore'] = 0
 
-        # sort dt highest score first, sort gt ignore last
+        # sort gt ignore last
         gtind = np.argsort([g['_ignore'] for g in gt], kind='mergesort')
         gt = [gt[i] for i in gtind]
-        dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
-        dt = [dt[i] for i in dtind[0:maxDet]]
         iscrowd = [int(o['iscrowd']) for o in gt]
-        # load computed ious
-        ious = self.ious[imgId, catId][:, gtind] if len(self.ious[imgId, catId]) > 0 else self.ious[imgId, catId]
+        gtIds = [g['id'] for g in gt]
+        dtIds = self._dtCols['id'][dt].tolist()
 
         T = len(p.iouThrs)
+        X = len(iousList)
         G = len(gt)
         D = len(dt)
-        gtm  = np.zeros((T,G))
-        dtm  = np.zeros((T,D))
+        gtm  = np.zeros((X*T,G))
+        dtm  = np.zeros((X*T,D))
         gtIg = np.array([g['_ignore'] for g in gt])
-        dtIg = np.zeros((T,D))
-        if not len(ious)==0:
-            for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t,1-1e-10])
-                    m   = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind,gind]>0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind,gind] < iou:
-                            continue
-                        # if match successful and best so far, store appropriately
-                        iou=ious[dind,gind]
-                        m=gind
-                    # if match made store id of match for both dt and gt
-                    if m ==-1:
-                        continue
-                    dtIg[tind,dind] = gtIg[m]
-                    dtm[tind,dind]  = gt[m]['id']
-                    gtm[tind,m]     = d['id']
+        dtIg = np.zeros((X*T,D))
+        for x, ious in enumerate(iousList):
+            if len(ious)==0:
+                continue
+            # load computed ious
+            ious = ious[:, gtind]
+            rows = slice(x*T, (x+1)*T)
+            if p.fastMatch and ious.size * T >= self.fastMatchMin:
+                self._matchFast(ious, gtIds, dtIds, gtIg, iscrowd, gtm[rows], dtm[rows], dtIg[rows])
+            else:
+                self._matchLoop(ious, gtIds, dtIds, gtIg, iscrowd, gtm[rows], dtm[rows], dtIg[rows])
         # set unmatched detections outside of area range to ignore
-        a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
-        dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
+        dtArea = self._dtCols['area'][dt]
+        a = np.logical_or(dtArea<aRng[0], dtArea>aRng[1]).reshape((1, len(dt)))
+        dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,X*T,0)))
         # store results for given image and category
         return {
                 'image_id':     imgId,
                 'category_id':  catId,
                 'aRng':         aRng,
                 'maxDet':       maxDet,
-                'dtIds':        [d['id'] for d in dt],
-                'gtIds':        [g['id'] for g in gt],
+                'dtIds':        dtIds,
+                'gtIds':        gtIds,
                 'dtMatches':    dtm,
                 'gtMatches':    gtm,
-                'dtScores':     [d['score'] for d in dt],
+                'dtScores':     self._dtCols['score'][dt].tolist(),
                 'gtIgnore':     gtIg,
                 'dtIgnore':     dtIg,
             }
 
+    def _matchLoop(self, ious, gtIds, dtIds, gtIg, iscrowd, gtm, dtm, dtIg):
+        '''
+        Greedy matching of evaluateImg, one IoU threshold and dt at a time, filling gtm, dtm and dtIg in place.
+        :return: None
+        '''
+        for tind, t in enumerate(self.params.iouThrs):
+            for dind, dtId in enumerate(dtIds):
+                # information about best match so far (m=-1 -> unmatched)
+                iou = min([t,1-1e-10])
+                m   = -1
+                for gind in range(len(gtIds)):
+                    # if this gt already matched, and not a crowd, continue
+                    if gtm[tind,gind]>0 and not iscrowd[gind]:
+                        continue
+                    # if dt matched to reg gt, and on ignore gt, stop
+                    if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
+                        break
+                    # continue to next gt unless better match made
+                    if ious[dind,gind] < iou:
+                        continue
+                    # if match successful and best so far, store appropriately
+                    iou=ious[dind,gind]
+                    m=gind
+                # if match made store id of match for both dt and gt
+                if m ==-1:
+                    continue
+                dtIg[tind,dind] = gtIg[m]
+                dtm[tind,dind]  = gtIds[m]
+                gtm[tind,m]     = dtId
+
+    # below this many (dt, gt, threshold) cells the python loop is faster than numpy
+    fastMatchMin = 512
+
+    def _matchFast(self, ious, gtIds, dtIds, gtIg, iscrowd, gtm, dtm, dtIg):
+        '''
+        Greedy matching of evaluateImg for all IoU thresholds at once, filling gtm, dtm and dtIg in place.
+        Like the loop, each dt (highest score first) takes the available gt of the highest IoU, the last
+        one among ties, and only takes an ignored gt if no regular gt matches.
+        dts which share no candidate gt cannot affect each other, so they are matched together in rounds.
+        :return: None
+        '''
+        thrs = np.minimum(self.params.iouThrs, 1-1e-10).reshape((-1, 1))     # Tx1
+        gtIds = np.asarray(gtIds)
+        dtIds = np.asarray(dtIds)
+        gtIg = np.asarray(gtIg, dtype=bool)
+        iscrowd = np.asarray(iscrowd, dtype=bool)
+        # the (dt, gt) pairs which can match at the lowest threshold, sorted by dt and then
+        # by preference of the gt: regular over ignored, higher IoU, and later in the list
+        dinds, ginds = np.nonzero(ious >= thrs.min())
+        if len(dinds) == 0:
+            return
+        pairIous = ious[dinds, ginds]
+        order = np.lexsort((ginds, pairIous, ~gtIg[ginds], dinds))
+        dinds, ginds, pairIous = dinds[order], ginds[order], pairIous[order]
+
+        # a dt is matched in the round after all earlier dts which share a candidate gt with it
+        bounds = [0] + (np.flatnonzero(np.diff(dinds)) + 1).tolist() + [len(dinds)]
+        gtRound = [-1] * len(gtIds)
+        gindList = ginds.tolist()
+        segRounds = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            r = max([gtRound[g] for g in gindList[start:end]]) + 1
+            segRounds.append(r)
+            for g in gindList[start:end]:
+                gtRound[g] = r
+        # make the pairs of each round contiguous, keeping the order of dts
+        segOrder = np.argsort(segRounds, kind='mergesort')
+        segLens = np.diff(bounds)[segOrder]
+        order = np.repeat(np.asarray(bounds[:-1])[segOrder] - np.cumsum(segLens) + segLens, segLens) + np.arange(len(dinds))
+        dinds, ginds, pairIous = dinds[order], ginds[order], pairIous[order]
+        segStarts = np.cumsum(segLens) - segLens
+        roundBounds = np.searchsorted(np.asarray(segRounds)[segOrder], np.arange(segRounds[segOrder[-1]] + 2))
+        pairIdx = np.arange(len(dinds))
+
+        for r0, r1 in zip(roundBounds[:-1], roundBounds[1:]):
+            starts = segStarts[r0:r1]
+            s, e = starts[0], (segStarts[r1] if r1 < len(segStarts) else len(dinds))
+            g = ginds[s:e]
+            # a gt is available if not matched yet at this threshold, or a crowd
+            valid = (pairIous[s:e] >= thrs) & ((gtm[:, g] <= 0) | iscrowd[g])   # TxP
+            # the last valid pair of each dt is its match
+            last = np.maximum.reduceat(np.where(valid, pairIdx[s:e], -1), starts - s, axis=1)
+            tinds, sinds = np.nonzero(last >= starts)
+            best = last[tinds, sinds]
+            dtIg[tinds, dinds[best]] = gtIg[ginds[best]]
+            dtm[tinds, dinds[best]] = gtIds[ginds[best]]
+            gtm[tinds, ginds[best]] = dtIds[dinds[best]]
+
     def accumulate(self, p = None):
         '''
         Accumulate per image evaluation results and store the result in self.eval
@@ -513,6 +732,200 @@ class COCOeval:
     def __str__(self):
         self.summarize()
 
+class MultiTargetCOCOeval(COCOeval):
+    # Evaluates several targets, e.g. damage boxes, house boxes and masks, of the same
+    # detections at once. The usage is the same as COCOeval, but stats is a list with the
+    # stats of each target and evals is a list with the accumulated results of each target.
+    #  targets    - [X] list of (iouType, gtType) to evaluate, 'bbox' or 'segm' only
+    # Gts and dts are prepared and sorted once, the ious of all targets are computed in one
+    # sweep per image, and the matches of target x are stored in rows [x*T, (x+1)*T) of the
+    # evalImgs arrays, so accumulate sorts and concatenates the dts of all targets only once.
+    # The results are identical to running COCOeval once for each target.
+    def __init__(self, cocoGt=None, cocoDt=None, targets=(('bbox', 'd'), ('bbox', 'h'), ('segm', 'd'))):
+        '''
+        Initialize MultiTargetCOCOeval using coco APIs for gt and dt
+        :param cocoGt: coco object with ground truth annotations
+        :param cocoDt: coco object with detection results
+        :param targets: list of (iouType, gtType) to evaluate
+        :return: None
+        '''
+        self.targets = list(targets)
+        assert len(self.targets) > 0 and all(t[0] in ('bbox', 'segm') for t in self.targets), self.targets
+        COCOeval.__init__(self, cocoGt, cocoDt, *self.targets[0])
+        self.evals = []                     # accumulated evaluation results of each target
+
+    def _targets(self):
+        return self.targets
+
+    def computeIoU(self, imgId, catId):
+        p = self.params
+        if p.useCats:
+            gt = self._gts[imgId,catId]
+        else:
+            gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
+        dt = self._dtRows(imgId, catId, p.maxDets[-1])
+        if len(gt) == 0 and len(dt) ==0:
+            return []
+        return [self._computeIoU(gt, dt, iouType, gtType) for iouType, gtType in self.targets]
+
+    def evaluateImg(self, imgId, catId, aRng, maxDet):
+        '''
+        perform evaluation of all targets for single category and image
+        :return: dict (single image results)
+        '''
+        iousList = self.ious[imgId, catId]
+        if len(iousList) == 0:
+            iousList = [[]] * len(self.targets)
+        return self._evaluateImg(imgId, catId, aRng, maxDet, iousList)
+
+    def accumulate(self, p = None):
+        '''
+        Accumulate per image evaluation results of all targets and store the result of each target in self.evals
+        :param p: input params for evaluation
+        :return: None
+        '''
+        p = copy.deepcopy(self.params if p is None else p)
+        T = len(p.iouThrs)
+        iouThrs = p.iouThrs
+        # the targets are accumulated as X*T thresholds
+        p.iouThrs = np.tile(iouThrs, len(self.targets))
+        COCOeval.accumulate(self, p)
+        p.iouThrs = iouThrs
+        self.evals = []
+        for x, (iouType, gtType) in enumerate(self.targets):
+            px = copy.deepcopy(p)
+            px.iouType, px.gtType = iouType, gtType
+            e = dict(self.eval)
+            e['params'] = px
+            e['counts'] = [T] + self.eval['counts'][1:]
+            for name in ['precision', 'recall', 'scores']:
+                e[name] = self.eval[name][x*T:(x+1)*T]
+            self.evals.append(e)
+
+    def summarize(self):
+        '''
+        Compute and display summary metrics for evaluation results of each target.
+        Note this functin can *only* be applied on the default parameter setting
+        '''
+        if not self.evals:
+            raise Exception('Please run accumulate() first')
+        params, eval = self.params, self.eval
+        stats = []
+        for e in self.evals:
+            print('Target *{}* ({})'.format(e['params'].iouType, e['params'].gtType))
+            self.params, self.eval = e['params'], e
+            COCOeval.summarize(self)
+            stats.append(self.stats)
+        self.params, self.eval = params, eval
+        self.stats = stats
+
+class StreamingCOCOeval(MultiTargetCOCOeval):
+    # Evaluates detections image by image, as they are produced, instead of loading all of
+    # them into a coco api first. The usage is
+    #  E = StreamingCOCOeval(cocoGt, targets)  # gts are prepared on the first addImage
+    #  E.addImage(imgId, dts)                   # dts of one image, as in loadRes
+    #  E.evaluate(); E.accumulate(); E.summarize()
+    # Each added image is matched right away, then its dts and ious are dropped and only the
+    # arrays used by accumulate are kept in evalImgs, as booleans, so the memory does not grow
+    # with the masks of the dts. evaluate() only has to match the images which were never
+    # added, i.e. which have no dts. The results are identical to MultiTargetCOCOeval.
+    def __init__(self, cocoGt=None, targets=(('bbox', 'd'), ('bbox', 'h'), ('segm', 'd'))):
+        '''
+        Initialize StreamingCOCOeval using coco api for gt
+        :param cocoGt: coco object with ground truth annotations
+        :param targets: list of (iouType, gtType) to evaluate
+        :return: None
+        '''
+        MultiTargetCOCOeval.__init__(self, cocoGt, None, targets)
+        self._imgEvals = None               # per-image evaluation results, {imgId: [KxA]}
+        self._nextDtId = 1
+
+    def _start(self):
+        p = self._checkParams()
+        self._prepare()
+        self._imgEvals = {}
+        self._imgIdSet = set(p.imgIds)
+
+    def addImage(self, imgId, dts):
+        '''
+        Evaluate the detections of one image
+        :param imgId: id of the image
+        :param dts (list of dict): all detection results of this image, in the format of loadRes,
+            or their columns as in COCOeval with rle segmentations
+        :return: None
+        '''
+        if self._imgEvals is None:
+            self._start()
+        assert imgId in self.cocoGt.imgs, 'Results do not correspond to current coco set'
+        assert imgId not in self._imgEvals, 'Image {} was added already'.format(imgId)
+        if imgId not in self._imgIdSet:
+            return
+        if isinstance(dts, dict):
+            dtCols = dict(dts)
+            dtCols['id'] = np.arange(self._nextDtId, self._nextDtId + dtCols['num'])
+            self._nextDtId += dtCols['num']
+        else:
+            # same as loadRes and _prepare
+            useSegm = any(iouType == 'segm' for iouType, _ in self.targets)
+            for dt in dts:
+                bb = dt['bbox']
+                if not 'segmentation' in dt:
+                    x1, x2, y1, y2 = [bb[0], bb[0]+bb[2], bb[1], bb[1]+bb[3]]
+                    dt['segmentation'] = [[x1, y1, x1, y2, x2, y2, x2, y1]]
+                if useSegm:
+                    dt['segmentation'] = self.cocoGt.annToRLE(dt)
+                dt['area'] = bb[2]*bb[3]
+                dt['id'] = self._nextDtId
+                dt['iscrowd'] = 0
+                self._nextDtId += 1
+            dtCols = _annsToColumns(dts, self._dtKeys())
+        self._setDts(dtCols)
+        self._imgEvals[imgId] = self._evaluateImage(imgId)
+        self._setDts(None)
+
+    def _evaluateImage(self, imgId):
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        maxDet = p.maxDets[-1]
+        evalImgs = []
+        for catId in catIds:
+            self.ious[imgId, catId] = self.computeIoU(imgId, catId)
+            for areaRng in p.areaRng:
+                e = self.evaluateImg(imgId, catId, areaRng, maxDet)
+                if e is not None:
+                    # only keep what accumulate uses
+                    e = {
+                        'dtScores':     np.asarray(e['dtScores']),
+                        'dtMatches':    e['dtMatches'] != 0,
+                        'dtIgnore':     e['dtIgnore'],
+                        'gtIgnore':     e['gtIgnore'],
+                    }
+                evalImgs.append(e)
+            del self.ious[imgId, catId]
+        return evalImgs
+
+    def evaluate(self):
+        '''
+        Evaluate the images which were not added and store the results of all images in self.evalImgs
+        :return: None
+        '''
+        tic = time.time()
+        print('Running per image evaluation...')
+        if self._imgEvals is None:
+            self._start()
+        p = self.params
+        for imgId in p.imgIds:
+            if imgId not in self._imgEvals:
+                self._imgEvals[imgId] = self._evaluateImage(imgId)
+        catIds = p.catIds if p.useCats else [-1]
+        self.evalImgs = [self._imgEvals[imgId][ka]
+                 for ka in range(len(catIds) * len(p.areaRng))
+                 for imgId in p.imgIds
+             ]
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
 class Params:
     '''
     Params for coco evaluation api
@@ -527,6 +940,8 @@ class Params:
         self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'small', 'medium', 'large']
         self.useCats = 1
+        self.fastMatch = 0
+        self.numProc = 1
 
     def setKpParams(self):
         self.imgIds = []
@@ -542,6 +957,8 @@ class Params:
         self.areaRngLbl = ['all', 'medium', 'large']
         self.useCats = 1
         self.kpt_oks_sigmas = np.array([.26, .25, .25, .35, .35, .79, .79, .72, .72, .62,.62, 1.07, 1.07, .87, .87, .89, .89])/10.0
+        self.fastMatch = 0
+        self.numProc = 1
 
     def __init__(self, iouType='segm', gtType='d'):
         if iouType == 'segm' or iouType == 'bbox':
@@ -554,3 +971,66 @@ class Params:
         self.gtType = gtType
         # useSegm is deprecated
         self.useSegm = None
+
+
+def _annsToColumns(anns, keys):
+    '''
+    Encode the given keys of a list of annotations as numpy arrays, one per key.
+    Rle segmentations are stored as the concatenated counts with their offsets and sizes.
+    :return: cols (dict): numpy arrays of the annotations
+    '''
+    cols = {'num': len(anns)}
+    for key in keys:
+        if key == 'segmentation':
+            counts = [ann[key]['counts'] for ann in anns]
+            counts = [c if isinstance(c, bytes) else c.encode('ascii') for c in counts]
+            cols['segmentation/counts'] = np.frombuffer(b''.join(counts), dtype=np.uint8)
+            cols['segmentation/offsets'] = np.cumsum([0] + [len(c) for c in counts])
+            cols['segmentation/size'] = np.asarray([ann[key]['size'] for ann in anns], dtype=np.int64).reshape((-1, 2))
+        else:
+            cols[key] = np.asarray([ann[key] for ann in anns])
+    return cols
+
+def _takeColumns(cols, rows):
+    '''
+    Select rows of annotation columns
+    :return: cols (dict): numpy arrays of the annotations of the rows
+    '''
+    ret = {'num': len(rows)}
+    for key, values in cols.items():
+        if key != 'num' and not key.startswith('segmentation/'):
+            ret[key] = values[rows]
+    if 'segmentation/counts' in cols:
+        counts, offsets = cols['segmentation/counts'], cols['segmentation/offsets']
+        ret['segmentation/counts'] = np.concatenate([counts[:0]] + [counts[offsets[i]:offsets[i+1]] for i in rows])
+        ret['segmentation/offsets'] = np.concatenate([[0], np.cumsum(offsets[rows+1] - offsets[rows])]).astype(np.int64)
+        ret['segmentation/size'] = cols['segmentation/size'][rows]
+    return ret
+
+def _columnsToAnns(cols):
+    '''
+    Decode the annotations encoded by _annsToColumns
+    :return: anns (list of dict)
+    '''
+    anns = [{} for _ in range(cols['num'])]
+    for key, values in cols.items():
+        if key == 'num' or key.startswith('segmentation/'):
+            continue
+        for ann, v in zip(anns, values.tolist()):
+            ann[key] = v
+    if 'segmentation/counts' in cols:
+        counts = cols['segmentation/counts'].tobytes()
+        offsets = cols['segmentation/offsets'].tolist()
+        for i, (ann, size) in enumerate(zip(anns, cols['segmentation/size'].tolist())):
+            ann['segmentation'] = {'size': size, 'counts': counts[offsets[i]:offsets[i+1]]}
+    return anns
+
+def _evaluateShard(E, imgIds, gtCols, dtCols):
+    # runs in the workers of COCOeval._evaluateParallel
+    E.params.imgIds = imgIds
+    E._gts = defaultdict(list)
+    for gt in _columnsToAnns(gtCols):
+        E._gts[gt['image_id'], gt['category_id']].append(gt)
+    E._setDts(dtCols)
+    E._evaluateImgs()
+    return E.evalImgs
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: bake.py
+"""
+Run the preprocessing of the training data offline, several times per image with different random
+augmentations, and save the results, so that training only has to read them.
+Train on them with `--config DATA.BAKED_TRAIN=/path/to/output`.
+
+The output directory has the LMDB shards written by `LMDBSerializer`, and a meta.json.
+The anchor inputs are saved sparsely, see `data.sparsify_anchor_inputs` and `RPN.SPARSE_ANCHOR_INPUTS`.
+"""
+import argparse
+import json
+import numpy as np
+import os
+import cv2
+
+from tensorpack.dataflow import DataFromList, LMDBSerializer
+from tensorpack.utils import logger
+
+from config import config as cfg
+from config import finalize_configs
+from data import RoidbFetcher, TrainingDataPreprocessor, get_baked_config, get_training_roidbs, sparsify_anchor_inputs
+from dataset import register_balloon, register_coco
+
+
+class BakeMapper:
+    """
+    Preprocess a roidb with a given random seed, and make the result compact for saving.
+    """
+
+    def __init__(self, fetcher, jpeg_quality):
+        """
+        Args:
+            fetcher (RoidbFetcher):
+            jpeg_quality (int): encode the images as jpeg of this quality. 0 to save them as they are.
+        """
+        self.fetcher = fetcher
+        self.jpeg_quality = jpeg_quality
+
+    def __call__(self, key_and_seed):
+        key, seed = key_and_seed
+        for aug in self.fetcher.preprocess.aug.augmentors:
+            aug.rng.seed(seed)
+        np.random.seed(seed)  # for the sampling of anchors
+        dp = self.fetcher(key)
+        if dp is None:
+            return None
+        # not the global cfg: in a spawned worker it does not have the overrides of --config
+        if not self.fetcher.preprocess.cfg.RPN.SPARSE_ANCHOR_INPUTS:
+            dp = sparsify_anchor_inputs(dp)
+        if self.jpeg_quality > 0:
+            ok, buf = cv2.imencode('.jpg', dp.pop('image'), [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            assert ok
+            dp['image_jpeg'] = buf
+        return dp
+
+
+if __name__ == '__main__':
+    import multiprocessing as mp
+    mp.set_start_method('spawn')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='The output directory', required=True)
+    parser.add_argument('--num-augmentations', help='Number of preprocessed datapoints per image',
+                        type=int, default=4)
+    parser.add_argument('--num-shards', help='Number of files to write', type=int, default=8)
+    parser.add_argument('--jpeg-quality', help='Encode the images as jpeg of this quality. 0 to save raw pixels',
+                        type=int, default=0)
+    parser.add_argument('--seed', help='Random seed of the first augmentation', type=int, default=0)
+    parser.add_argument('--config', help="A list of KEY=VALUE to overwrite those defined in config.py", nargs='+')
+    args = parser.parse_args()
+    if args.config:
+        cfg.update_args(args.config)
+    register_coco(cfg.DATA.BASEDIR)  # add COCO datasets to the registry
+    register_balloon(cfg.DATA.BASEDIR)  # add the demo balloon datasets to the registry
+    finalize_configs(is_training=False)
+    assert not cfg.DATA.BAKED_TRAIN, "Cannot bake from baked data!"
+
+    # the images are saved as uint8, and converted when they are read
+    cfg.freeze(False)
+    cfg.PREPROC.FLOAT_INPUT = False
+    cfg.freeze()
+
+    assert not os.path.exists(args.output), "{} exists!".format(args.output)
+    os.makedirs(args.output)
+    roidbs, keys = get_training_roidbs()
+    mapper = BakeMapper(RoidbFetcher(roidbs, TrainingDataPreprocessor(cfg)), args.jpeg_quality)
+    items = [(key, args.seed + i * args.num_augmentations + k)
+             for i, key in enumerate(keys) for k in range(args.num_augmentations)]
+
+    # the workers preprocess and serialize the datapoints in parallel
+    LMDBSerializer.save(DataFromList(items, shuffle=False), args.output, num_shards=args.num_shards,
+                        num_proc=cfg.DATA.NUM_WORKERS, map_func=mapper)
+
+    with open(os.path.join(args.output, 'meta.json'), 'w') as f:
+        json.dump({
+            'config': get_baked_config(cfg),
+            'num_augmentations': args.num_augmentations,
+        }, f, indent=2)
+    logger.info("Baked {} augmentations of {} images to {}.".format(args.num_augmentations, len(keys), args.output))
@@ -6,8 +6,10 @@ import cv2
 
 from tensorpack.dataflow import RNGDataFlow
 from tensorpack.dataflow.imgaug import ImageAugmentor, ResizeTransform
+from tensorpack.tfutils.scope_utils import under_name_scope
 from utils.np_box_ops import iou as np_iou  # noqa
-from utils.box_ops import pairwise_iou,pairwise_inner
+from utils.box_ops import area as tf_area
+from utils.box_ops import pairwise_intersection, pairwise_iou
 import tensorflow as tf
 import tensorflow.compat.v1 as tfc
 
@@ -147,14 +149,6 @@ def filter_boxes_inside_shape(boxes, shape):
         (boxes[:, 3] <= h))[0]
     return indices, boxes[indices, :]
 
-def get_mask_single_inner(curr_damage_anchors_batch, house_bboxes, iou_thr):
-    # iou_matrix = pairwise_iou(curr_damage_anchors_batch, house_bboxes)
-    iou_matrix = pairwise_inner(curr_damage_anchors_batch, house_bboxes)
-    iou_max = tf.math.reduce_max(input_tensor=iou_matrix, axis=1)
-    mask = tf.greater(iou_max, tf.constant(iou_thr, dtype=tf.float32))
-    return mask
-
-
 def get_mask_single_iou(curr_damage_anchors_batch, house_bboxes, iou_thr):
     iou_matrix = pairwise_iou(curr_damage_anchors_batch, house_bboxes)
     iou_max = tf.math.reduce_max(input_tensor=iou_matrix, axis=1)
@@ -162,27 +156,141 @@ def get_mask_single_iou(curr_damage_anchors_batch, house_bboxes, iou_thr):
     return mask
 
 
-def filter_anchors_inner(house_bboxes, damage_anchors, iou_thr):
+@under_name_scope()
+def filter_anchors_inner(house_bboxes, damage_anchors, iou_thr, tile_size=16384):
+    """
+    Mark the anchors which are mostly inside a house box, i.e. whose best
+    intersection with `house_bboxes` covers more than `iou_thr` of the anchor area.
+
+    Anchors of all levels are evaluated together in a single graph loop,
+    `tile_size` anchors at a time, so the #anchor x #house intersection matrix
+    never has to be materialized in full.
+
+    Args:
+        house_bboxes: Mx4 floatbox
+        damage_anchors: #lvl tensors of shape fHxfWxNAx4
+        iou_thr (float): threshold on the inner ratio
+        tile_size (int): number of anchors evaluated at a time
+
+    Returns:
+        [tf.Tensor]: #lvl boolean tensors of shape fHxfWxNA
+    """
+    house_bboxes = tf.stop_gradient(house_bboxes)
+    level_shapes = [tf.shape(input=k)[:3] for k in damage_anchors]
+    level_sizes = [tf.reduce_prod(input_tensor=k) for k in level_shapes]
+    anchors = tf.concat([tf.reshape(k, [-1, 4]) for k in damage_anchors], axis=0)
+
+    # pad to a whole number of tiles; the padded entries are dropped below
+    num_anchors = tf.shape(input=anchors)[0]
+    anchor_areas = tf_area(anchors)
+    num_tiles = (num_anchors + tile_size - 1) // tile_size
+    anchors = tf.pad(tensor=anchors, paddings=[[0, num_tiles * tile_size - num_anchors], [0, 0]])
+    anchors = tf.reshape(anchors, [num_tiles, tile_size, 4])
+
+    def max_inter_per_anchor(tile):
+        return tf.reduce_max(input_tensor=pairwise_intersection(tile, house_bboxes), axis=1)
+
+    max_inter = tf.map_fn(max_inter_per_anchor, anchors, dtype=tf.float32, back_prop=False)
+    # inner ratio is intersection / anchor area; compare without dividing
+    max_inter = tf.reshape(max_inter, [-1])[:num_anchors]
+    mask = tf.greater(max_inter, iou_thr * anchor_areas)
+
+    masks = tf.split(mask, level_sizes, axis=0)
+    return [tf.reshape(m, shp) for m, shp in zip(masks, level_shapes)]
+
+
+class SparseBoxMatcher(object):
+    """
+    Find all pairs of overlapping boxes between a fixed set of boxes (e.g. the anchors)
+    and a few query boxes (e.g. the groundtruth), without building the dense IoU matrix.
+
+    The fixed boxes are sorted by x1 within each group of similar sizes (e.g. an FPN level),
+    so the candidates for a query box are a contiguous range found by binary search.
+    The IoU is only evaluated on the candidates that overlap the query box.
+    """
+
+    def __init__(self, boxes, group_splits=()):
+        """
+        Args:
+            boxes: Nx4 floatbox
+            group_splits: indices to split `boxes` into groups, as in `np.split`.
+        """
+        self.boxes = boxes
+        self._groups = []
+        bounds = [0] + list(group_splits) + [len(boxes)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end <= start:
+                continue
+            group = boxes[start:end]
+            order = np.argsort(group[:, 0], kind='stable') + start
+            max_width = (group[:, 2] - group[:, 0]).max()
+            self._groups.append((order, boxes[order, 0], max_width))
+
+    def pairwise_iou(self, query_boxes):
+        """
+        Args:
+            query_boxes: Mx4 floatbox
 
-    all_masks = []
+        Returns:
+            box_inds, query_inds: (k,) int, the indices of all pairs with non-zero IoU
+            ious: (k,) float32, the same values as `np_iou` would give for these pairs
+        """
+        all_box_inds, all_query_inds, all_ious = [], [], []
+        for query_idx, q in enumerate(query_boxes):
+            cands = []
+            for order, x1, max_width in self._groups:
+                # boxes with x2 > q.x1 must have x1 > q.x1 - width; keep a margin for rounding
+                lo = np.searchsorted(x1, q[0] - max_width - 1, side='right')
+                hi = np.searchsorted(x1, q[2], side='left')
+                cands.append(order[lo:hi])
+            cands = np.concatenate(cands)
+            cand_boxes = self.boxes[cands]
+            overlap = (cand_boxes[:, 2] > q[0]) & (cand_boxes[:, 1] < q[3]) & (cand_boxes[:, 3] > q[1])
+            cands = cands[overlap]
+            if len(cands) == 0:
+                continue
+            ious = np_iou(self.boxes[cands], q[None, :])[:, 0]
+            keep = ious > 0
+            all_box_inds.append(cands[keep])
+            all_query_inds.append(np.full((keep.sum(),), query_idx, dtype='int64'))
+            all_ious.append(ious[keep])
+        if len(all_ious) == 0:
+            return np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='float32')
+        return np.concatenate(all_box_inds), np.concatenate(all_query_inds), np.concatenate(all_ious)
+
+
+def summarize_sparse_ious(num_boxes, num_query, box_inds, query_inds, ious):
+    """
+    Compute, from the non-zero entries of a num_boxes x num_query IoU matrix,
+    the statistics that a dense matrix would give with argmax/max/amax/where.
 
-    for i in range(len(damage_anchors)):
-        curr_damage_anchors = damage_anchors[i]
-        ori_shape = curr_damage_anchors.shape
-        # print("ori_shape = ", ori_shape)
-        curr_damage_anchors = np.reshape(curr_damage_anchors, (-1, 4))
-        batch_size = 21 * 21 * 3
-        all_mask = tf.convert_to_tensor(value=[], dtype=tf.float64)
-        for i in range(curr_damage_anchors.shape[0] // batch_size):
-            curr_mask = get_mask_single_inner(curr_damage_anchors[batch_size * i : batch_size * (i+1)], house_bboxes, iou_thr)
-            if i == 0:
-                all_mask = curr_mask
-            else:
-                all_mask = tf.concat([all_mask, curr_mask], axis=0)
-        all_mask = tf.reshape(all_mask, ori_shape[:3])
-        all_masks.append(all_mask)
-    return all_masks
+    Args:
+        num_boxes, num_query (int): shape of the IoU matrix
+        box_inds, query_inds, ious: the non-zero entries, see :meth:`SparseBoxMatcher.pairwise_iou`.
 
+    Returns:
+        argmax_per_box: (num_boxes,) int, ties are broken by the smallest query index like `np.argmax`
+        max_per_box: (num_boxes,) float32
+        boxes_with_max_iou_per_query: (k,) int, the boxes that have (including ties) the max IoU with some query.
+    """
+    argmax_per_box = np.zeros((num_boxes,), dtype='int64')
+    max_per_box = np.zeros((num_boxes,), dtype='float32')
+    if len(ious):
+        # sort by box, then by decreasing iou, then by query index
+        order = np.lexsort((query_inds, -ious, box_inds))
+        sorted_box_inds = box_inds[order]
+        best = order[np.r_[True, sorted_box_inds[1:] != sorted_box_inds[:-1]]]
+        argmax_per_box[box_inds[best]] = query_inds[best]
+        max_per_box[box_inds[best]] = ious[best]
+
+    max_per_query = np.zeros((num_query,), dtype='float32')
+    np.maximum.at(max_per_query, query_inds, ious)
+    if np.any(max_per_query == 0):
+        # a query without overlap has max IoU 0, which every box ties with
+        boxes_with_max_iou_per_query = np.arange(num_boxes)
+    else:
+        boxes_with_max_iou_per_query = np.unique(box_inds[ious == max_per_query[query_inds]])
+    return argmax_per_box, max_per_box, boxes_with_max_iou_per_query
 
 
 try:
@@ -204,3 +312,37 @@ try:
 
 except ImportError:
     from utils.np_box_ops import iou as np_iou  # noqa
+
+
+if __name__ == '__main__':
+    """
+    Micro-benchmark of the sparse anchor matching against the dense IoU matrix,
+    on FPN anchors of a 800x1333 image and a few small groundtruth boxes.
+    """
+    import timeit
+    from modeling.model_fpn import get_all_anchors_fpn
+
+    anchors_per_level = get_all_anchors_fpn(
+        strides=(4, 8, 16, 32, 64), sizes=(32, 64, 128, 256, 512), ratios=(0.5, 1., 2.), max_size=1344)
+    all_anchors = np.concatenate([k.reshape((-1, 4)) for k in anchors_per_level], axis=0)
+    level_splits = np.cumsum([k.size // 4 for k in anchors_per_level])[:-1]
+    inside_ind, anchors = filter_boxes_inside_shape(all_anchors, (800, 1333))
+    matcher = SparseBoxMatcher(anchors, np.searchsorted(inside_ind, level_splits))
+
+    rng = np.random.RandomState(0)
+    xy = rng.uniform(0, 1200, size=(8, 2)).astype('float32')
+    gt_boxes = np.concatenate([xy, xy + rng.uniform(10, 100, size=(8, 2))], axis=1).astype('float32')
+
+    def dense():
+        box_ious = np_iou(anchors, gt_boxes)
+        return (box_ious.argmax(axis=1), box_ious.max(axis=1),
+                np.where(box_ious == np.amax(box_ious, axis=0, keepdims=True))[0])
+
+    def sparse():
+        return summarize_sparse_ious(len(anchors), len(gt_boxes), *matcher.pairwise_iou(gt_boxes))
+
+    d, s = dense(), sparse()
+    assert np.array_equal(d[0], s[0]) and np.array_equal(d[1], s[1])
+    assert np.array_equal(np.unique(d[2]), s[2])
+    for name, func in [('dense', dense), ('sparse', sparse)]:
+        print("{}: {:.2f}ms".format(name, min(timeit.repeat(func, number=10, repeat=5)) * 100))
@@ -111,6 +111,20 @@ _C.DATA.ABSOLUTE_COORD = True
 # In case of horovod training, this is the number of workers per-GPU (so you may want to use a smaller number).
 # Set to 0 to disable parallel data loading
 _C.DATA.NUM_WORKERS = 10
+# Directory to cache the parsed roidbs of the datasets in, see `dataset/roidb.py`.
+# The cache is keyed by the content of the annotation files. Set to empty to disable.
+_C.DATA.CACHE_DIR = '~/.cache/msnet'
+# Size in MB of the in-memory cache of decoded training images in each data loading worker.
+# The images are downscaled to the largest training size and also saved under CACHE_DIR,
+# see `ImageCache` in data.py. Set to 0 to decode the image files every time.
+_C.DATA.IMAGE_CACHE_MB = 0
+# If > 0, the data loading processes write the arrays of each training datapoint into shared memory slabs
+# of this size in MB, instead of serializing them. Every datapoint has to fit into a slab.
+# See `MultiProcessMapDataSharedMemory` in tensorpack.
+_C.DATA.SHM_SLAB_MB = 0
+# A directory written by bake.py. If set, the training datapoints are read from it,
+# instead of being preprocessed during training.
+_C.DATA.BAKED_TRAIN = ''
 
 # backbone ----------------------
 _C.BACKBONE.WEIGHTS = ''
@@ -138,6 +152,10 @@ _C.BACKBONE.STRIDE_1X1 = False  # True for MSRA models
 
 # schedule -----------------------
 _C.TRAIN.NUM_GPUS = None         # by default, will be set from code
+# Number of images in each GPU per step. If > 1, images of similar aspect ratio are padded to a batch,
+# the backbone runs on the batch, the rest of the model on each image, and the losses of the images are summed.
+# The total batch size below is NUM_GPUS * IMAGES_PER_GPU. Only for FPN models.
+_C.TRAIN.IMAGES_PER_GPU = 1
 _C.TRAIN.WEIGHT_DECAY = 1e-4
 _C.TRAIN.BASE_LR = 1e-2  # defined for total batch size=8. Otherwise it will be adjusted automatically
 _C.TRAIN.WARMUP = 1000   # in terms of iterations. This is not affected by #GPUs
@@ -159,6 +177,10 @@ _C.TRAIN.CHECKPOINT_PERIOD = 1  # period (epochs) to save model
 _C.PREPROC.TRAIN_SHORT_EDGE_SIZE = [800, 800]  # [min, max] to sample from
 _C.PREPROC.TEST_SHORT_EDGE_SIZE = 800
 _C.PREPROC.MAX_SIZE = 1333
+# The images are augmented and fed to the graph as uint8, and cast to float32 on the device
+# in `GeneralizedRCNN.preprocess`. Set to True to cast them before the augmentation and feed float32
+# images instead, which reproduces older versions exactly but moves 4x more bytes.
+_C.PREPROC.FLOAT_INPUT = False
 # mean and std in RGB order.
 # Un-scaled version: [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
 _C.PREPROC.PIXEL_MEAN = [123.675, 116.28, 103.53]
@@ -181,6 +203,9 @@ _C.RPN.PROPOSAL_NMS_THRESH = 0.7
 # It is disabled by default because Detectron does not do this.
 _C.RPN.CROWD_OVERLAP_THRESH = 9.99
 _C.RPN.HEAD_DIM = 1024      # used in C4 only
+# Feed only the anchors sampled for the loss (their indices, labels and target boxes) instead of
+# the labels and boxes of all anchors, see `TrainingDataPreprocessor`. Only for FPN models.
+_C.RPN.SPARSE_ANCHOR_INPUTS = False
 
 # RPN proposal selection -------------------------------
 # for C4
@@ -228,6 +253,8 @@ _C.TEST.FRCNN_NMS_THRESH = 0.5
 _C.TEST.RESULT_SCORE_THRESH = 0.05
 _C.TEST.RESULT_SCORE_THRESH_VIS = 0.5   # only visualize confident results
 _C.TEST.RESULTS_PER_IM = 100
+_C.TEST.BATCH_SIZE = 1   # number of images in one inference run of predict.py. >1 builds a batched inference graph
+_C.TEST.EVAL_NUM_WORKERS = 1   # number of processes for the COCO evaluation, which shards the images across them
 
 _C.freeze()  # avoid typo / wrong config keys
 
@@ -255,6 +282,13 @@ def finalize_configs(is_training):
 
     _C.RPN.NUM_ANCHOR = len(_C.RPN.ANCHOR_SIZES) * len(_C.RPN.ANCHOR_RATIOS)
     assert len(_C.FPN.ANCHOR_STRIDES) == len(_C.RPN.ANCHOR_SIZES)
+    assert _C.TEST.BATCH_SIZE >= 1, _C.TEST.BATCH_SIZE
+    assert _C.TEST.EVAL_NUM_WORKERS >= 1, _C.TEST.EVAL_NUM_WORKERS
+    assert _C.TRAIN.IMAGES_PER_GPU >= 1, _C.TRAIN.IMAGES_PER_GPU
+    if _C.TRAIN.IMAGES_PER_GPU > 1:
+        assert _C.MODE_FPN, "TRAIN.IMAGES_PER_GPU > 1 is only implemented for FPN models!"
+    if _C.RPN.SPARSE_ANCHOR_INPUTS:
+        assert _C.MODE_FPN, "RPN.SPARSE_ANCHOR_INPUTS is only implemented for FPN models!"
     # image size into the backbone has to be multiple of this number
     _C.FPN.RESOLUTION_REQUIREMENT = _C.FPN.ANCHOR_STRIDES[3]  # [3] because we build FPN with features r2,r3,r4,r5
 
@@ -302,6 +336,9 @@ def finalize_configs(is_training):
             ngpu = get_num_gpu()
         assert ngpu > 0, "Has to train with GPU!"
         assert ngpu % 8 == 0 or 8 % ngpu == 0, "Can only train with 1,2,4 or >=8 GPUs, but found {} GPUs".format(ngpu)
+        total_batch = ngpu * _C.TRAIN.IMAGES_PER_GPU
+        assert total_batch % 8 == 0 or 8 % total_batch == 0, \
+            "The total batch size has to be 1, 2, 4 or a multiple of 8, but is {}".format(total_batch)
     else:
         # autotune is too slow for inference
         os.environ['TF_CUDNN_USE_AUTOTUNE'] = '0'
@@ -5,15 +5,21 @@ Make changes on two rpn
 """
 
 import copy
+import functools
+import glob
+import hashlib
 import itertools
+import json
 import numpy as np
+import os
 import cv2
+from collections import OrderedDict, namedtuple
 from tabulate import tabulate
 from termcolor import colored
 
 from tensorpack.dataflow import (
-    DataFromList, MapData, MapDataComponent,
-    MultiProcessMapData, MultiThreadMapData, TestDataSpeed, imgaug,
+    BatchDataByShape, DataFromList, LMDBSerializer, MapData, MapDataComponent,
+    MultiProcessMapData, MultiProcessMapDataSharedMemory, MultiThreadMapData, TestDataSpeed, imgaug,
 )
 from tensorpack.utils import logger
 from tensorpack.utils.argtools import log_once
@@ -21,11 +27,11 @@ from tensorpack.utils.argtools import log_once
 from modeling.model_rpn import get_all_anchors
 from modeling.model_fpn import get_all_anchors_fpn
 from common import (
-    CustomResize, DataFromListOfDict, box_to_point4,
-    filter_boxes_inside_shape, np_iou, point4_to_box, polygons_to_mask,
+    CustomResize, DataFromListOfDict, SparseBoxMatcher, box_to_point4,
+    filter_boxes_inside_shape, np_iou, point4_to_box, polygons_to_mask, summarize_sparse_ious,
 )
 from config import config as cfg
-from dataset import DatasetRegistry, register_coco
+from dataset import DatasetRegistry, RoidbArrays, register_coco
 from utils.np_box_ops import area as np_area
 from utils.np_box_ops import ioa as np_ioa
 
@@ -39,7 +45,7 @@ class MalformedData(BaseException):
 def print_class_histogram(roidbs):
     """
     Args:
-        roidbs (list[dict]): the same format as the output of `training_roidbs`.
+        roidbs (iterable[dict]): the same format as the output of `training_roidbs`.
     """
     class_names = DatasetRegistry.get_metadata(cfg.DATA.TRAIN[0], 'class_names')
     # labels are in [1, NUM_CATEGORY], hence +2 for bins
@@ -65,6 +71,131 @@ def print_class_histogram(roidbs):
     logger.info("Ground-Truth category distribution:\n" + colored(table, "cyan"))
 
 
+class RoidbFetcher:
+    """
+    Look up the roidbs of the training dataflow in the dataflow workers, then preprocess them.
+
+    A roidb from a :class:`RoidbArrays` is sent to the workers as its (dataset index, image index)
+    only. The RoidbArrays are pickled with this object once per worker, by the path of their
+    memory-mapped cache if they have one. Other roidbs are sent as they are.
+    """
+
+    def __init__(self, roidbs, preprocess):
+        """
+        Args:
+            roidbs (list): the roidbs of each dataset
+            preprocess: the function to apply to each roidb
+        """
+        self.roidbs = [r if isinstance(r, RoidbArrays) else None for r in roidbs]
+        self.preprocess = preprocess
+
+    @staticmethod
+    def keys(roidbs, predicate):
+        """
+        Returns:
+            list: what to send to the workers for each roidb for which `predicate` is True
+        """
+        ret = []
+        for k, dataset_roidbs in enumerate(roidbs):
+            is_arrays = isinstance(dataset_roidbs, RoidbArrays)
+            for i, roidb in enumerate(dataset_roidbs):
+                if predicate(roidb):
+                    ret.append((k, i) if is_arrays else roidb)
+        return ret
+
+    def __call__(self, key):
+        if not isinstance(key, dict):
+            # the tuple may arrive as a list after serialization
+            key = self.roidbs[key[0]][key[1]]
+        return self.preprocess(key)
+
+
+class ImageCache:
+    """
+    A cache of the decoded training images, downscaled to the largest size the training
+    augmentation can produce, so that reading an image does not decode the full-resolution file.
+
+    Each process keeps the recently used images in memory, up to `ram_mb`, and evicts the least
+    recently used ones. If `cache_dir` is given, every image is also saved there as a .npy file,
+    which all processes memory-map, so each image is only decoded once by any worker.
+    Images are keyed by their file name and modification time.
+    """
+
+    def __init__(self, short_edge_size, max_size, ram_mb, cache_dir=None):
+        """
+        Args:
+            short_edge_size (int): the largest short edge used by the training augmentation
+            max_size (int): the largest long edge used by the training augmentation
+            ram_mb (float): the size of the in-memory cache of each process
+            cache_dir (str): directory to save the images in
+        """
+        self.short_edge_size = short_edge_size
+        self.max_size = max_size
+        self.ram_bytes = ram_mb * 1024 * 1024
+        if cache_dir:
+            cache_dir = os.path.join(
+                os.path.expanduser(cache_dir), 'images', '{}-{}'.format(int(short_edge_size), int(max_size)))
+        self.cache_dir = cache_dir
+        self._ram = OrderedDict()
+        self._ram_used = 0
+
+    def read(self, fname):
+        """
+        Returns:
+            (np.ndarray, tuple): the downscaled BGR uint8 image (read-only), and the (h, w) of the file
+        """
+        key = hashlib.sha1('{}:{}'.format(
+            os.path.abspath(fname), os.stat(fname).st_mtime_ns).encode('utf-8')).hexdigest()
+        entry = self._ram.get(key)
+        if entry is not None:
+            self._ram.move_to_end(key)
+            return entry
+        entry = self._read_disk(key)
+        if entry is None:
+            entry = self._decode(fname)
+            self._write_disk(key, entry)
+        self._ram[key] = entry
+        self._ram_used += entry[0].nbytes
+        while self._ram_used > self.ram_bytes and len(self._ram) > 1:
+            _, (img, _) = self._ram.popitem(last=False)
+            self._ram_used -= img.nbytes
+        return entry
+
+    def _decode(self, fname):
+        im = cv2.imread(fname, cv2.IMREAD_COLOR)
+        assert im is not None, fname
+        h, w = im.shape[:2]
+        scale = min(self.short_edge_size * 1.0 / min(h, w), self.max_size * 1.0 / max(h, w))
+        if scale < 1:
+            im = cv2.resize(im, (int(w * scale + 0.5), int(h * scale + 0.5)), interpolation=cv2.INTER_AREA)
+        im.setflags(write=False)
+        return im, (h, w)
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        fnames = glob.glob(os.path.join(self.cache_dir, key + '-*.npy'))
+        if not fnames:
+            return None
+        # the shape of the file is in the name
+        h, w = map(int, os.path.basename(fnames[0])[len(key) + 1:-len('.npy')].split('x'))
+        return np.asarray(np.load(fnames[0], mmap_mode='r')), (h, w)
+
+    def _write_disk(self, key, entry):
+        if not self.cache_dir:
+            return
+        im, (h, w) = entry
+        fname = os.path.join(self.cache_dir, '{}-{}x{}.npy'.format(key, h, w))
+        tmp_fname = '{}.tmp{}'.format(fname, os.getpid())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(tmp_fname, im, allow_pickle=False)
+            # np.save appends .npy, the rename makes the file visible to others only when complete
+            os.rename(tmp_fname + '.npy', fname)
+        except OSError as e:
+            log_once("Cannot save images to {}: {}".format(self.cache_dir, e), "warn")
+
+
 class TrainingDataPreprocessor:
     """
     The mapper to preprocess the input data for training.
@@ -79,6 +210,11 @@ class TrainingDataPreprocessor:
             CustomResize(cfg.PREPROC.TRAIN_SHORT_EDGE_SIZE, cfg.PREPROC.MAX_SIZE),
             imgaug.Flip(horiz=True)
         ])
+        self.image_cache = None
+        if cfg.DATA.IMAGE_CACHE_MB > 0:
+            self.image_cache = ImageCache(
+                max(cfg.PREPROC.TRAIN_SHORT_EDGE_SIZE), cfg.PREPROC.MAX_SIZE,
+                cfg.DATA.IMAGE_CACHE_MB, cfg.DATA.CACHE_DIR)
 
     def __call__(self, roidb):
         fname, boxes_house, boxes_damage, klass, is_crowd = roidb["file_name"], roidb["boxes_house"],roidb["boxes_damage"], roidb["class"], roidb["is_crowd"]
@@ -87,10 +223,12 @@ class TrainingDataPreprocessor:
         boxes_house = np.copy(boxes_house)
         boxes_damage = np.copy(boxes_damage)
 
-        im = cv2.imread(fname, cv2.IMREAD_COLOR)
-        assert im is not None, fname
-        im = im.astype("float32")
-        height, width = im.shape[:2]
+        if self.image_cache is not None:
+            im, (height, width) = self.image_cache.read(fname)
+        else:
+            im = cv2.imread(fname, cv2.IMREAD_COLOR)
+            assert im is not None, fname
+            height, width = im.shape[:2]
         # assume floatbox as input
         assert boxes_damage.dtype == np.float32, "Loader has to return float32 boxes!"
 
@@ -101,8 +239,16 @@ class TrainingDataPreprocessor:
             boxes_damage[:, 1::2] *= height
 
         # augmentation:
+        cached_shape = im.shape[:2]
+        if self.cfg.PREPROC.FLOAT_INPUT:
+            im = im.astype("float32")
+        # otherwise the image stays uint8, and is cast in the graph
         tfms = self.aug.get_transform(im)
         im = tfms.apply_image(im)
+        if cached_shape != (height, width):
+            # the image from the cache is downscaled, but the coordinates are of the file
+            tfms = imgaug.TransformList([
+                imgaug.ResizeTransform(height, width, cached_shape[0], cached_shape[1], cv2.INTER_AREA), tfms])
 
         points_house = box_to_point4(boxes_house)
         points_house = tfms.apply_coords(points_house)
@@ -126,17 +272,13 @@ class TrainingDataPreprocessor:
         try:
             if self.cfg.MODE_FPN:
                 # CHANGE TWO RPN anchors here
-                multilevel_anchor_inputs_house = self.get_multilevel_rpn_anchor_input(im, boxes_house, is_crowd)
-                for i, (anchor_labels, anchor_boxes_house) in enumerate(multilevel_anchor_inputs_house):
-                    ret["anchor_labels_lvl{}_house".format(i + 2)] = anchor_labels
-                    ret["anchor_boxes_lvl{}_house".format(i + 2)] = anchor_boxes_house
-
-                multilevel_anchor_inputs_damage = self.get_multilevel_rpn_anchor_input(
-                    im, boxes_damage, is_crowd)
-                for i, (anchor_labels, anchor_boxes_damage) in enumerate(
-                        multilevel_anchor_inputs_damage):
-                    ret["anchor_labels_lvl{}_damage".format(i + 2)] = anchor_labels
-                    ret["anchor_boxes_lvl{}_damage".format(i + 2)] = anchor_boxes_damage
+                multilevel_anchor_inputs_house, multilevel_anchor_inputs_damage = \
+                    self.get_multilevel_rpn_anchor_input_joint(im, boxes_house, boxes_damage, is_crowd)
+                for branch, multilevel_anchor_inputs in [
+                        ("house", multilevel_anchor_inputs_house), ("damage", multilevel_anchor_inputs_damage)]:
+                    for i, level_inputs in enumerate(multilevel_anchor_inputs):
+                        for name, v in zip(["anchor_labels", "anchor_boxes", "anchor_inds"], level_inputs):
+                            ret["{}_lvl{}_{}".format(name, i + 2, branch)] = v
             else:
                 ret["anchor_labels"], ret["anchor_boxes_house"] = self.get_rpn_anchor_input(im, boxes_house, is_crowd)
                 ret["anchor_labels"], ret["anchor_boxes_damage"] = self.get_rpn_anchor_input(im, boxes_damage, is_crowd)
@@ -240,51 +382,121 @@ class TrainingDataPreprocessor:
 
             fm_labels: fHxfWx NUM_ANCHOR_RATIOS
             fm_boxes: fHxfWx NUM_ANCHOR_RATIOS x4
+
+            If RPN.SPARSE_ANCHOR_INPUTS, each tuple is (labels, boxes, inds) of the K anchors
+            sampled in the level instead, see :meth:`_split_to_levels_sparse`.
         """
         boxes = boxes.copy()
-        anchors_per_level = get_all_anchors_fpn(
-            strides=self.cfg.FPN.ANCHOR_STRIDES,
-            sizes=self.cfg.RPN.ANCHOR_SIZES,
-            ratios=self.cfg.RPN.ANCHOR_RATIOS,
-            max_size=self.cfg.PREPROC.MAX_SIZE,
+        fpn_anchors = self._get_fpn_anchors(im.shape[:2])
+
+        gt_boxes = boxes[is_crowd == 0]
+        anchor_labels, anchor_gt_boxes = self.get_anchor_labels(
+            fpn_anchors.inside_anchors, gt_boxes, boxes[is_crowd == 1],
+            anchor_matches=fpn_anchors.matcher.pairwise_iou(gt_boxes)
         )
-        flatten_anchors_per_level = [k.reshape((-1, 4)) for k in anchors_per_level]
-        all_anchors_flatten = np.concatenate(flatten_anchors_per_level, axis=0)
+        return self._split_to_levels(fpn_anchors, anchor_labels, anchor_gt_boxes)
 
-        inside_ind, inside_anchors = filter_boxes_inside_shape(all_anchors_flatten, im.shape[:2])
+    def get_multilevel_rpn_anchor_input_joint(self, im, boxes_house, boxes_damage, is_crowd):
+        """
+        Like :meth:`get_multilevel_rpn_anchor_input`, but label the same anchors against
+        both house and damage boxes. The anchors inside the image are only selected once,
+        and their overlaps with all house and damage boxes are computed in one pass.
 
-        anchor_labels, anchor_gt_boxes = self.get_anchor_labels(
-            inside_anchors, boxes[is_crowd == 0], boxes[is_crowd == 1]
+        Args:
+            im: an image
+            boxes_house, boxes_damage: nx4, floatbox, gt. shoudn't be changed
+            is_crowd: n,
+
+        Returns:
+            [(fm_labels, fm_boxes)], [(fm_labels, fm_boxes)]: the per-level inputs
+            for house and damage respectively, in the format of :meth:`get_multilevel_rpn_anchor_input`.
+        """
+        fpn_anchors = self._get_fpn_anchors(im.shape[:2])
+
+        gt_house, crowd_house = boxes_house[is_crowd == 0], boxes_house[is_crowd == 1]
+        gt_damage, crowd_damage = boxes_damage[is_crowd == 0], boxes_damage[is_crowd == 1]
+        num_house = len(gt_house)
+        anchor_inds, gt_inds, ious = fpn_anchors.matcher.pairwise_iou(
+            np.concatenate([gt_house, gt_damage], axis=0))
+        is_house = gt_inds < num_house
+
+        multilevel_inputs = []
+        for gt_boxes, crowd_boxes, matches in [
+                (gt_house, crowd_house, (anchor_inds[is_house], gt_inds[is_house], ious[is_house])),
+                (gt_damage, crowd_damage,
+                 (anchor_inds[~is_house], gt_inds[~is_house] - num_house, ious[~is_house]))]:
+            anchor_labels, anchor_gt_boxes = self.get_anchor_labels(
+                fpn_anchors.inside_anchors, gt_boxes, crowd_boxes, anchor_matches=matches)
+            multilevel_inputs.append(
+                self._split_to_levels(fpn_anchors, anchor_labels, anchor_gt_boxes))
+        return tuple(multilevel_inputs)
+
+    def _get_fpn_anchors(self, shape2d):
+        """
+        Returns:
+            See :func:`get_inside_anchors_fpn`.
+        """
+        return get_inside_anchors_fpn(
+            tuple(shape2d),
+            strides=tuple(self.cfg.FPN.ANCHOR_STRIDES),
+            sizes=tuple(self.cfg.RPN.ANCHOR_SIZES),
+            ratios=tuple(self.cfg.RPN.ANCHOR_RATIOS),
+            max_size=self.cfg.PREPROC.MAX_SIZE,
         )
 
-        # map back to all_anchors, then split to each level
-        num_all_anchors = all_anchors_flatten.shape[0]
-        all_labels = -np.ones((num_all_anchors,), dtype="int32")
-        all_labels[inside_ind] = anchor_labels
-        all_boxes = np.zeros((num_all_anchors, 4), dtype="float32")
-        all_boxes[inside_ind] = anchor_gt_boxes
+    def _split_to_levels(self, fpn_anchors, anchor_labels, anchor_gt_boxes):
+        """
+        Map the labels of the inside anchors back to all anchors, then split to each level.
+        """
+        if self.cfg.RPN.SPARSE_ANCHOR_INPUTS:
+            return self._split_to_levels_sparse(fpn_anchors, anchor_labels, anchor_gt_boxes)
+        all_labels = -np.ones((fpn_anchors.num_anchors,), dtype="int32")
+        all_labels[fpn_anchors.inside_ind] = anchor_labels
+        all_boxes = np.zeros((fpn_anchors.num_anchors, 4), dtype="float32")
+        all_boxes[fpn_anchors.inside_ind] = anchor_gt_boxes
 
-        start = 0
         multilevel_inputs = []
-        for level_anchor in anchors_per_level:
-            assert level_anchor.shape[2] == len(self.cfg.RPN.ANCHOR_RATIOS)
-            anchor_shape = level_anchor.shape[:3]  # fHxfWxNUM_ANCHOR_RATIOS
-            num_anchor_this_level = np.prod(anchor_shape)
-            end = start + num_anchor_this_level
+        for anchor_shape, start, end in zip(
+                fpn_anchors.level_shapes, fpn_anchors.level_offsets[:-1], fpn_anchors.level_offsets[1:]):
             multilevel_inputs.append(
                 (all_labels[start:end].reshape(anchor_shape), all_boxes[start:end, :].reshape(anchor_shape + (4,)))
             )
-            start = end
-        assert end == num_all_anchors, "{} != {}".format(end, num_all_anchors)
         return multilevel_inputs
 
-    def get_anchor_labels(self, anchors, gt_boxes, crowd_boxes):
+    def _split_to_levels_sparse(self, fpn_anchors, anchor_labels, anchor_gt_boxes):
+        """
+        Like :meth:`_split_to_levels`, but only keep the anchors which are not ignored.
+
+        Returns:
+            [(labels, boxes, inds)]: for each level,
+            labels: (K,) int32, 0 or 1
+            boxes: (K, 4) float32, the target gt_box of the anchor when it is fg, otherwise zeros
+            inds: (K, 3) int32, the (y, x, anchor) coordinates of the anchors in the level
+        """
+        sampled = np.flatnonzero(anchor_labels >= 0)
+        sampled_ind = fpn_anchors.inside_ind[sampled]   # sorted, like inside_ind
+        bounds = np.searchsorted(sampled_ind, fpn_anchors.level_offsets)
+
+        multilevel_inputs = []
+        for anchor_shape, offset, start, end in zip(
+                fpn_anchors.level_shapes, fpn_anchors.level_offsets, bounds[:-1], bounds[1:]):
+            coords = np.unravel_index(sampled_ind[start:end] - offset, anchor_shape)
+            multilevel_inputs.append((
+                anchor_labels[sampled[start:end]],
+                anchor_gt_boxes[sampled[start:end]],
+                np.stack(coords, axis=1).astype("int32")))
+        return multilevel_inputs
+
+    def get_anchor_labels(self, anchors, gt_boxes, crowd_boxes, anchor_matches=None):
         """
         Label each anchor as fg/bg/ignore.
         Args:
             anchors: Ax4 float
             gt_boxes: Bx4 float, non-crowd
             crowd_boxes: Cx4 float
+            anchor_matches: (anchor_inds, gt_inds, ious), all the anchor/gt pairs with non-zero IoU,
+                as returned by :meth:`SparseBoxMatcher.pairwise_iou`.
+                If None, a dense AxB IoU matrix is computed instead.
 
         Returns:
             anchor_labels: (A,) int. Each element is {-1, 0, 1}
@@ -306,12 +518,17 @@ class TrainingDataPreprocessor:
             filter_box_label(anchor_labels, 0, self.cfg.RPN.BATCH_PER_IM)
             return anchor_labels, np.zeros((NA, 4), dtype="float32")
 
-        box_ious = np_iou(anchors, gt_boxes)  # NA x NB
-        ious_argmax_per_anchor = box_ious.argmax(axis=1)  # NA,
-        ious_max_per_anchor = box_ious.max(axis=1)
-        ious_max_per_gt = np.amax(box_ious, axis=0, keepdims=True)  # 1xNB
-        # for each gt, find all those anchors (including ties) that has the max ious with it
-        anchors_with_max_iou_per_gt = np.where(box_ious == ious_max_per_gt)[0]
+        if anchor_matches is None:
+            box_ious = np_iou(anchors, gt_boxes)  # NA x NB
+            ious_argmax_per_anchor = box_ious.argmax(axis=1)  # NA,
+            ious_max_per_anchor = box_ious.max(axis=1)
+            ious_max_per_gt = np.amax(box_ious, axis=0, keepdims=True)  # 1xNB
+            # for each gt, find all those anchors (including ties) that has the max ious with it
+            anchors_with_max_iou_per_gt = np.where(box_ious == ious_max_per_gt)[0]
+        else:
+            # same results as above, from the few non-zero entries of the IoU matrix
+            ious_argmax_per_anchor, ious_max_per_anchor, anchors_with_max_iou_per_gt = \
+                summarize_sparse_ious(NA, NB, *anchor_matches)
 
         # Setting NA labels: 1--fg 0--bg -1--ignore
         anchor_labels = -np.ones((NA,), dtype="int32")  # NA,
@@ -352,48 +569,291 @@ class TrainingDataPreprocessor:
         return anchor_labels, anchor_boxes
 
 
-def get_train_dataflow():
+FPNAnchors = namedtuple(
+    'FPNAnchors',
+    ['level_shapes', 'level_offsets', 'num_anchors', 'inside_ind', 'inside_anchors', 'matcher'])
+"""
+level_shapes: [(fH, fW, NUM_ANCHOR_RATIOS)], the anchor shape of each level
+level_offsets: #lvl+1 ints, level i has the anchors in [level_offsets[i], level_offsets[i+1])
+num_anchors: int, number of anchors in all levels
+inside_ind: (k, ) indices of the anchors inside the image
+inside_anchors: kx4, the anchors inside the image
+matcher: a `SparseBoxMatcher` of the inside anchors, grouped by level
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def get_inside_anchors_fpn(shape2d, *, strides, sizes, ratios, max_size):
     """
-    Return a training dataflow. Each datapoint consists of the following:
+    Flatten the anchors of all FPN levels, and select those inside an image of this shape.
 
-    An image: (h, w, 3),
+    The result only depends on the image shape and the anchor config, and training images
+    come in a limited number of shapes, so it is cached per-process to leave only the
+    IoU and sampling work for each image.
 
-    1 or more pairs of (anchor_labels, anchor_boxes):
-    anchor_labels: (h', w', NA)
-    anchor_boxes: (h', w', NA, 4)
+    Args:
+        shape2d (tuple): h, w of the image
+        strides, sizes, ratios, max_size: see :func:`get_all_anchors_fpn`.
 
-    gt_boxes: (N, 4)
-    gt_labels: (N,)
+    Returns:
+        FPNAnchors. The arrays are read-only.
+    """
+    anchors_per_level = get_all_anchors_fpn(strides=strides, sizes=sizes, ratios=ratios, max_size=max_size)
+    flatten_anchors_per_level = [k.reshape((-1, 4)) for k in anchors_per_level]
+    all_anchors_flatten = np.concatenate(flatten_anchors_per_level, axis=0)
+
+    inside_ind, inside_anchors = filter_boxes_inside_shape(all_anchors_flatten, shape2d)
+    inside_ind.setflags(write=False)
+    inside_anchors.setflags(write=False)
+
+    level_shapes = []
+    for level_anchor in anchors_per_level:
+        assert level_anchor.shape[2] == len(ratios)
+        level_shapes.append(level_anchor.shape[:3])  # fHxfWxNUM_ANCHOR_RATIOS
+    level_offsets = np.cumsum([0] + [np.prod(k) for k in level_shapes]).tolist()
+    assert level_offsets[-1] == len(all_anchors_flatten), "{} != {}".format(
+        level_offsets[-1], len(all_anchors_flatten))
+    matcher = SparseBoxMatcher(inside_anchors, np.searchsorted(inside_ind, level_offsets[1:-1]))
+    return FPNAnchors(level_shapes, level_offsets, len(all_anchors_flatten), inside_ind, inside_anchors, matcher)
+
+
+def batch_training_datapoints(dps):
+    """
+    Args:
+        dps (list[dict]): datapoints produced by :class:`TrainingDataPreprocessor`
 
-    If MODE_MASK, gt_masks: (N, h, w)
+    Returns:
+        dict: a datapoint with the same keys, where each array gets a new first dimension
+        and is padded at the end of every dimension to the largest shape in the batch:
+        anchor labels with -1 (i.e. ignored), everything else with 0.
+        Two arrays tell the valid parts of the padded ones:
+
+        image_shape2d: (N, 2) int32, the height and width of each image
+        gt_count: (N,) int32, the number of groundtruth instances of each image
+    """
+    ret = {}
+    for k in dps[0]:
+        arrs = [dp[k] for dp in dps]
+        shape = np.max([a.shape for a in arrs], axis=0)
+        batch = np.full((len(arrs),) + tuple(shape), -1 if k.startswith('anchor_labels') else 0, dtype=arrs[0].dtype)
+        for b, a in zip(batch, arrs):
+            b[tuple(slice(0, s) for s in a.shape)] = a
+        ret[k] = batch
+    ret['image_shape2d'] = np.asarray([dp['image'].shape[:2] for dp in dps], dtype=np.int32)
+    ret['gt_count'] = np.asarray([len(dp['gt_labels']) for dp in dps], dtype=np.int32)
+    return ret
+
+
+class BatchDataByAspectRatio(BatchDataByShape):
+    """
+    Like :class:`BatchDataByShape`, but group the training datapoints of landscape images
+    and of portrait images together, so that little is padded in :func:`batch_training_datapoints`.
     """
-    roidbs = list(itertools.chain.from_iterable(DatasetRegistry.get(x).training_roidbs() for x in cfg.DATA.TRAIN))
-    print_class_histogram(roidbs)
+    def __init__(self, ds, batch_size, copy=False):
+        """
+        Args:
+            ds (DataFlow): produces datapoints of :class:`TrainingDataPreprocessor`
+            batch_size (int): number of images in a batch
+            copy (bool): copy the arrays of the datapoints which wait for a batch.
+                Needed if `ds` reuses them, e.g. :class:`MultiProcessMapDataSharedMemory`.
+        """
+        super(BatchDataByAspectRatio, self).__init__(ds, batch_size, 'image')
+        self.copy = copy
+
+    def __iter__(self):
+        with self._guard:
+            for dp in self.ds:
+                h, w = dp['image'].shape[:2]
+                holder = self.holder[h > w]
+                holder.append({k: v.copy() for k, v in dp.items()} if self.copy else dp)
+                if len(holder) == self.batch_size:
+                    yield batch_training_datapoints(holder)
+                    del holder[:]
+
+
+def get_training_roidbs():
+    """
+    Returns:
+        list: the roidbs of each training dataset
+        list: the keys of the roidbs to train on, for :class:`RoidbFetcher`
+    """
+    roidbs = [DatasetRegistry.get(x).training_roidbs() for x in cfg.DATA.TRAIN]
+    print_class_histogram(itertools.chain.from_iterable(roidbs))
 
     # Filter out images that have no gt boxes, but this filter shall not be applied for testing.
     # The model does support training with empty images, but it is not useful for COCO.
-    num = len(roidbs)
-    roidbs = list(filter(lambda img: len(img["boxes_damage"][img["is_crowd"] == 0]) > 0, roidbs))
+    num = sum(len(r) for r in roidbs)
+    keys = RoidbFetcher.keys(roidbs, lambda img: len(img["boxes_damage"][img["is_crowd"] == 0]) > 0)
     logger.info(
         "Filtered {} images which contain no non-crowd groudtruth boxes. Total #images for training: {}".format(
-            num - len(roidbs), len(roidbs)
+            num - len(keys), len(keys)
         )
     )
+    return roidbs, keys
 
-    ds = DataFromList(roidbs, shuffle=True)
 
-    preprocess = TrainingDataPreprocessor(cfg)
+def sparsify_anchor_inputs(dp):
+    """
+    Args:
+        dp (dict): a datapoint produced by :class:`TrainingDataPreprocessor`
+
+    Returns:
+        dict: the datapoint, where each pair of dense anchor labels "anchor_labels*" and boxes "anchor_boxes*"
+        is replaced by:
 
+        anchor_labels*_shape: the shape of the labels
+        anchor_labels*_fg, anchor_labels*_bg: int32, the indices of the fg and bg anchors in the flattened labels
+        anchor_boxes*_fg: (#fg, 4) float32, the boxes of the fg anchors
+
+        All other anchors are ignored and have zero boxes, so :func:`densify_anchor_inputs` restores them exactly.
+    """
+    ret = dict(dp)
+    for k in dp:
+        boxes_key = k.replace('anchor_labels', 'anchor_boxes')
+        if not k.startswith('anchor_labels') or boxes_key not in dp:
+            continue
+        labels = ret.pop(k)
+        boxes = ret.pop(boxes_key).reshape((-1, 4))
+        fg_inds = np.flatnonzero(labels == 1).astype('int32')
+        ret[k + '_shape'] = np.asarray(labels.shape, dtype='int32')
+        ret[k + '_fg'] = fg_inds
+        ret[k + '_bg'] = np.flatnonzero(labels == 0).astype('int32')
+        ret[boxes_key + '_fg'] = boxes[fg_inds]
+    return ret
+
+
+def densify_anchor_inputs(dp):
+    """
+    The inverse of :func:`sparsify_anchor_inputs`.
+    """
+    ret = dict(dp)
+    for k in dp:
+        if not (k.startswith('anchor_labels') and k.endswith('_shape')):
+            continue
+        k = k[:-len('_shape')]
+        boxes_key = k.replace('anchor_labels', 'anchor_boxes')
+        shape = tuple(ret.pop(k + '_shape').tolist())
+        fg_inds, bg_inds = ret.pop(k + '_fg'), ret.pop(k + '_bg')
+        labels = -np.ones(shape, dtype='int32')
+        labels.reshape(-1)[fg_inds] = 1
+        labels.reshape(-1)[bg_inds] = 0
+        boxes = np.zeros(shape + (4,), dtype='float32')
+        boxes.reshape((-1, 4))[fg_inds] = ret.pop(boxes_key + '_fg')
+        ret[k], ret[boxes_key] = labels, boxes
+    return ret
+
+
+# the configs which the baked training datapoints depend on
+BAKED_CONFIG_KEYS = [
+    'MODE_MASK', 'MODE_FPN', 'DATA.TRAIN', 'DATA.ABSOLUTE_COORD',
+    'PREPROC.TRAIN_SHORT_EDGE_SIZE', 'PREPROC.MAX_SIZE',
+    'RPN.ANCHOR_STRIDE', 'RPN.ANCHOR_SIZES', 'RPN.ANCHOR_RATIOS', 'RPN.POSITIVE_ANCHOR_THRESH',
+    'RPN.NEGATIVE_ANCHOR_THRESH', 'RPN.CROWD_OVERLAP_THRESH', 'RPN.FG_RATIO', 'RPN.BATCH_PER_IM',
+    'RPN.SPARSE_ANCHOR_INPUTS', 'FPN.ANCHOR_STRIDES']
+
+
+def get_baked_config(cfg):
+    """
+    Returns:
+        dict: the values of `BAKED_CONFIG_KEYS` in cfg, as they are saved in json
+    """
+    return json.loads(json.dumps({k: functools.reduce(getattr, k.split('.'), cfg) for k in BAKED_CONFIG_KEYS}))
+
+
+def decode_baked_datapoint(dp):
+    """
+    Turn a datapoint saved by bake.py back to the format of :class:`TrainingDataPreprocessor`.
+    """
+    dp = densify_anchor_inputs(dp)
+    if 'image_jpeg' in dp:
+        dp['image'] = cv2.imdecode(dp.pop('image_jpeg'), cv2.IMREAD_COLOR)
+    if cfg.PREPROC.FLOAT_INPUT:
+        dp['image'] = dp['image'].astype('float32')
+    return dp
+
+
+def get_baked_train_dataflow(path):
+    """
+    Args:
+        path (str): a directory written by bake.py
+
+    Returns:
+        DataFlow: the training datapoints in it, in random order, in the format of :class:`TrainingDataPreprocessor`.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    baked_config, curr_config = meta['config'], get_baked_config(cfg)
+    diff = [k for k in BAKED_CONFIG_KEYS if baked_config.get(k) != curr_config[k]]
+    if diff:
+        raise ValueError("The training data in {} is baked with a different config: {}".format(
+            path, ", ".join("{}={} instead of {}".format(k, baked_config.get(k), curr_config[k]) for k in diff)))
+    # the shards are read block by block, see `ShardedLMDBData`
+    ds = LMDBSerializer.load(path, shuffle=True)
+    logger.info("Found {} baked training datapoints of {} augmentations per image in {}.".format(
+        len(ds), meta['num_augmentations'], path))
     if cfg.DATA.NUM_WORKERS > 0:
-        if cfg.TRAINER == "horovod":
-            buffer_size = cfg.DATA.NUM_WORKERS * 10  # one dataflow for each process, therefore don't need large buffer
-            ds = MultiThreadMapData(ds, cfg.DATA.NUM_WORKERS, preprocess, buffer_size=buffer_size)
-            # MPI does not like fork()
-        else:
-            buffer_size = cfg.DATA.NUM_WORKERS * 20
-            ds = MultiProcessMapData(ds, cfg.DATA.NUM_WORKERS, preprocess, buffer_size=buffer_size)
+        # decoding releases the GIL
+        ds = MultiThreadMapData(ds, cfg.DATA.NUM_WORKERS, decode_baked_datapoint, buffer_size=cfg.DATA.NUM_WORKERS * 4)
+    else:
+        ds = MapData(ds, decode_baked_datapoint)
+    return ds
+
+
+def get_train_dataflow():
+    """
+    Return a training dataflow. Each datapoint consists of the following:
+
+    An image: (h, w, 3),
+
+    1 or more pairs of (anchor_labels, anchor_boxes):
+    anchor_labels: (h', w', NA)
+    anchor_boxes: (h', w', NA, 4)
+    or, if RPN.SPARSE_ANCHOR_INPUTS, the K anchors sampled for the loss in 1 or more triples of
+    anchor_labels: (K,), anchor_boxes: (K, 4), anchor_inds: (K, 3)
+
+    gt_boxes: (N, 4)
+    gt_labels: (N,)
+
+    If MODE_MASK, gt_masks: (N, h, w)
+
+    If DATA.BAKED_TRAIN is set, the datapoints are read from there instead of preprocessed here.
+
+    If TRAIN.IMAGES_PER_GPU > 1, each datapoint is a batch of images with similar aspect ratios,
+    see :func:`batch_training_datapoints`.
+    """
+    if cfg.DATA.BAKED_TRAIN:
+        ds = get_baked_train_dataflow(cfg.DATA.BAKED_TRAIN)
     else:
-        ds = MapData(ds, preprocess)
+        roidbs, keys = get_training_roidbs()
+        # the workers get the roidbs from `RoidbFetcher` by their keys
+        ds = DataFromList(keys, shuffle=True)
+
+        preprocess = RoidbFetcher(roidbs, TrainingDataPreprocessor(cfg))
+
+        if cfg.DATA.NUM_WORKERS > 0:
+            if cfg.TRAINER == "horovod":
+                # one dataflow for each process, therefore don't need large buffer
+                buffer_size = cfg.DATA.NUM_WORKERS * 10
+                ds = MultiThreadMapData(ds, cfg.DATA.NUM_WORKERS, preprocess, buffer_size=buffer_size)
+                # MPI does not like fork()
+            else:
+                if cfg.DATA.SHM_SLAB_MB > 0:
+                    # every datapoint in the buffer takes a slab, therefore use a smaller buffer
+                    buffer_size = cfg.DATA.NUM_WORKERS * 4
+                    ds = MultiProcessMapDataSharedMemory(
+                        ds, cfg.DATA.NUM_WORKERS, preprocess, slab_size=int(cfg.DATA.SHM_SLAB_MB * 1024 ** 2),
+                        buffer_size=buffer_size)
+                else:
+                    buffer_size = cfg.DATA.NUM_WORKERS * 20
+                    ds = MultiProcessMapData(ds, cfg.DATA.NUM_WORKERS, preprocess, buffer_size=buffer_size)
+        else:
+            ds = MapData(ds, preprocess)
+    if cfg.TRAIN.IMAGES_PER_GPU > 1:
+        ds = BatchDataByAspectRatio(
+            ds, cfg.TRAIN.IMAGES_PER_GPU, copy=isinstance(ds, MultiProcessMapDataSharedMemory))
+    elif isinstance(ds, MultiProcessMapDataSharedMemory):
+        # the slabs get reused, and TF may feed the arrays to the queue without copying them
+        ds = MapData(ds, lambda dp: {k: v.copy() for k, v in dp.items()})
     return ds
 
 
@@ -424,7 +884,6 @@ def get_eval_dataflow(name, shard=0, num_shards=1):
 
 
 if __name__ == "__main__":
-    import os
     from tensorpack.dataflow import PrintData
     from config import finalize_configs
 
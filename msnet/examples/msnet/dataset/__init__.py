@@ -1,3 +1,5 @@
 from .dataset import *
+from .results import *
+from .roidb import *
 from .coco import *
 from .balloon import *
@@ -5,17 +5,43 @@ Make changes on two rpn
 import json
 import numpy as np
 import os
-import tqdm
 
 from tensorpack.utils import logger
 from tensorpack.utils.timer import timed_operation
 
 from config import config as cfg
 from dataset import DatasetRegistry, DatasetSplit
+from dataset import DetectionResults
+from dataset.roidb import RoidbArrays, roidb_cache_key, save_roidb_arrays
 
 __all__ = ['register_coco']
 
 
+def _metric_targets(has_mask):
+    """
+    Returns:
+        list of (name, (iouType, gtType)): the targets of the COCO evaluation, and their names in the metrics
+    """
+    targets = [('d_bbox', ('bbox', 'd')), ('h_bbox', ('bbox', 'h'))]
+    if has_mask:
+        targets.append(('segm', ('segm', 'd')))
+    return targets
+
+
+def _summarize_metrics(cocoEval, targets):
+    """
+    Accumulate an evaluated `MultiTargetCOCOeval` of `targets` and return its metrics.
+    """
+    cocoEval.accumulate()
+    cocoEval.summarize()
+    ret = {}
+    fields = ['IoU=0.25:0.5', 'IoU=0.25', 'IoU=0.5', 'small', 'medium', 'large']
+    for (name, _), stats in zip(targets, cocoEval.stats):
+        for k in range(6):
+            ret['mAP({})/'.format(name) + fields[k]] = stats[k]
+    return ret
+
+
 class COCODetection(DatasetSplit):
     # handle a few special splits whose names do not match the directory names
     _INSTANCE_TO_BASEDIR = {
@@ -53,177 +79,199 @@ class COCODetection(DatasetSplit):
         annotation_file = os.path.join(
             basedir, 'annotations/instances_{}.json'.format(split))
         assert os.path.isfile(annotation_file), annotation_file
-
-        from pycocotools.coco import COCO
-        self.coco = COCO(annotation_file)
         self.annotation_file = annotation_file
-        logger.info("Instances loaded from {}.".format(annotation_file))
+        self._coco = None
+
+    @property
+    def coco(self):
+        """
+        The COCO object of the annotations. It is only parsed when used,
+        roidbs loaded from the cache do not need it.
+        """
+        if self._coco is None:
+            from pycocotools.coco import COCO
+            self._coco = COCO(self.annotation_file)
+            logger.info("Instances loaded from {}.".format(self.annotation_file))
+        return self._coco
 
     # https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocoEvalDemo.ipynb
-    def print_coco_metrics(self, results):
+    def print_coco_metrics(self, results, fast_match=True, num_workers=1):
         """
         Args:
-            results(list[dict]): results in coco format
+            results(list[dict] or dict): results in coco format, or their columns as returned by
+                `_to_coco_columns`
+            fast_match(bool): match detections to groundtruth with the vectorized matcher of COCOeval,
+                which gives the same numbers as its original loop
+            num_workers(int): shard the images across this many processes in COCOeval.evaluate
         Returns:
             dict: the evaluation metrics
         """
-        from pycocotools.cocoeval import COCOeval
-        ret = {}
-        has_mask = "segmentation" in results[0]  # results will be modified by loadRes
-
-        cocoDt = self.coco.loadRes(results)
-        cocoEval = COCOeval(self.coco, cocoDt, 'bbox', 'd')
-        cocoEval.evaluate()
-        cocoEval.accumulate()
-        cocoEval.summarize()
-        fields = ['IoU=0.25:0.5', 'IoU=0.25', 'IoU=0.5', 'small', 'medium', 'large']
-        for k in range(6):
-            ret['mAP(d_bbox)/' + fields[k]] = cocoEval.stats[k]
-
-        cocoEval = COCOeval(self.coco, cocoDt, 'bbox', 'h')
+        from pycocotools.cocoeval import MultiTargetCOCOeval
+        if isinstance(results, dict):
+            has_mask = "segmentation/counts" in results
+            cocoDt = results
+        else:
+            has_mask = len(results) > 0 and "segmentation" in results[0]  # results will be modified by loadRes
+            cocoDt = self.coco.loadRes(results)
+        # damage boxes, house boxes and masks are evaluated in a single pass over the images
+        targets = _metric_targets(has_mask)
+        cocoEval = MultiTargetCOCOeval(self.coco, cocoDt, [t for _, t in targets])
+        cocoEval.params.fastMatch = int(fast_match)
+        cocoEval.params.numProc = num_workers
         cocoEval.evaluate()
-        cocoEval.accumulate()
-        cocoEval.summarize()
-        fields = ['IoU=0.25:0.5', 'IoU=0.25', 'IoU=0.5', 'small', 'medium',
-                  'large']
-        for k in range(6):
-            ret['mAP(h_bbox)/' + fields[k]] = cocoEval.stats[k]
-
+        return _summarize_metrics(cocoEval, targets)
 
-        if len(results) > 0 and has_mask:
-            cocoEval = COCOeval(self.coco, cocoDt, 'segm', 'd')
-            cocoEval.evaluate()
-            cocoEval.accumulate()
-            cocoEval.summarize()
-            for k in range(6):
-                ret['mAP(segm)/' + fields[k]] = cocoEval.stats[k]
-        return ret
-
-    def load(self, add_gt=True, add_mask=False):
+    def load(self, add_gt=True, add_mask=False, cache_dir=None):
         """
         Args:
             add_gt: whether to add ground truth bounding box annotations to the dicts
             add_mask: whether to also add ground truth mask
+            cache_dir (str): if given, the roidbs are cached in this directory, keyed by the content
+                of the annotation file and the arguments. A cached roidb is memory-mapped instead
+                of parsing the annotations again, see `dataset.roidb`.
 
         Returns:
-            a list of dict, each has keys including:
+            RoidbArrays: a sequence of dict, each has keys including:
                 'image_id', 'file_name',
-                and (if add_gt is True) 'boxes', 'class', 'is_crowd', and optionally
+                and (if add_gt is True) 'boxes_house', 'boxes_damage', 'class', 'is_crowd', and optionally
                 'segmentation'.
         """
         with timed_operation('Load annotations for {}'.format(
                 os.path.basename(self.annotation_file))):
-            img_ids = self.coco.getImgIds()
-            img_ids.sort()
-            # list of dict, each has keys: height,width,id,file_name
-            imgs = self.coco.loadImgs(img_ids)
-
-            for idx, img in enumerate(tqdm.tqdm(imgs)):
-                img['image_id'] = img.pop('id')
-                img['file_name'] = os.path.join(self._imgdir, img['file_name'])
-                if idx == 0:
-                    # make sure the directories are correctly set
-                    assert os.path.isfile(img["file_name"]), img["file_name"]
-                if add_gt:
-                    self._add_detection_gt(img, add_mask)
-            return imgs
-
-    def _add_detection_gt(self, img, add_mask):
+            roidbs = None
+            if cache_dir:
+                key = roidb_cache_key(
+                    self.annotation_file, add_gt=add_gt, add_mask=add_mask,
+                    category_ids=sorted(self.COCO_id_to_category_id.items()))
+                cache_path = os.path.join(os.path.expanduser(cache_dir), 'roidb', '{}-{}'.format(
+                    os.path.splitext(os.path.basename(self.annotation_file))[0], key))
+                roidbs = RoidbArrays.load(cache_path, self._imgdir)
+                if roidbs is not None:
+                    logger.info("Loaded roidbs from the cache {}.".format(cache_path))
+            if roidbs is None:
+                arrays = self._load_arrays(add_gt, add_mask)
+                roidbs = RoidbArrays(arrays, self._imgdir)
+                if cache_dir:
+                    try:
+                        save_roidb_arrays(arrays, cache_path)
+                    except OSError as e:
+                        logger.warn("Cannot cache the roidbs in {}: {}".format(cache_path, e))
+                    else:
+                        # memory-mapped, to be shared with the dataflow workers
+                        roidbs = RoidbArrays.load(cache_path, self._imgdir)
+            if len(roidbs):
+                # make sure the directories are correctly set
+                assert os.path.isfile(roidbs[0]["file_name"]), roidbs[0]["file_name"]
+            return roidbs
+
+    def _load_arrays(self, add_gt, add_mask):
+        """
+        Parse the annotations into the arrays described in `dataset.roidb`.
         """
-        Add 'boxes', 'class', 'is_crowd' of this image to the dict, used by detection.
-        If add_mask is True, also add 'segmentation' in coco poly format.
+        img_ids = self.coco.getImgIds()
+        img_ids.sort()
+        # list of dict, each has keys: height,width,id,file_name
+        imgs = self.coco.loadImgs(img_ids)
+        names = [img['file_name'].encode('utf-8') for img in imgs]
+        arrays = {
+            'image_id': np.asarray(img_ids),
+            'file_name': np.frombuffer(b''.join(names), dtype=np.uint8),
+            'file_name_offsets': np.cumsum([0] + [len(n) for n in names]).astype(np.int64),
+            'height': np.asarray([img['height'] for img in imgs], dtype='int32'),
+            'width': np.asarray([img['width'] for img in imgs], dtype='int32'),
+        }
+        if add_gt:
+            arrays.update(self._detection_gt_arrays(imgs, arrays['height'], arrays['width'], add_mask))
+        return arrays
+
+    def _detection_gt_arrays(self, imgs, heights, widths, add_mask):
         """
-        # ann_ids = self.coco.getAnnIds(imgIds=img['image_id'])
+        Get 'boxes_house', 'boxes_damage', 'class', 'is_crowd' of all images, used by detection,
+        with their 'ann_offsets'. If add_mask is True, also the polygons of 'segmentation'.
+        """
+        # ann_ids = self.coco.getAnnIds(imgIds=img['id'])
         # objs = self.coco.loadAnns(ann_ids)
-        objs = self.coco.imgToAnns[img['image_id']]  # equivalent but faster than the above two lines
+        objs_per_img = [self.coco.imgToAnns[img['id']] for img in imgs]  # equivalent but faster
+        num_objs = [len(objs) for objs in objs_per_img]
+        objs = [obj for objs in objs_per_img for obj in objs]
+        img_index = np.repeat(np.arange(len(imgs)), num_objs)
         if 'minival' not in self.annotation_file:
             # TODO better to check across the entire json, rather than per-image
-            ann_ids = [ann["id"] for ann in objs]
-            assert len(set(ann_ids)) == len(ann_ids), \
+            ann_ids = set(zip(img_index.tolist(), [obj["id"] for obj in objs]))
+            assert len(ann_ids) == len(objs), \
                 "Annotation ids in '{}' are not unique!".format(self.annotation_file)
 
-        # clean-up boxes
-        width = img.pop('width')
-        height = img.pop('height')
-
-        all_boxes_house = []
-        all_boxes_damage = []
-        all_segm = []
-        all_cls = []
-        all_iscrowd = []
-        for objid, obj in enumerate(objs):
-            if obj.get('ignore', 0) == 1:
-                continue
-            x1_house, y1_house, w_house, h_house = list(map(float, obj['house_bbox']))
-            x1_damage, y1_damage, w_damage, h_damage = list(map(float, obj['damage_bbox']))
+        def clipped_boxes(key):
             # bbox is originally in float
             # x1/y1 means upper-left corner and w/h means true w/h. This can be verified by segmentation pixels.
             # But we do make an assumption here that (0.0, 0.0) is upper-left corner of the first pixel
-            x2_house, y2_house = x1_house + w_house, y1_house + h_house
-            x2_damage, y2_damage = x1_damage + w_damage, y1_damage + h_damage
-
-            # np.clip would be quite slow here
-            x1_house = min(max(x1_house, 0), width)
-            x2_house = min(max(x2_house, 0), width)
-            y1_house = min(max(y1_house, 0), height)
-            y2_house = min(max(y2_house, 0), height)
-            w_house, h_house = x2_house - x1_house, y2_house - y1_house
-
-            x1_damage = min(max(x1_damage, 0), width)
-            x2_damage = min(max(x2_damage, 0), width)
-            y1_damage = min(max(y1_damage, 0), height)
-            y2_damage = min(max(y2_damage, 0), height)
-            w_damage, h_damage = x2_damage - x1_damage, y2_damage - y1_damage
-
-
-            # Require non-zero seg area and more than 1x1 box size
-            if obj['area'] > 1 and w_house > 0 and h_house > 0:
-                all_boxes_house.append([x1_house, y1_house, x2_house, y2_house])
-                all_boxes_damage.append([x1_damage, y1_damage, x2_damage, y2_damage])
-                all_cls.append(self.COCO_id_to_category_id.get(obj['category_id'], obj['category_id']))
-                iscrowd = obj.get("iscrowd", 0)
-                all_iscrowd.append(iscrowd)
-
-                if add_mask:
-                    segs = obj['segmentation']
-                    if not isinstance(segs, list):
-                        assert iscrowd == 1
-                        all_segm.append(None)
-                    else:
-                        valid_segs = [np.asarray(p).reshape(-1, 2).astype('float32') for p in segs if len(p) >= 6]
-                        if len(valid_segs) == 0:
-                            logger.error("Object {} in image {} has no valid polygons!".format(objid, img['file_name']))
-                        elif len(valid_segs) < len(segs):
-                            logger.warn("Object {} in image {} has invalid polygons!".format(objid, img['file_name']))
-                        all_segm.append(valid_segs)
+            boxes = np.asarray([obj[key] for obj in objs], dtype='float64').reshape((-1, 4))
+            boxes[:, 2:] += boxes[:, :2]
+            # clean-up boxes
+            boxes[:, 0::2] = np.minimum(np.maximum(boxes[:, 0::2], 0), widths[img_index, None])
+            boxes[:, 1::2] = np.minimum(np.maximum(boxes[:, 1::2], 0), heights[img_index, None])
+            return boxes
+
+        boxes_house = clipped_boxes('house_bbox')
+        boxes_damage = clipped_boxes('damage_bbox')
+        area = np.asarray([obj['area'] for obj in objs], dtype='float64')
+        ignore = np.asarray([obj.get('ignore', 0) == 1 for obj in objs], dtype='bool')
+        # Require non-zero seg area and more than 1x1 box size
+        valid = ~ignore & (area > 1) & \
+            (boxes_house[:, 2] > boxes_house[:, 0]) & (boxes_house[:, 3] > boxes_house[:, 1])
+        valid_inds = np.flatnonzero(valid).tolist()
 
         # all geometrically-valid boxes are returned
-        if len(all_boxes_house):
-            img['boxes_house'] = np.asarray(all_boxes_house, dtype='float32')  # (n, 4)
-        else:
-            img['boxes_house'] = np.zeros((0, 4), dtype='float32')
-        if len(all_boxes_damage):
-            img['boxes_damage'] = np.asarray(all_boxes_damage,
-                                            dtype='float32')  # (n, 4)
-        else:
-            img['boxes_damage'] = np.zeros((0, 4), dtype='float32')
-
-        cls = np.asarray(all_cls, dtype='int32')  # (n,)
+        cls = np.asarray([self.COCO_id_to_category_id.get(objs[k]['category_id'], objs[k]['category_id'])
+                          for k in valid_inds], dtype='int32')  # (n,)
         if len(cls):
             assert cls.min() > 0, "Category id in COCO format must > 0!"
-        img['class'] = cls          # n, always >0
-        img['is_crowd'] = np.asarray(all_iscrowd, dtype='int8')  # n,
+        arrays = {
+            'ann_offsets': np.cumsum(
+                [0] + np.bincount(img_index[valid], minlength=len(imgs)).tolist()).astype(np.int64),
+            'boxes_house': boxes_house[valid].astype('float32'),  # (n, 4)
+            'boxes_damage': boxes_damage[valid].astype('float32'),  # (n, 4)
+            'class': cls,  # n, always >0
+            'is_crowd': np.asarray([objs[k].get("iscrowd", 0) for k in valid_inds], dtype='int8'),  # n,
+        }
+
         if add_mask:
-            # also required to be float32
-            img['segmentation'] = all_segm
+            first_obj = np.cumsum([0] + num_objs).tolist()
+            segm_is_none, num_polys, polys = [], [], []
+            for k in valid_inds:
+                segs = objs[k]['segmentation']
+                if not isinstance(segs, list):
+                    assert objs[k].get("iscrowd", 0) == 1
+                    segm_is_none.append(True)
+                    num_polys.append(0)
+                    continue
+                # also required to be float32
+                valid_segs = [np.asarray(p).reshape(-1, 2).astype('float32') for p in segs if len(p) >= 6]
+                i = img_index[k]
+                objid, file_name = k - first_obj[i], imgs[i]['file_name']
+                if len(valid_segs) == 0:
+                    logger.error("Object {} in image {} has no valid polygons!".format(objid, file_name))
+                elif len(valid_segs) < len(segs):
+                    logger.warn("Object {} in image {} has invalid polygons!".format(objid, file_name))
+                segm_is_none.append(False)
+                num_polys.append(len(valid_segs))
+                polys.extend(valid_segs)
+            arrays['segm_offsets'] = np.cumsum([0] + num_polys).astype(np.int64)
+            arrays['segm_is_none'] = np.asarray(segm_is_none, dtype='bool')
+            arrays['poly_offsets'] = np.cumsum([0] + [len(p) for p in polys]).astype(np.int64)
+            arrays['poly_points'] = np.concatenate(polys) if polys else np.zeros((0, 2), dtype='float32')
+        return arrays
 
     def training_roidbs(self):
-        return self.load(add_gt=True, add_mask=cfg.MODE_MASK)
+        return self.load(add_gt=True, add_mask=cfg.MODE_MASK, cache_dir=cfg.DATA.CACHE_DIR)
 
     def inference_roidbs(self):
-        return self.load(add_gt=False)
+        return self.load(add_gt=False, cache_dir=cfg.DATA.CACHE_DIR)
 
-    def eval_inference_results(self, results, output=None):
+    def _to_coco_results(self, results):
+        """
+        Convert the inference results in place to the format of COCO.
+        """
         continuous_id_to_COCO_id = {v: k for k, v in self.COCO_id_to_category_id.items()}
         for res in results:
             # convert to COCO's incontinuous category id
@@ -239,16 +287,101 @@ class COCODetection(DatasetSplit):
             boxes_house[2] -= boxes_house[0]
             boxes_house[3] -= boxes_house[1]
             res['boxes_house'] = [round(float(x), 3) for x in boxes_house]
-            # print("res = ", res)
 
+    def _to_coco_columns(self, results):
+        """
+        Convert :class:`DetectionResults` to the columns of the dts used by COCOeval,
+        with the same values as `_to_coco_results`.
+        """
+        continuous_id_to_COCO_id = {v: k for k, v in self.COCO_id_to_category_id.items()}
+        cols = {
+            'num': len(results),
+            'image_id': results['image_id'],
+            'category_id': np.asarray([continuous_id_to_COCO_id.get(c, c) for c in results['category_id'].tolist()]),
+            'score': results['score'],
+        }
+        for key in ['bbox', 'boxes_house']:
+            # COCO expects results in xywh format
+            box = results[key].copy()
+            box[:, 2:] -= box[:, :2]
+            cols[key] = np.asarray([round(x, 3) for x in box.ravel().tolist()],
+                                   dtype=np.float64).reshape((-1, 4))
+        if results.has_mask:
+            cols['segmentation/counts'] = results['mask_counts']
+            cols['segmentation/offsets'] = results['mask_offsets']
+            cols['segmentation/size'] = results['mask_size']
+        return cols
+
+    def eval_inference_results(self, results, output=None, num_workers=1):
+        if not isinstance(results, DetectionResults):
+            results = DetectionResults.from_json(results)
         if output is not None:
-            with open(output, 'w') as f:
-                json.dump(results, f)
+            if output.endswith('.npz'):
+                results.save(output)
+            else:
+                json_results = results.to_json()
+                self._to_coco_results(json_results)
+                with open(output, 'w') as f:
+                    json.dump(json_results, f)
         if len(results):
             # sometimes may crash if the results are empty?
-            return self.print_coco_metrics(results)
+            return self.print_coco_metrics(self._to_coco_columns(results), num_workers=num_workers)
+        else:
+            return {}
+
+    def inference_evaluator(self):
+        return COCOStreamingEvaluator(self)
+
+
+class COCOStreamingEvaluator(object):
+    """
+    Evaluates the inference results of a :class:`COCODetection` image by image, see
+    `DatasetSplit.inference_evaluator`. Only the matching of each image is kept, not the results.
+    """
+    def __init__(self, dataset, fast_match=True):
+        """
+        Args:
+            dataset (COCODetection): the split which the results belong to
+            fast_match(bool): see :meth:`COCODetection.print_coco_metrics`
+        """
+        self._dataset = dataset
+        self._fast_match = fast_match
+        self._cocoEval = None   # created with the first results, which tell whether there are masks
+        self._targets = None
+
+    def add(self, img_id, results):
+        """
+        Args:
+            img_id: the id of the image
+            results (DetectionResults or list[dict]): all inference results of this image, in the format
+                used by `DatasetSplit.eval_inference_results`. A list will be modified.
+        """
+        if not len(results):
+            # images without results are evaluated in `evaluate`
+            return
+        if isinstance(results, DetectionResults):
+            has_mask = results.has_mask
+            results = self._dataset._to_coco_columns(results)
         else:
+            has_mask = "segmentation" in results[0]
+            self._dataset._to_coco_results(results)
+        if self._cocoEval is None:
+            from pycocotools.cocoeval import StreamingCOCOeval
+            self._targets = _metric_targets(has_mask)
+            self._cocoEval = StreamingCOCOeval(self._dataset.coco, [t for _, t in self._targets])
+            self._cocoEval.params.fastMatch = int(self._fast_match)
+        self._cocoEval.addImage(img_id, results)
+
+    def evaluate(self):
+        """
+        Returns:
+            dict: the evaluation metrics of all the added results, same as
+            `DatasetSplit.eval_inference_results`
+        """
+        if self._cocoEval is None:
             return {}
+        self._cocoEval.evaluate()
+        return _summarize_metrics(self._cocoEval, self._targets)
 
 
 def register_coco(basedir):
@@ -18,6 +18,8 @@ class DatasetSplit():
             roidbs (list[dict]):
 
         Produce "roidbs" as a list of dict, each dict corresponds to one image with k>=0 instances.
+        Any sequence of dict works, e.g. a :class:`RoidbArrays`, which the training dataflow
+        shares with its workers instead of sending them the dicts.
         and the following keys are expected for training:
 
         file_name: str, full path to the image
@@ -50,10 +52,11 @@ class DatasetSplit():
         """
         raise NotImplementedError()
 
-    def eval_inference_results(self, results, output=None):
+    def eval_inference_results(self, results, output=None, num_workers=1):
         """
         Args:
-            results (list[dict]): the inference results as dicts.
+            results (DetectionResults or list[dict]): the inference results, either as
+                :class:`DetectionResults` or as dicts.
                 Each dict corresponds to one __instance__. It contains the following keys:
 
                 image_id (str): the id that matches `inference_roidbs`.
@@ -62,12 +65,26 @@ class DatasetSplit():
                 score (float):
                 segmentation: the segmentation mask in COCO's rle format.
             output (str): the output file or directory to optionally save the results to.
+                A file ending with ".npz" is written by `DetectionResults.save`.
+            num_workers (int): the number of processes to evaluate with.
 
         Returns:
             dict: the evaluation results.
         """
         raise NotImplementedError()
 
+    def inference_evaluator(self):
+        """
+        Returns:
+            an evaluator to feed the inference results to image by image, as they are produced,
+            instead of calling `eval_inference_results` with all of them. It has two methods:
+
+            add(img_id, results): add the results (DetectionResults or list[dict], in the format
+                used by `eval_inference_results`) of one image.
+            evaluate(): returns the same dict as `eval_inference_results` for all the added results.
+        """
+        raise NotImplementedError()
+
 
 class DatasetRegistry():
     _registry = {}
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+__all__ = ['DetectionResults']
+
+
+class DetectionResults(object):
+    """
+    Inference results of many images, stored as numpy arrays with one row per detection,
+    instead of one dict per detection.
+
+    The arrays are:
+
+    image_id (N,): the id of the image of each detection
+    category_id (N,) int32: in the range of [1, #category]
+    bbox (N, 4) float64: x1, y1, x2, y2 of the damage box
+    score (N,) float64:
+    boxes_house (N, 4) float64: x1, y1, x2, y2 of the house box
+    scores_house (N,) float64:
+    mask_counts (uint8), mask_offsets (N + 1,) int64, mask_size (N, 2) int32:
+        only if there are masks. The compressed RLE counts of all masks, concatenated,
+        where the counts of detection i are mask_counts[mask_offsets[i]:mask_offsets[i + 1]].
+
+    The values are rounded as in the json results, so both give the same evaluation.
+    """
+
+    _MASK_KEYS = ['mask_counts', 'mask_offsets', 'mask_size']
+
+    def __init__(self, arrays):
+        """
+        Args:
+            arrays (dict): the arrays described above
+        """
+        self._arrays = arrays
+
+    def __len__(self):
+        return len(self._arrays['score'])
+
+    def __getitem__(self, key):
+        return self._arrays[key]
+
+    @property
+    def has_mask(self):
+        return 'mask_counts' in self._arrays
+
+    def mask(self, i):
+        """
+        Returns:
+            dict: the mask of detection i in COCO's compressed RLE format
+        """
+        offsets = self._arrays['mask_offsets']
+        return {'size': self._arrays['mask_size'][i].tolist(),
+                'counts': self._arrays['mask_counts'][offsets[i]:offsets[i + 1]].tobytes()}
+
+    @staticmethod
+    def from_detections(results, img_id):
+        """
+        Args:
+            results: [DetectionResult] of one image
+            img_id: the id of the image
+
+        Returns:
+            DetectionResults
+        """
+        def rounded(values, ndigits=4):
+            return np.asarray([round(float(x), ndigits) for x in values], dtype=np.float64)
+
+        n = len(results)
+        arrays = {
+            'image_id': np.asarray([img_id] * n),
+            'category_id': np.asarray([r.class_id for r in results], dtype=np.int32),
+            'bbox': rounded([x for r in results for x in r.box]).reshape((n, 4)),
+            'score': rounded([r.score for r in results]),
+            'boxes_house': rounded([x for r in results for x in r.boxes_house]).reshape((n, 4)),
+            'scores_house': rounded([r.scores_house for r in results]),
+        }
+        if n and results[0].mask is not None:
+            arrays.update(_encode_masks([r.mask for r in results]))
+        return DetectionResults(arrays)
+
+    @staticmethod
+    def from_json(results):
+        """
+        Args:
+            results (list[dict]): in the format used by `DatasetSplit.eval_inference_results`
+
+        Returns:
+            DetectionResults
+        """
+        n = len(results)
+        arrays = {
+            'image_id': np.asarray([r['image_id'] for r in results]),
+            'category_id': np.asarray([r['category_id'] for r in results], dtype=np.int32),
+            'bbox': np.asarray([r['bbox'] for r in results], dtype=np.float64).reshape((n, 4)),
+            'score': np.asarray([r['score'] for r in results], dtype=np.float64),
+            'boxes_house': np.asarray([r['boxes_house'] for r in results], dtype=np.float64).reshape((n, 4)),
+            'scores_house': np.asarray([r['scores_house'] for r in results], dtype=np.float64),
+        }
+        if n and 'segmentation' in results[0]:
+            arrays.update(_encode_masks([r['segmentation'] for r in results]))
+        return DetectionResults(arrays)
+
+    def to_json(self):
+        """
+        Returns:
+            list of dict, in the format used by `DatasetSplit.eval_inference_results`
+        """
+        a = self._arrays
+        ret = []
+        for i, (img_id, cat, box, score, box_house, score_house) in enumerate(zip(
+                a['image_id'].tolist(), a['category_id'].tolist(), a['bbox'].tolist(),
+                a['score'].tolist(), a['boxes_house'].tolist(), a['scores_house'].tolist())):
+            res = {
+                'image_id': img_id,
+                'category_id': cat,
+                'bbox': box,
+                'score': score,
+                'boxes_house': box_house,
+                'scores_house': score_house
+            }
+            if self.has_mask:
+                mask = self.mask(i)
+                res['segmentation'] = {'size': mask['size'], 'counts': mask['counts'].decode('ascii')}
+            ret.append(res)
+        return ret
+
+    @staticmethod
+    def concatenate(results_list):
+        """
+        Args:
+            results_list (list[DetectionResults]): they all have masks, or none of them
+
+        Returns:
+            DetectionResults: all the results
+        """
+        results_list = [r for r in results_list if len(r)]
+        if not results_list:
+            return DetectionResults.from_json([])
+        has_mask = results_list[0].has_mask
+        assert all(r.has_mask == has_mask for r in results_list)
+        arrays = {k: np.concatenate([r[k] for r in results_list])
+                  for k in results_list[0]._arrays if k not in DetectionResults._MASK_KEYS}
+        if has_mask:
+            arrays['mask_counts'] = np.concatenate([r['mask_counts'] for r in results_list])
+            arrays['mask_size'] = np.concatenate([r['mask_size'] for r in results_list])
+            lengths = np.concatenate([np.diff(r['mask_offsets']) for r in results_list])
+            arrays['mask_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return DetectionResults(arrays)
+
+    def save(self, fname):
+        """
+        Save the arrays to an uncompressed npz file.
+        """
+        with open(fname, 'wb') as f:
+            np.savez(f, **self._arrays)
+
+    @staticmethod
+    def load(fname):
+        """
+        Load the results saved by :meth:`save`.
+        """
+        with np.load(fname) as f:
+            return DetectionResults({k: f[k] for k in f.files})
+
+
+def _encode_masks(masks):
+    """
+    Args:
+        masks: list of masks in COCO's compressed RLE format. The counts may be str or bytes.
+
+    Returns:
+        dict: the mask arrays of :class:`DetectionResults`
+    """
+    counts = [m['counts'] if isinstance(m['counts'], bytes) else m['counts'].encode('ascii') for m in masks]
+    return {
+        'mask_counts': np.frombuffer(b''.join(counts), dtype=np.uint8),
+        'mask_offsets': np.cumsum([0] + [len(c) for c in counts]).astype(np.int64),
+        'mask_size': np.asarray([m['size'] for m in masks], dtype=np.int32).reshape((-1, 2)),
+    }
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+The roidbs of a dataset split, stored as a struct of arrays instead of one dict per image,
+so that they can be saved as .npy files and memory-mapped back. The arrays are:
+
+image_id (N,): the id of each image
+file_name (uint8), file_name_offsets (N + 1,) int64: the utf-8 encoded file names of the images,
+    relative to the image directory, concatenated
+height, width (N,) int32:
+
+only with groundtruth:
+ann_offsets (N + 1,) int64: the instances of image i are the rows ann_offsets[i]:ann_offsets[i + 1]
+    of the following arrays
+boxes_house, boxes_damage (A, 4) float32: x1, y1, x2, y2
+class (A,) int32: in the range of [1, #categories]
+is_crowd (A,) int8:
+
+only with groundtruth masks:
+segm_offsets (A + 1,) int64: the polygons of instance a are segm_offsets[a]:segm_offsets[a + 1]
+segm_is_none (A,) bool: the instance has no polygons (a crowd instance in rle format)
+poly_offsets (P + 1,) int64: the points of polygon p are poly_points[poly_offsets[p]:poly_offsets[p + 1]]
+poly_points (X, 2) float32:
+"""
+
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+from collections.abc import Sequence
+
+from tensorpack.utils import logger
+
+__all__ = ['roidb_cache_key', 'save_roidb_arrays', 'load_roidb_arrays', 'RoidbArrays']
+
+# bump when the arrays below change
+ROIDB_CACHE_VERSION = 1
+
+
+def roidb_cache_key(annotation_file, **kwargs):
+    """
+    Args:
+        annotation_file (str): the file the roidbs are parsed from
+        kwargs: everything else the roidbs depend on. Has to be json-serializable.
+
+    Returns:
+        str: a hash of the content of the file, the arguments and the cache version
+    """
+    h = hashlib.sha1()
+    with open(annotation_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(json.dumps([ROIDB_CACHE_VERSION, kwargs], sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def save_roidb_arrays(arrays, path):
+    """
+    Save the arrays as one .npy file each in the directory `path`.
+    The directory is written elsewhere and then moved, so readers never see a partial cache.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        for k, v in arrays.items():
+            np.save(os.path.join(tmpdir, k + '.npy'), v)
+        with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+            json.dump({'version': ROIDB_CACHE_VERSION, 'arrays': sorted(arrays.keys())}, f)
+        os.rename(tmpdir, path)
+    except OSError:
+        # e.g. another process has written the same cache in the meantime
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+def load_roidb_arrays(path):
+    """
+    Returns:
+        dict: the arrays saved by :func:`save_roidb_arrays`, memory-mapped read-only,
+        or None if there is no valid cache in `path`.
+    """
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != ROIDB_CACHE_VERSION:
+        logger.warn("Ignore the roidb cache {} of version {}.".format(path, meta.get('version')))
+        return None
+    return {k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r') for k in meta['arrays']}
+
+
+class RoidbArrays(Sequence):
+    """
+    The roidbs in the arrays described in this module, as a read-only sequence of dict in the format
+    of `DatasetSplit.training_roidbs` and `inference_roidbs`. Each roidb is only built when accessed,
+    and the numpy arrays in it are views of the arrays.
+
+    If the arrays are memory-mapped from a cache, only its path is pickled. Processes which receive
+    the roidbs memory-map the same files, and share their memory, instead of getting a copy.
+    """
+    def __init__(self, arrays, imgdir, path=None):
+        """
+        Args:
+            arrays (dict): the arrays described in this module
+            imgdir (str): the directory the file names are relative to
+            path (str): the directory `arrays` are memory-mapped from, see :meth:`load`
+        """
+        # np.asarray drops the memmap subclass, the views still share the memory
+        self._arrays = {k: np.asarray(v) for k, v in arrays.items()}
+        self._imgdir = imgdir
+        self._path = path
+
+    @staticmethod
+    def load(path, imgdir):
+        """
+        Returns:
+            RoidbArrays: of the arrays saved in `path` by :func:`save_roidb_arrays`, memory-mapped.
+            None if there is no valid cache in `path`.
+        """
+        arrays = load_roidb_arrays(path)
+        return None if arrays is None else RoidbArrays(arrays, imgdir, path)
+
+    def __len__(self):
+        return len(self._arrays['image_id'])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        a = self._arrays
+        start, end = a['file_name_offsets'][i:i + 2].tolist()
+        roidb = {
+            'image_id': a['image_id'][i].item(),
+            'file_name': os.path.join(self._imgdir, a['file_name'][start:end].tobytes().decode('utf-8'))
+        }
+        if 'ann_offsets' not in a:
+            roidb['height'], roidb['width'] = a['height'][i].item(), a['width'][i].item()
+            return roidb
+        start, end = a['ann_offsets'][i:i + 2].tolist()
+        for k in ['boxes_house', 'boxes_damage', 'class', 'is_crowd']:
+            roidb[k] = a[k][start:end]
+        if 'segm_offsets' in a:
+            points = a['poly_points']
+            segm_offsets = a['segm_offsets'][start:end + 1].tolist()
+            segm_is_none = a['segm_is_none'][start:end].tolist()
+            segmentation = []
+            for k, is_none in enumerate(segm_is_none):
+                if is_none:
+                    segmentation.append(None)
+                    continue
+                offsets = a['poly_offsets'][segm_offsets[k]:segm_offsets[k + 1] + 1].tolist()
+                segmentation.append([points[offsets[p]:offsets[p + 1]] for p in range(len(offsets) - 1)])
+            roidb['segmentation'] = segmentation
+        return roidb
+
+    def __getstate__(self):
+        if self._path is None:
+            return self.__dict__
+        return {'_imgdir': self._imgdir, '_path': self._path}
+
+    def __setstate__(self, state):
+        if '_arrays' not in state:
+            arrays = load_roidb_arrays(state['_path'])
+            assert arrays is not None, "The roidb cache {} is gone!".format(state['_path'])
+            state['_arrays'] = {k: np.asarray(v) for k, v in arrays.items()}
+        self.__dict__.update(state)
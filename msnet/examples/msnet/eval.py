@@ -1,28 +1,32 @@
 # -*- coding: utf-8 -*-
 # File: eval.py
 
+import functools
 import itertools
-import json
+import multiprocessing
 import numpy as np
 import os
-import sys
+import queue
+import threading
+import time
 import tensorflow as tf
 from collections import namedtuple
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import ExitStack
 import cv2
 import pycocotools.mask as cocomask
 import tqdm
-from scipy import interpolate
 
 from tensorpack.callbacks import Callback
 from tensorpack.tfutils.common import get_tf_version_tuple
 from tensorpack.utils import logger, get_tqdm
+from tensorpack.utils.concurrency import StoppableThread
+from tensorpack.utils.stats import StatCounter
 
 from common import CustomResize, clip_boxes
 from config import config as cfg
 from data import get_eval_dataflow
-from dataset import DatasetRegistry
+from dataset import DatasetRegistry, DetectionResults
 
 try:
     import horovod.tensorflow as hvd
@@ -37,7 +41,8 @@ DetectionResult = namedtuple(
 box: 4 float
 score: float
 class_id: int, 1~NUM_CLASS
-mask: None, or a binary image of the original image shape
+mask: None, or the binary mask of the original image shape, in COCO's compressed RLE format.
+    Use `cocomask.decode` to get the binary image.
 """
 
 
@@ -58,35 +63,69 @@ def _scale_box(box, scale):
     return scaled_box
 
 
-def _paste_mask(box, mask, shape):
+def _bilinear_weights(coords, size):
     """
+    Args:
+        coords: n floats, continuous coordinates in a 1D grid where pixel i is centered at i + 0.5
+        size (int): number of pixels in the grid
+
+    Returns:
+        n x size weights of the linear interpolation at `coords`.
+        Rows of coordinates outside [0.5, size - 0.5] are all zeros, i.e. filled with 0.
+    """
+    t = coords - 0.5
+    outside = (t < 0) | (t > size - 1)
+    t = np.clip(t, 0, size - 1)
+    k0 = np.floor(t).astype('int64')
+    frac = t - k0
+    rows = np.arange(len(coords))
+    weights = np.zeros((len(coords), size), dtype='float64')
+    weights[rows, k0] += 1 - frac
+    weights[rows, np.minimum(k0 + 1, size - 1)] += frac
+    weights[outside] = 0
+    return weights
+
+
+def _paste_mask_window(box, mask, shape):
+    """
+    Paste a mask into the window of the image covered by its box.
+
     Args:
         box: 4 float
         mask: MxM floats
         shape: h,w
+
     Returns:
-        A uint8 binary image of hxw.
+        y0, x0 (int): the top-left corner of the window in the image
+        A uint8 binary image of the window. Pixels outside the window are all zeros.
     """
-    # print("mask_shape = ", mask.shape)
-    # if mask.shape[0] != mask.shape[1]:
-    #     print("incorrect mask shape = ", mask.shape)
     assert mask.shape[0] == mask.shape[1], mask.shape
+    h, w = shape
 
     if cfg.MRCNN.ACCURATE_PASTE:
-        # This method is accurate but much slower.
+        # This method is accurate but slower.
+        # Bilinear interpolation of the zero-padded mask, evaluated at the centers of the
+        # image pixels. Only the pixels that fall inside the padded mask can be non-zero,
+        # so the interpolation is restricted to that window.
         mask = np.pad(mask, [(1, 1), (1, 1)], mode='constant')
-        box = _scale_box(box, float(mask.shape[0]) / (mask.shape[0] - 2))
-
-        mask_pixels = np.arange(0.0, mask.shape[0]) + 0.5
-        mask_continuous = interpolate.interp2d(mask_pixels, mask_pixels, mask, fill_value=0.0)
-        h, w = shape
-        ys = np.arange(0.0, h) + 0.5
-        xs = np.arange(0.0, w) + 0.5
-        ys = (ys - box[1]) / (box[3] - box[1]) * mask.shape[0]
-        xs = (xs - box[0]) / (box[2] - box[0]) * mask.shape[1]
-        # Waste a lot of compute since most indices are out-of-border
-        res = mask_continuous(xs, ys)
-        return (res >= 0.5).astype('uint8')
+        size = mask.shape[0]
+        box = _scale_box(box, float(size) / (size - 2))
+        box_w, box_h = box[2] - box[0], box[3] - box[1]
+        if box_w <= 0 or box_h <= 0:
+            return 0, 0, np.zeros((0, 0), dtype='uint8')
+
+        # pixel x can be non-zero when (x + 0.5 - box[0]) / box_w * size is in [0.5, size - 0.5]
+        x0 = max(int(np.floor(box[0] + 0.5 * box_w / size - 0.5)), 0)
+        x1 = min(int(np.ceil(box[0] + (size - 0.5) * box_w / size - 0.5)) + 1, w)
+        y0 = max(int(np.floor(box[1] + 0.5 * box_h / size - 0.5)), 0)
+        y1 = min(int(np.ceil(box[1] + (size - 0.5) * box_h / size - 0.5)) + 1, h)
+        if x1 <= x0 or y1 <= y0:
+            return 0, 0, np.zeros((0, 0), dtype='uint8')
+
+        xs = (np.arange(x0, x1) + 0.5 - box[0]) / box_w * size
+        ys = (np.arange(y0, y1) + 0.5 - box[1]) / box_h * size
+        res = _bilinear_weights(ys, size).dot(mask).dot(_bilinear_weights(xs, size).T)
+        return y0, x0, (res >= 0.5).astype('uint8')
     else:
         # This method (inspired by Detectron) is less accurate but fast.
 
@@ -98,35 +137,104 @@ def _paste_mask(box, mask, shape):
         x1 = max(x0, x1)    # require at least 1x1
         y1 = max(y0, y1)
 
-        w = x1 + 1 - x0
-        h = y1 + 1 - y0
-
         # rounding errors could happen here, because masks were not originally computed for this shape.
         # but it's hard to do better, because the network does not know the "original" scale
-        mask = (cv2.resize(mask, (w, h)) > 0.5).astype('uint8')
-        ret = np.zeros(shape, dtype='uint8')
-        ret[y0:y1 + 1, x0:x1 + 1] = mask
-        return ret
+        mask = (cv2.resize(mask, (x1 + 1 - x0, y1 + 1 - y0)) > 0.5).astype('uint8')
+        return y0, x0, mask[:max(h - y0, 0), :max(w - x0, 0)]
 
 
-def predict_image(img, model_func):
+def _window_to_rle(y0, x0, window, shape):
     """
-    Run detection on one image, using the TF callable.
-    This function should handle the preprocessing internally.
+    Encode a binary window of an image to COCO's compressed RLE,
+    without materializing the full image.
 
     Args:
-        img: an image
-        model_func: a callable from the TF model.
-            It takes image and returns (boxes, probs, labels, [masks])
+        y0, x0, window: see :func:`_paste_mask_window`
+        shape: h,w
 
     Returns:
-        [DetectionResult]
+        dict: the RLE, the same as `cocomask.encode` on the full (Fortran-order) mask.
+    """
+    h, w = shape
+    # pixels in column-major order, with a zero row above and below each column of the window
+    padded = np.pad(window.T, [(0, 0), (1, 1)], mode='constant').ravel()
+    changes = np.nonzero(np.diff(padded))[0]    # the pixel before each change, in the padded window
+    cols, rows = np.divmod(changes, window.shape[0] + 2)
+    # index of the pixel after each change, in the flattened full image
+    changes = (x0 + cols) * h + (y0 + rows)
+    starts, ends = changes[0::2], changes[1::2]
+    # runs that cross a column border are split by the padding, merge them back
+    joined = starts[1:] == ends[:-1]
+    starts = np.concatenate([starts[:1], starts[1:][~joined]])
+    ends = np.concatenate([ends[:-1][~joined], ends[-1:]])
+
+    counts = np.stack([starts - np.concatenate([[0], ends[:-1]]), ends - starts], axis=1).ravel().tolist()
+    counts.append(h * w - (ends[-1] if len(ends) else 0))
+    if counts[-1] == 0 and len(counts) > 1:
+        counts.pop()
+    return cocomask.frPyObjects({'size': [h, w], 'counts': counts}, h, w)
+
+
+def paste_masks(boxes, masks, shape, rle=False):
+    """
+    Paste the masks of all detections in an image.
+
+    Args:
+        boxes: nx4 floats
+        masks: nxMxM floats
+        shape: h,w
+        rle (bool): whether to return the masks as COCO's compressed RLE,
+            encoded directly from each box's window instead of from a full image.
+
+    Returns:
+        [np.ndarray]: n uint8 binary images of hxw, or [dict]: n RLEs if `rle`.
+    """
+    ret = []
+    for box, mask in zip(boxes, masks):
+        y0, x0, window = _paste_mask_window(box, mask, shape)
+        if rle:
+            ret.append(_window_to_rle(y0, x0, window, shape))
+        else:
+            full_mask = np.zeros(shape, dtype='uint8')
+            full_mask[y0:y0 + window.shape[0], x0:x0 + window.shape[1]] = window
+            ret.append(full_mask)
+    return ret
+
+
+def _paste_mask(box, mask, shape):
+    """
+    Args:
+        box: 4 float
+        mask: MxM floats
+        shape: h,w
+    Returns:
+        A uint8 binary image of hxw.
+    """
+    return paste_masks([box], [mask], shape)[0]
+
+
+def _preprocess_image(img):
+    """
+    Returns:
+        the image resized for the model, and its scale w.r.t. the original image
     """
-    orig_shape = img.shape[:2]
     resizer = CustomResize(cfg.PREPROC.TEST_SHORT_EDGE_SIZE, cfg.PREPROC.MAX_SIZE)
     resized_img = resizer.augment(img)
     scale = np.sqrt(resized_img.shape[0] * 1.0 / img.shape[0] * resized_img.shape[1] / img.shape[1])
-    boxes_house, scores_house, boxes, probs, labels, *masks = model_func(resized_img)
+    return resized_img, scale
+
+
+def _postprocess_outputs(outputs, orig_shape, scale):
+    """
+    Args:
+        outputs: what the TF callable returns on the resized image
+        orig_shape: (h, w) of the original image
+        scale: the scale returned by :func:`_preprocess_image`
+
+    Returns:
+        [DetectionResult]
+    """
+    boxes_house, scores_house, boxes, probs, labels, *masks = outputs
 
     # Some slow numpy postprocessing:
     boxes = boxes / scale
@@ -137,9 +245,7 @@ def predict_image(img, model_func):
 
     # if masks and masks[0]:
     if masks:
-        full_masks = [_paste_mask(box, mask, orig_shape)
-                      for box, mask in zip(boxes, masks[0])]
-        masks = full_masks
+        masks = paste_masks(boxes, masks[0], orig_shape, rle=True)
     else:
         # fill with none
         masks = [None] * len(boxes)
@@ -148,7 +254,308 @@ def predict_image(img, model_func):
     return results
 
 
-def predict_dataflow(df, model_func, tqdm_bar=None):
+def predict_image(img, model_func):
+    """
+    Run detection on one image, using the TF callable.
+    This function should handle the preprocessing internally.
+
+    Args:
+        img: an image
+        model_func: a callable from the TF model.
+            It takes image and returns (boxes, probs, labels, [masks])
+
+    Returns:
+        [DetectionResult]
+    """
+    resized_img, scale = _preprocess_image(img)
+    return _postprocess_outputs(model_func(resized_img), img.shape[:2], scale)
+
+
+def _run_batch(model_func, resized_imgs, batch_size):
+    """
+    Call `model_func` once on the images, filling the batch with blank images if needed.
+
+    Returns:
+        the outputs of `model_func` for each of `resized_imgs`
+    """
+    num_imgs = len(resized_imgs)
+    assert 0 < num_imgs <= batch_size, num_imgs
+    if num_imgs < batch_size:
+        blank = np.zeros((cfg.FPN.RESOLUTION_REQUIREMENT, cfg.FPN.RESOLUTION_REQUIREMENT, 3), dtype=resized_imgs[0].dtype)
+        resized_imgs = list(resized_imgs) + [blank] * (batch_size - num_imgs)
+    outputs = model_func(*resized_imgs)
+    num_outputs = len(outputs) // batch_size
+    return [outputs[k * num_outputs: (k + 1) * num_outputs] for k in range(num_imgs)]
+
+
+def predict_images(imgs, model_func, batch_size=None):
+    """
+    Run detection on several images with one call of the TF callable.
+
+    Args:
+        imgs: a list of images
+        model_func: a callable from the TF model built with `inference_batch_size=batch_size`.
+            It takes `batch_size` images and returns the outputs of all images, concatenated.
+        batch_size (int): number of images `model_func` takes, defaults to `len(imgs)`.
+            If `imgs` has fewer images, the batch is filled with blank images.
+
+    Returns:
+        [[DetectionResult]], for each image
+    """
+    if batch_size is None:
+        batch_size = len(imgs)
+    resized = [_preprocess_image(img) for img in imgs]
+    outputs = _run_batch(model_func, [k[0] for k in resized], batch_size)
+    return [_postprocess_outputs(out, img.shape[:2], scale)
+            for out, img, (_, scale) in zip(outputs, imgs, resized)]
+
+
+class _StreamThread(StoppableThread):
+    """
+    Runs `func(thread)` and then puts None to `outq`, if given.
+    Exceptions from `func` are sent to `outq` as failed futures.
+    """
+
+    def __init__(self, func, outq, evt):
+        super(_StreamThread, self).__init__(evt)
+        self._func = func
+        self._outq = outq
+        self.daemon = True
+
+    def run(self):
+        try:
+            self._func(self)
+        except Exception as e:
+            if self._outq is None:
+                raise
+            fut = Future()
+            fut.set_exception(e)
+            self.queue_put_stoppable(self._outq, fut)
+        finally:
+            if self._outq is not None:
+                self.queue_put_stoppable(self._outq, None)
+
+
+def _postprocess_job(outputs, orig_shape, scale, img_id, convert):
+    """
+    The postprocessing of one image in :func:`predict_stream`, which may run in another process.
+
+    Returns:
+        [DetectionResult] of the image or what `convert` returns for them, and the seconds it took
+    """
+    start = time.perf_counter()
+    results = _postprocess_outputs(outputs, orig_shape, scale)
+    if convert is not None:
+        results = convert(results, img_id)
+    return results, time.perf_counter() - start
+
+
+def _init_postprocess_worker(config_dict):
+    cfg.from_dict(config_dict)
+    cfg.freeze()
+
+
+def create_postprocess_pool(num_proc=None):
+    """
+    Create a pool of processes to postprocess detections in, for :func:`predict_stream`.
+    The processes are spawned, and use the config of the current process.
+
+    Args:
+        num_proc (int): number of processes. Defaults to half of the CPUs, at most 8.
+
+    Returns:
+        a :class:`ProcessPoolExecutor`
+    """
+    if num_proc is None:
+        num_proc = min(8, max(1, multiprocessing.cpu_count() // 2))
+    return ProcessPoolExecutor(
+        max_workers=num_proc, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_postprocess_worker, initargs=(cfg.to_dict(),))
+
+
+def predict_stream(inputs, model_funcs, batch_size=1, num_workers=4, queue_size=16,
+                   timers=None, postprocess_pool=None, convert=None):
+    """
+    Run detection on a stream of images, with reading, preprocessing, inference
+    and postprocessing of different images overlapped.
+
+    `inputs` is iterated in a background thread and the images are preprocessed in a pool
+    of `num_workers` threads. Each of `model_funcs` runs in its own thread on batches of
+    preprocessed images, and the outputs are postprocessed in `postprocess_pool`.
+    At most `queue_size` images wait for inference or to be yielded.
+
+    Args:
+        inputs: an iterable of (image, key)
+        model_funcs: a callable from the TF model, same as in :func:`predict_images`,
+            or a list of them (e.g. one for each GPU) to run in parallel
+        batch_size (int): number of images each of `model_funcs` takes
+        num_workers (int): number of threads to preprocess images
+        queue_size (int): size of the queues between stages
+        timers (dict): if not None, the seconds each image spends in the stages
+            'read', 'preprocess', 'inference' and 'postprocess' are fed to the
+            :class:`StatCounter` of that name in this dict. Missing ones are created.
+            'inference' is timed once per batch.
+        postprocess_pool: a :class:`concurrent.futures.Executor` to postprocess the outputs in,
+            e.g. from :func:`create_postprocess_pool`. Defaults to the preprocessing threads.
+        convert: a function `convert(results, key)` to apply to the [DetectionResult] of each image
+            as part of its postprocessing, e.g. :func:`results_to_json` or
+            `DetectionResults.from_detections`. It has to be picklable for a process pool.
+
+    Yields:
+        (key, [DetectionResult] or what `convert` returns), in the same order as `inputs`
+    """
+    if callable(model_funcs):
+        model_funcs = [model_funcs]
+    if timers is None:
+        timers = {}
+    for stage in ['read', 'preprocess', 'inference', 'postprocess']:
+        timers.setdefault(stage, StatCounter())
+
+    def preprocess(img, key):
+        start = time.perf_counter()
+        resized_img, scale = _preprocess_image(img)
+        timers['preprocess'].feed(time.perf_counter() - start)
+        return key, img.shape[:2], resized_img, scale
+
+    def read(thread):
+        inputs_iter = iter(inputs)
+        while not thread.stopped():
+            start = time.perf_counter()
+            try:
+                img, key = next(inputs_iter)
+            except StopIteration:
+                break
+            timers['read'].feed(time.perf_counter() - start)
+            # the output queue holds a future for each image, so that the order of images is kept
+            result = Future()
+            thread.queue_put_stoppable(output_q, result)
+            thread.queue_put_stoppable(preprocess_q, (preprocess_pool.submit(preprocess, img, key), result))
+        for _ in model_funcs:
+            thread.queue_put_stoppable(preprocess_q, None)
+
+    def set_result(result, key, fut):
+        try:
+            ret, seconds = fut.result()
+        except Exception as e:
+            result.set_exception(e)
+        else:
+            timers['postprocess'].feed(seconds)
+            result.set_result((key, ret))
+
+    def infer(thread, model_func):
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < batch_size:
+                item = thread.queue_get_stoppable(preprocess_q)
+                if item is None:
+                    finished = True
+                    break
+                batch.append(item)
+            if not batch:
+                return
+            try:
+                keys, orig_shapes, resized_imgs, scales = zip(*[fut.result() for fut, _ in batch])
+                start = time.perf_counter()
+                outputs = _run_batch(model_func, resized_imgs, batch_size)
+                timers['inference'].feed(time.perf_counter() - start)
+                for key, out, orig_shape, scale, (_, result) in zip(keys, outputs, orig_shapes, scales, batch):
+                    fut = postprocess_pool.submit(_postprocess_job, out, orig_shape, scale, key, convert)
+                    fut.add_done_callback(functools.partial(set_result, result, key))
+            except Exception as e:
+                for _, result in batch:
+                    if not result.done():
+                        result.set_exception(e)
+
+    preprocess_q = queue.Queue(maxsize=queue_size)
+    output_q = queue.Queue(maxsize=queue_size)
+    stop_evt = threading.Event()
+    preprocess_pool = ThreadPoolExecutor(max_workers=num_workers)
+    if postprocess_pool is None:
+        postprocess_pool = preprocess_pool
+    threads = [_StreamThread(read, output_q, stop_evt)]
+    threads.extend([_StreamThread(functools.partial(infer, model_func=f), None, stop_evt) for f in model_funcs])
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            fut = output_q.get()
+            if fut is None:
+                return
+            yield fut.result()
+    finally:
+        stop_evt.set()
+        preprocess_pool.shutdown(wait=False)
+
+
+def _read_dataflows(dataflows, queue_size=16):
+    """
+    Iterate over the dataflows in parallel threads.
+
+    Yields:
+        the datapoints of all dataflows, in the order they are produced
+    """
+    dp_q = queue.Queue(maxsize=queue_size)
+    stop_evt = threading.Event()
+
+    def read(df, thread):
+        for dp in df:
+            thread.queue_put_stoppable(dp_q, dp)
+            if thread.stopped():
+                return
+
+    for df in dataflows:
+        df.reset_state()
+    threads = [_StreamThread(functools.partial(read, df), dp_q, stop_evt) for df in dataflows]
+    for t in threads:
+        t.start()
+    try:
+        num_finished = 0
+        while num_finished < len(threads):
+            dp = dp_q.get()
+            if dp is None:
+                num_finished += 1
+            elif isinstance(dp, Future):
+                dp.result()     # raise the exception
+            else:
+                yield dp
+    finally:
+        stop_evt.set()
+
+
+def results_to_json(results, img_id):
+    """
+    Args:
+        results: [DetectionResult] of one image
+        img_id: the id of the image
+
+    Returns:
+        list of dict, in the format used by
+        `DatasetSplit.eval_inference_results`
+    """
+    ret = []
+    for r in results:
+        # int()/float() to make it json-serializable
+        res = {
+            'image_id': img_id,
+            'category_id': int(r.class_id),
+            'bbox': [round(float(x), 4) for x in r.box],
+            'score': round(float(r.score), 4),
+            # 'boxes_house':round(float(r.boxes_house), 4),
+            'boxes_house': [round(float(x), 4) for x in r.boxes_house],
+            'scores_house':round(float(r.scores_house), 4)
+        }
+
+        # also append segmentation to results
+        if r.mask is not None:
+            res['segmentation'] = {
+                'size': r.mask['size'],
+                'counts': r.mask['counts'].decode('ascii')}
+        ret.append(res)
+    return ret
+
+
+def predict_dataflow(df, model_func, tqdm_bar=None, batch_size=1, evaluator=None):
     """
     Args:
         df: a DataFlow which produces (image, image_id)
@@ -156,10 +563,13 @@ def predict_dataflow(df, model_func, tqdm_bar=None):
             It takes image and returns (boxes, probs, labels, [masks])
         tqdm_bar: a tqdm object to be shared among multiple evaluation instances. If None,
             will create a new one.
+        batch_size (int): number of images `model_func` takes, see :func:`predict_images`.
+        evaluator: an evaluator from `DatasetSplit.inference_evaluator`.
+            If given, the results of each image are added to it instead of being returned.
 
     Returns:
-        list of dict, in the format used by
-        `DatasetSplit.eval_inference_results`
+        DetectionResults: of all images, to be used by
+        `DatasetSplit.eval_inference_results`. Empty if `evaluator` is given.
     """
     df.reset_state()
     all_results = []
@@ -167,55 +577,65 @@ def predict_dataflow(df, model_func, tqdm_bar=None):
         # tqdm is not quite thread-safe: https://github.com/tqdm/tqdm/issues/323
         if tqdm_bar is None:
             tqdm_bar = stack.enter_context(get_tqdm(total=df.size()))
-        for img, img_id in df:
-            results = predict_image(img, model_func)
-            for r in results:
-                # int()/float() to make it json-serializable
-                res = {
-                    'image_id': img_id,
-                    'category_id': int(r.class_id),
-                    'bbox': [round(float(x), 4) for x in r.box],
-                    'score': round(float(r.score), 4),
-                    # 'boxes_house':round(float(r.boxes_house), 4),
-                    'boxes_house': [round(float(x), 4) for x in r.boxes_house],
-                    'scores_house':round(float(r.scores_house), 4)
-                }
-
-                # also append segmentation to results
-                if r.mask is not None:
-                    rle = cocomask.encode(
-                        np.array(r.mask[:, :, None], order='F'))[0]
-                    rle['counts'] = rle['counts'].decode('ascii')
-                    res['segmentation'] = rle
-                all_results.append(res)
-            tqdm_bar.update(1)
-    return all_results
-
-
-def multithread_predict_dataflow(dataflows, model_funcs):
-    """
-    Running multiple `predict_dataflow` in multiple threads, and aggregate the results.
+        df_iter = iter(df)
+        while True:
+            batch = list(itertools.islice(df_iter, batch_size))
+            if not batch:
+                break
+            imgs, img_ids = zip(*batch)
+            for results, img_id in zip(predict_images(imgs, model_func, batch_size), img_ids):
+                results = DetectionResults.from_detections(results, img_id)
+                if evaluator is not None:
+                    evaluator.add(img_id, results)
+                else:
+                    all_results.append(results)
+            tqdm_bar.update(len(batch))
+    return DetectionResults.concatenate(all_results)
+
+
+def multithread_predict_dataflow(dataflows, model_funcs, batch_size=1, postprocess_pool=None, timers=None,
+                                 evaluator=None):
+    """
+    Run detection on multiple dataflows with multiple predictors, and aggregate the results.
+
+    The dataflows are read in parallel threads, and their images go through :func:`predict_stream`,
+    where all predictors run in parallel and the results are postprocessed in `postprocess_pool`.
 
     Args:
-        dataflows: a list of DataFlow to be used in :func:`predict_dataflow`
-        model_funcs: a list of callable to be used in :func:`predict_dataflow`
+        dataflows: a list of DataFlow which produces (image, image_id)
+        model_funcs: a list of callable from the TF model, same as in :func:`predict_images`
+        batch_size (int): number of images each of `model_funcs` takes
+        postprocess_pool: a :class:`concurrent.futures.Executor` to postprocess the outputs in.
+            If None, a pool from :func:`create_postprocess_pool` is used for this call.
+        timers (dict): to collect the time spent in each stage, see :func:`predict_stream`
+        evaluator: an evaluator from `DatasetSplit.inference_evaluator`.
+            If given, the results of each image are added to it instead of being returned.
 
     Returns:
-        list of dict, in the format used by
-        `DatasetSplit.eval_inference_results`
+        DetectionResults: of all images, to be used by
+        `DatasetSplit.eval_inference_results`. Empty if `evaluator` is given.
     """
-    num_worker = len(model_funcs)
-    assert len(dataflows) == num_worker
-    if num_worker == 1:
-        return predict_dataflow(dataflows[0], model_funcs[0])
-    kwargs = {'thread_name_prefix': 'EvalWorker'} if sys.version_info.minor >= 6 else {}
-    with ThreadPoolExecutor(max_workers=num_worker, **kwargs) as executor, \
-            tqdm.tqdm(total=sum([df.size() for df in dataflows])) as pbar:
-        futures = []
-        for dataflow, pred in zip(dataflows, model_funcs):
-            futures.append(executor.submit(predict_dataflow, dataflow, pred, pbar))
-        all_results = list(itertools.chain(*[fut.result() for fut in futures]))
-        return all_results
+    own_pool = postprocess_pool is None
+    if own_pool:
+        postprocess_pool = create_postprocess_pool()
+    # enough images in flight to keep all predictors busy
+    queue_size = max(16, 2 * batch_size * len(model_funcs))
+    all_results = []
+    try:
+        with tqdm.tqdm(total=sum([df.size() for df in dataflows])) as pbar:
+            for img_id, results in predict_stream(
+                    _read_dataflows(dataflows, queue_size), model_funcs, batch_size,
+                    queue_size=queue_size, timers=timers, postprocess_pool=postprocess_pool,
+                    convert=DetectionResults.from_detections):
+                if evaluator is not None:
+                    evaluator.add(img_id, results)
+                else:
+                    all_results.append(results)
+                pbar.update(1)
+    finally:
+        if own_pool:
+            postprocess_pool.shutdown()
+    return DetectionResults.concatenate(all_results)
 
 
 class EvalCallback(Callback):
@@ -230,6 +650,7 @@ class EvalCallback(Callback):
         self._eval_dataset = eval_dataset
         self._in_names, self._out_names = in_names, out_names
         self._output_dir = output_dir
+        self._postprocess_pool = None
 
     def _setup_graph(self):
         num_gpu = cfg.TRAIN.NUM_GPUS
@@ -268,33 +689,55 @@ class EvalCallback(Callback):
         self.epochs_to_eval.add(self.trainer.max_epoch)
         logger.info("[EvalCallback] Will evaluate every {} epochs".format(eval_period))
 
+    def _after_train(self):
+        if self._postprocess_pool is not None:
+            self._postprocess_pool.shutdown()
+
     def _eval(self):
         logdir = self._output_dir
+        if self._postprocess_pool is None:
+            # the postprocessing processes are kept for all evaluations
+            self._postprocess_pool = create_postprocess_pool()
+        timers = {}
+        start = time.perf_counter()
+        dataset = DatasetRegistry.get(self._eval_dataset)
         if cfg.TRAINER == 'replicated':
-            all_results = multithread_predict_dataflow(self.dataflows, self.predictors)
+            # the results are evaluated while the predictors run
+            evaluator = dataset.inference_evaluator()
+            multithread_predict_dataflow(
+                self.dataflows, self.predictors, postprocess_pool=self._postprocess_pool, timers=timers,
+                evaluator=evaluator)
         else:
             filenames = [os.path.join(
-                logdir, 'outputs{}-part{}.json'.format(self.global_step, rank)
+                logdir, 'outputs{}-part{}.npz'.format(self.global_step, rank)
             ) for rank in range(hvd.local_size())]
 
             if self._horovod_run_eval:
-                local_results = predict_dataflow(self.dataflow, self.predictor)
-                fname = filenames[hvd.local_rank()]
-                with open(fname, 'w') as f:
-                    json.dump(local_results, f)
+                local_results = multithread_predict_dataflow(
+                    [self.dataflow], [self.predictor], postprocess_pool=self._postprocess_pool, timers=timers)
+                local_results.save(filenames[hvd.local_rank()])
             self.barrier.eval()
             if hvd.rank() > 0:
                 return
             all_results = []
             for fname in filenames:
-                with open(fname, 'r') as f:
-                    obj = json.load(f)
-                all_results.extend(obj)
+                all_results.append(DetectionResults.load(fname))
                 os.unlink(fname)
+            all_results = DetectionResults.concatenate(all_results)
+
+        predict_time = time.perf_counter() - start
 
-        scores = DatasetRegistry.get(self._eval_dataset).eval_inference_results(all_results)
+        if cfg.TRAINER == 'replicated':
+            scores = evaluator.evaluate()
+        else:
+            scores = dataset.eval_inference_results(all_results, num_workers=cfg.TEST.EVAL_NUM_WORKERS)
         for k, v in scores.items():
             self.trainer.monitors.put_scalar(self._eval_dataset + '-' + k, v)
+        self.trainer.monitors.put_scalar(self._eval_dataset + '-eval_time/predict(s)', predict_time)
+        for stage, counter in timers.items():
+            if counter.count:
+                self.trainer.monitors.put_scalar(
+                    self._eval_dataset + '-eval_time/{}(ms)'.format(stage), counter.average * 1000)
 
     def _trigger_epoch(self):
         if self.epoch_num in self.epochs_to_eval:
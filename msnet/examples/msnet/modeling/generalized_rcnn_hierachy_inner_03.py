@@ -18,7 +18,7 @@ from common import filter_anchors_inner
 from . import model_frcnn
 from . import model_mrcnn
 from .backbone import image_preprocess, resnet_c4_backbone, resnet_conv5, resnet_fpn_backbone
-from .model_box import RPNAnchors, clip_boxes, crop_and_resize, roi_align
+from .model_box import RPNAnchors, SparseRPNAnchors, clip_boxes, crop_and_resize, roi_align
 from .model_cascade import CascadeRCNNHead
 from .model_fpn import fpn_model, generate_fpn_proposals_ori, generate_fpn_proposals, multilevel_roi_align, multilevel_rpn_losses,multilevel_rpn_losses_ori
 from .model_frcnn import (
@@ -38,20 +38,71 @@ def merge_bbox_proposals(proposal_house, proposal_damage):
 
 
 class GeneralizedRCNN(ModelDesc):
+    def __init__(self, inference_batch_size=1):
+        """
+        Args:
+            inference_batch_size (int): number of images in one run of the inference graph.
+                If larger than 1, the graph takes inputs "image0", "image1", ...,
+                and can only be used for inference. See :meth:`get_inference_tensor_names`.
+        """
+        self.inference_batch_size = inference_batch_size
+
+    def image_inputs(self):
+        """
+        Returns:
+            [tf.TensorSpec]: the image inputs of the graph
+        """
+        dtype = tf.float32 if cfg.PREPROC.FLOAT_INPUT else tf.uint8
+        if self.inference_batch_size == 1:
+            return [tf.TensorSpec((None, None, 3), dtype, 'image')]
+        return [tf.TensorSpec((None, None, 3), dtype, 'image{}'.format(k))
+                for k in range(self.inference_batch_size)]
+
+    def target_inputs(self):
+        """
+        Returns:
+            [tf.TensorSpec]: the other inputs of the graph, for one image
+        """
+        raise NotImplementedError()
+
+    def inputs(self):
+        ret = self.image_inputs() + self.target_inputs()
+        if cfg.TRAIN.IMAGES_PER_GPU > 1:
+            # The training towers take padded batches of the inputs, see `batch_training_datapoints`,
+            # while the inference towers built from the same inputs take one image.
+            # Therefore their shapes are only set in `build_graph`.
+            ret = [tf.TensorSpec(None, spec.dtype, spec.name) for spec in ret] + [
+                tf.TensorSpec((None, 2), tf.int32, 'image_shape2d'),
+                tf.TensorSpec((None,), tf.int32, 'gt_count')]
+        return ret
+
     def preprocess(self, image):
         image = tf.expand_dims(image, 0)
-        image = image_preprocess(image, bgr=True)
+        image = image_preprocess(image, bgr=True)  # casts uint8 images to float32
         return tf.transpose(a=image, perm=[0, 3, 1, 2])
 
+    def preprocess_batch(self, images, shapes2d):
+        """
+        Like :meth:`preprocess`, but for a batch of NHWC images padded at the bottom and right.
+        The padding is set to zero after the normalization, the same as what the backbone pads.
+        """
+        images = image_preprocess(images, bgr=True)
+        images = tf.transpose(a=images, perm=[0, 3, 1, 2])
+        h_mask = tf.range(tf.shape(input=images)[2])[None, :] < shapes2d[:, 0:1]     # NxH
+        w_mask = tf.range(tf.shape(input=images)[3])[None, :] < shapes2d[:, 1:2]     # NxW
+        mask = tf.logical_and(h_mask[:, None, :, None], w_mask[:, None, None, :])   # Nx1xHxW
+        return images * tf.cast(mask, images.dtype)
+
     def optimizer(self):
         lr = tf.compat.v1.get_variable('learning_rate', initializer=0.003, trainable=False)
         tf.compat.v1.summary.scalar('learning_rate-summary', lr)
 
-        # The learning rate in the config is set for 8 GPUs, and we use trainers with average=False.
+        # The learning rate in the config is set for 8 images, and we use trainers with average=False.
         lr = lr / 8.
         opt = tf.compat.v1.train.MomentumOptimizer(lr, 0.9)
-        if cfg.TRAIN.NUM_GPUS < 8:
-            opt = optimizer.AccumGradOptimizer(opt, 8 // cfg.TRAIN.NUM_GPUS)
+        total_batch = cfg.TRAIN.NUM_GPUS * cfg.TRAIN.IMAGES_PER_GPU
+        if total_batch < 8:
+            opt = optimizer.AccumGradOptimizer(opt, 8 // total_batch)
         return opt
 
     def get_inference_tensor_names(self):
@@ -59,6 +110,7 @@ class GeneralizedRCNN(ModelDesc):
         Returns two lists of tensor names to be used to create an inference callable.
 
         `build_graph` must create tensors of these names when called under inference context.
+        With `inference_batch_size > 1`, the outputs of the k-th image are under the name scope "image{k}".
 
         Returns:
             [str]: input names
@@ -68,17 +120,52 @@ class GeneralizedRCNN(ModelDesc):
         # out = ['output/boxes', 'output/scores', 'output/labels']
         if cfg.MODE_MASK:
             out.append('output/masks')
-        return ['image'], out
+        if self.inference_batch_size == 1:
+            return ['image'], out
+        return ['image{}'.format(k) for k in range(self.inference_batch_size)], \
+            ['image{}/{}'.format(k, name) for k in range(self.inference_batch_size) for name in out]
 
     def build_graph(self, *inputs):
         inputs = dict(zip(self.input_names, inputs))
-        if "gt_masks_packed" in inputs:
-            gt_masks = tf.cast(unpackbits_masks(inputs.pop("gt_masks_packed")), tf.uint8, name="gt_masks")
-            inputs["gt_masks"] = gt_masks
+        batch_training = self.training and cfg.TRAIN.IMAGES_PER_GPU > 1
+        if cfg.TRAIN.IMAGES_PER_GPU > 1:
+            for spec in self.image_inputs() + self.target_inputs():
+                inputs[spec.name].set_shape(([None] if batch_training else []) + spec.shape.as_list())
+
+        if batch_training:
+            losses = self.build_batch_training_graph(inputs)
+        else:
+            if "gt_masks_packed" in inputs:
+                gt_masks = tf.cast(unpackbits_masks(inputs.pop("gt_masks_packed")), tf.uint8, name="gt_masks")
+                inputs["gt_masks"] = gt_masks
+
+            if self.inference_batch_size > 1:
+                assert not self.training, "The batched graph is only for inference!"
+                self.build_batch_inference_graph(inputs)
+                self.check_inference_tensors()
+                return
+
+            image = self.preprocess(inputs['image'])     # 1CHW
+
+            features = self.backbone(image)
+            losses = self.build_image_graph(image, features, inputs)
 
-        image = self.preprocess(inputs['image'])     # 1CHW
+        if self.training:
+            wd_cost = regularize_cost(
+                '.*/W', l2_regularizer(cfg.TRAIN.WEIGHT_DECAY), name='wd_cost')
+            total_cost = tf.add_n(losses + [wd_cost], 'total_cost')
+            add_moving_summary(total_cost, wd_cost)
+            return total_cost
+        else:
+            self.check_inference_tensors()
 
-        features = self.backbone(image)
+    def build_image_graph(self, image, features, inputs):
+        """
+        Run the RPNs and the heads on the features of one image.
+
+        Returns:
+            [tf.Tensor]: the losses in training, otherwise an empty list
+        """
         anchor_inputs = {k: v for k, v in inputs.items() if k.startswith('anchor_')}
         proposals_house, rpn_losses_house = self.rpn_house(image, features, anchor_inputs)  # inputs?
         # proposal on house bboxes
@@ -98,33 +185,117 @@ class GeneralizedRCNN(ModelDesc):
         gt_boxes_area = tf.reduce_mean(input_tensor=tf_area(inputs["gt_boxes_damage"]), name='mean_gt_box_area')
         add_moving_summary(gt_boxes_area)
         head_losses = self.roi_heads(image, features, proposals, targets)
+        return rpn_losses_house + rpn_losses_damage + head_losses
 
-        if self.training:
-            wd_cost = regularize_cost(
-                '.*/W', l2_regularizer(cfg.TRAIN.WEIGHT_DECAY), name='wd_cost')
-            total_cost = tf.add_n(
-                rpn_losses_house + rpn_losses_damage + head_losses + [wd_cost], 'total_cost')
-            add_moving_summary(total_cost, wd_cost)
-            return total_cost
-        else:
-            # Check that the model defines the tensors it declares for inference
-            # For existing models, they are defined in "fastrcnn_predictions(name_scope='output')"
-            G = tf.compat.v1.get_default_graph()
-            ns = G.get_name_scope()
-            for name in self.get_inference_tensor_names()[1]:
-                try:
-                    name = '/'.join([ns, name]) if ns else name
-                    G.get_tensor_by_name(name + ':0')
-                except KeyError:
-                    raise KeyError("Your model does not define the tensor '{}' in inference context.".format(name))
+    def build_batch_training_graph(self, inputs):
+        """
+        Train on a padded batch of images: run the backbone once on the batch,
+        then the rest of the model on the features and inputs of each image, under name scope "image{k}".
+        The losses of the images are summed, the same as the trainers do with the losses of the GPUs.
+
+        Returns:
+            [tf.Tensor]: the losses of all images
+        """
+        shapes2d = inputs['image_shape2d']
+        batch = self.preprocess_batch(inputs['image'], shapes2d)    # NCHW
+        batch_features = self.backbone(batch)
+
+        losses = []
+        for k in range(cfg.TRAIN.IMAGES_PER_GPU):
+            shape2d = shapes2d[k]
+            image = batch[k:k + 1, :, :shape2d[0], :shape2d[1]]
+            features = self.slice_image_features(batch_features, k, shape2d)
+            # all images share the variables of the heads
+            with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope(), reuse=k > 0, auxiliary_name_scope=False), \
+                    tf.compat.v1.name_scope('image{}'.format(k)):
+                losses.extend(self.build_image_graph(image, features, self.slice_image_inputs(inputs, k)))
+        return losses
+
+    def slice_image_inputs(self, inputs, k):
+        """
+        Returns:
+            dict: the inputs of the k-th image in a padded batch, like the inputs of a single image.
+            The anchor inputs keep their padding, the model narrows them to the featuremaps of the image
+            (sparse anchor inputs are padded with ignored anchors).
+        """
+        num_gt = inputs['gt_count'][k]
+        ret = {}
+        for name, v in inputs.items():
+            if name.startswith('anchor_'):
+                ret[name] = v[k]
+            elif name.startswith('gt_') and name != 'gt_count':
+                ret[name] = v[k, :num_gt]
+        if 'gt_masks_packed' in ret:
+            h, w = tf.unstack(inputs['image_shape2d'][k])
+            masks = ret.pop('gt_masks_packed')[:, :h, :(w + 7) // 8]
+            ret['gt_masks'] = tf.cast(unpackbits_masks(masks), tf.uint8, name="gt_masks")
+        return ret
+
+    def build_batch_inference_graph(self, inputs):
+        """
+        Pad the images to a common shape and run the backbone once on the batch.
+        Then run the rest of the model on the features of each image, under name scope "image{k}".
+        """
+        images = [self.preprocess(inputs['image{}'.format(k)])     # 1CHW
+                  for k in range(self.inference_batch_size)]
+        shapes2d = [tf.shape(input=image)[2:] for image in images]
+        max_shape2d = tf.reduce_max(input_tensor=tf.stack(shapes2d), axis=0)
+        # pad after normalization, the same as what the backbone pads
+        batch = tf.concat([
+            tf.pad(tensor=image, paddings=[[0, 0], [0, 0], [0, max_shape2d[0] - shape2d[0]], [0, max_shape2d[1] - shape2d[1]]])
+            for image, shape2d in zip(images, shapes2d)], axis=0, name='batch_images')   # NCHW
+        batch_features = self.backbone(batch)
+
+        anchor_inputs = {k: v for k, v in inputs.items() if k.startswith('anchor_')}
+        targets = [inputs[k] for k in ['gt_boxes_damage', 'gt_labels', 'gt_masks'] if k in inputs]
+        for k, image in enumerate(images):
+            features = self.slice_image_features(batch_features, k, shapes2d[k])
+            # all images share the variables of the heads
+            with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope(), reuse=k > 0, auxiliary_name_scope=False), \
+                    tf.compat.v1.name_scope('image{}'.format(k)):
+                proposals_house, _ = self.rpn_house(image, features, anchor_inputs)
+                proposals_damage, _ = self.rpn_damage(image, features, anchor_inputs, proposals_house.boxes)
+                self.roi_heads(image, features, proposals_damage, targets)
+
+    def slice_image_features(self, features, k, shape2d):
+        """
+        Args:
+            features: the features of a padded batch of images
+            k (int): index of the image in the batch
+            shape2d: (h, w) of the preprocessed image
+
+        Returns:
+            the features of the k-th image, with the shapes the backbone gives on that image alone
+        """
+        raise NotImplementedError("Batched graphs are not implemented for {}!".format(type(self).__name__))
+
+    def check_inference_tensors(self):
+        # Check that the model defines the tensors it declares for inference
+        # For existing models, they are defined in "fastrcnn_predictions(name_scope='output')"
+        G = tf.compat.v1.get_default_graph()
+        ns = G.get_name_scope()
+        for name in self.get_inference_tensor_names()[1]:
+            try:
+                name = '/'.join([ns, name]) if ns else name
+                G.get_tensor_by_name(name + ':0')
+            except KeyError:
+                raise KeyError("Your model does not define the tensor '{}' in inference context.".format(name))
 
 class ResNetFPNModel(GeneralizedRCNN):
 
-    def inputs(self):
-        ret = [
-            tf.TensorSpec((None, None, 3), tf.float32, 'image')]
+    def target_inputs(self):
+        ret = []
         num_anchors = len(cfg.RPN.ANCHOR_RATIOS)
         for k in range(len(cfg.FPN.ANCHOR_STRIDES)):
+            if cfg.RPN.SPARSE_ANCHOR_INPUTS:
+                # only the anchors sampled for the loss, see `TrainingDataPreprocessor._split_to_levels_sparse`
+                for branch in ['house', 'damage']:
+                    ret.extend([
+                        tf.TensorSpec((None,), tf.int32, 'anchor_labels_lvl{}_{}'.format(k + 2, branch)),
+                        tf.TensorSpec((None, 4), tf.float32, 'anchor_boxes_lvl{}_{}'.format(k + 2, branch)),
+                        tf.TensorSpec((None, 3), tf.int32, 'anchor_inds_lvl{}_{}'.format(k + 2, branch))
+                    ])
+                continue
             ret.extend([
                 tf.TensorSpec((None, None, num_anchors), tf.int32,
                               'anchor_labels_lvl{}_house'.format(k + 2)),
@@ -145,11 +316,42 @@ class ResNetFPNModel(GeneralizedRCNN):
             )
         return ret
 
+    def get_multilevel_anchors(self, inputs, branch):
+        """
+        Returns:
+            [RPNAnchors] or [SparseRPNAnchors]: the anchors of each level with their
+            groundtruth for the "house" or "damage" branch
+        """
+        all_anchors_fpn = get_all_anchors_fpn(
+            strides=cfg.FPN.ANCHOR_STRIDES,
+            sizes=cfg.RPN.ANCHOR_SIZES,
+            ratios=cfg.RPN.ANCHOR_RATIOS,
+            max_size=cfg.PREPROC.MAX_SIZE)
+        ret = []
+        for i, anchors in enumerate(all_anchors_fpn):
+            gt_labels = inputs['anchor_labels_lvl{}_{}'.format(i + 2, branch)]
+            gt_boxes = inputs['anchor_boxes_lvl{}_{}'.format(i + 2, branch)]
+            if cfg.RPN.SPARSE_ANCHOR_INPUTS:
+                inds = inputs['anchor_inds_lvl{}_{}'.format(i + 2, branch)]
+                ret.append(SparseRPNAnchors(anchors, gt_labels, gt_boxes, inds))
+            else:
+                ret.append(RPNAnchors(anchors, gt_labels, gt_boxes))
+        return ret
+
     def slice_feature_and_anchors(self, p23456, anchors):
         for i, stride in enumerate(cfg.FPN.ANCHOR_STRIDES):
             with tf.compat.v1.name_scope('FPN_slice_lvl{}'.format(i)):
                 anchors[i] = anchors[i].narrow_to(p23456[i])
 
+    def slice_image_features(self, features, k, shape2d):
+        mult = float(cfg.FPN.RESOLUTION_REQUIREMENT)
+        padded_shape2d = tf.cast(tf.math.ceil(tf.cast(shape2d, tf.float32) / mult) * mult, tf.int32)
+        ret = []
+        for stride, featuremap in zip(cfg.FPN.ANCHOR_STRIDES, features):
+            fshape2d = (padded_shape2d + stride - 1) // stride
+            ret.append(featuremap[k:k + 1, :, :fshape2d[0], :fshape2d[1]])
+        return ret
+
     def backbone(self, image):
         c2345 = resnet_fpn_backbone(image, cfg.BACKBONE.RESNET_NUM_BLOCKS)
         p23456 = fpn_model('fpn', c2345)
@@ -159,15 +361,7 @@ class ResNetFPNModel(GeneralizedRCNN):
         assert len(cfg.RPN.ANCHOR_SIZES) == len(cfg.FPN.ANCHOR_STRIDES)
 
         image_shape2d = tf.shape(input=image)[2:]     # h,w
-        all_anchors_fpn = get_all_anchors_fpn(
-            strides=cfg.FPN.ANCHOR_STRIDES,
-            sizes=cfg.RPN.ANCHOR_SIZES,
-            ratios=cfg.RPN.ANCHOR_RATIOS,
-            max_size=cfg.PREPROC.MAX_SIZE)
-        multilevel_anchors = [RPNAnchors(
-            all_anchors_fpn[i],
-            inputs['anchor_labels_lvl{}_house'.format(i + 2)],
-            inputs['anchor_boxes_lvl{}_house'.format(i + 2)]) for i in range(len(all_anchors_fpn))]
+        multilevel_anchors = self.get_multilevel_anchors(inputs, 'house')
 
 
         self.slice_feature_and_anchors(features, multilevel_anchors)
@@ -204,24 +398,16 @@ class ResNetFPNModel(GeneralizedRCNN):
         assert len(cfg.RPN.ANCHOR_SIZES) == len(cfg.FPN.ANCHOR_STRIDES)
 
         image_shape2d = tf.shape(input=image)[2:]     # h,w
-        all_anchors_fpn = get_all_anchors_fpn(
-            strides=cfg.FPN.ANCHOR_STRIDES,
-            sizes=cfg.RPN.ANCHOR_SIZES,
-            ratios=cfg.RPN.ANCHOR_RATIOS,
-            max_size=cfg.PREPROC.MAX_SIZE)
-        # Filter anchors here: lvl and house bboxes
-        # TODO: IOU filter.
-        masks = filter_anchors_inner(house_bboxes, all_anchors_fpn, 0.3)
-
-
-        multilevel_anchors = [RPNAnchors(
-            all_anchors_fpn[i],
-            inputs['anchor_labels_lvl{}_damage'.format(i + 2)],
-            inputs['anchor_boxes_lvl{}_damage'.format(i + 2)]) for i in range(len(all_anchors_fpn))]
+        multilevel_anchors = self.get_multilevel_anchors(inputs, 'damage')
 
 
         self.slice_feature_and_anchors(features, multilevel_anchors)
 
+        # Filter anchors here: lvl and house bboxes
+        # Only the anchors that fit the featuremaps are needed, so the masks match the logits.
+        # TODO: IOU filter.
+        masks = filter_anchors_inner(house_bboxes, [k.boxes for k in multilevel_anchors], 0.3)
+
         # Multi-Level RPN Proposals
         rpn_outputs = [rpn_head('rpn_damage', pi, cfg.FPN.NUM_CHANNEL, len(cfg.RPN.ANCHOR_RATIOS))
                        for pi in features]
@@ -306,9 +492,8 @@ class ResNetFPNModel(GeneralizedRCNN):
             return []
 
 class ResNetC4Model(GeneralizedRCNN):
-    def inputs(self):
+    def target_inputs(self):
         ret = [
-            tf.TensorSpec((None, None, 3), tf.float32, 'image'),
             tf.TensorSpec((None, None, cfg.RPN.NUM_ANCHOR), tf.int32, 'anchor_labels'),
             tf.TensorSpec((None, None, cfg.RPN.NUM_ANCHOR, 4), tf.float32, 'anchor_boxes'),
             tf.TensorSpec((None, 4), tf.float32, 'gt_boxes'),
@@ -195,6 +195,43 @@ class RPNAnchors(namedtuple('_RPNAnchors', ['boxes', 'gt_labels', 'gt_boxes'])):
         return RPNAnchors(boxes, gt_labels, gt_boxes)
 
 
+class SparseRPNAnchors(namedtuple('_SparseRPNAnchors', ['boxes', 'gt_labels', 'gt_boxes', 'inds'])):
+    """
+    Like :class:`RPNAnchors`, but the groundtruth is only given for the K anchors sampled for the loss.
+
+    boxes (FS x FS x NA x 4): The anchor boxes.
+    gt_labels (K,):
+    gt_boxes (K x 4): Groundtruth boxes corresponding to each sampled anchor.
+    inds (K x 3): The (y, x, anchor) coordinates of each sampled anchor.
+    """
+    def gather(self, featuremap_output):
+        """
+        Args:
+            featuremap_output: fHxfWxNA(x...), e.g. the logits of the anchors
+
+        Returns:
+            K(x...): the values of the sampled anchors
+        """
+        return tf.gather_nd(featuremap_output, self.inds)
+
+    def encoded_gt_boxes(self):
+        return encode_bbox_target(self.gt_boxes, self.gather(self.boxes))
+
+    def decode_logits(self, logits):
+        return decode_bbox_target(logits, self.boxes)
+
+    @under_name_scope()
+    def narrow_to(self, featuremap):
+        """
+        Slice anchors to the spatial size of this featuremap.
+        The sampled anchors are inside the image, therefore their coordinates do not change.
+        """
+        shape2d = tf.shape(input=featuremap)[2:]  # h,w
+        slice4d = tf.concat([shape2d, [-1, -1]], axis=0)
+        boxes = tf.slice(self.boxes, [0, 0, 0, 0], slice4d)
+        return SparseRPNAnchors(boxes, self.gt_labels, self.gt_boxes, self.inds)
+
+
 if __name__ == '__main__':
     """
     Demonstrate what's wrong with tf.image.crop_and_resize.
@@ -14,7 +14,7 @@ from tensorpack.utils.argtools import memoized
 from config import config as cfg
 from utils.box_ops import area as tf_area
 from .backbone import GroupNorm
-from .model_box import roi_align
+from .model_box import SparseRPNAnchors, roi_align
 from .model_rpn import generate_rpn_proposals, rpn_losses, rpn_losses_ori, get_all_anchors
 
 
@@ -135,7 +135,8 @@ def multilevel_rpn_losses_ori(
         multilevel_anchors, multilevel_label_logits, multilevel_box_logits):
     """
     Args:
-        multilevel_anchors: #lvl RPNAnchors
+        multilevel_anchors: #lvl RPNAnchors, or SparseRPNAnchors.
+            For the latter, the logits of the sampled anchors are gathered by their indices.
         multilevel_label_logits: #lvl tensors of shape HxWxA
         multilevel_box_logits: #lvl tensors of shape HxWxAx4
 
@@ -151,9 +152,11 @@ def multilevel_rpn_losses_ori(
     with tf.compat.v1.name_scope('rpn_losses'):
         for lvl in range(num_lvl):
             anchors = multilevel_anchors[lvl]
+            label_logits, box_logits = multilevel_label_logits[lvl], multilevel_box_logits[lvl]
+            if isinstance(anchors, SparseRPNAnchors):
+                label_logits, box_logits = anchors.gather(label_logits), anchors.gather(box_logits)
             label_loss, box_loss = rpn_losses_ori(
-                anchors.gt_labels, anchors.encoded_gt_boxes(),
-                multilevel_label_logits[lvl], multilevel_box_logits[lvl],
+                anchors.gt_labels, anchors.encoded_gt_boxes(), label_logits, box_logits,
                 name_scope='level{}'.format(lvl + 2))
             losses.extend([label_loss, box_loss])
 
@@ -166,9 +169,11 @@ def multilevel_rpn_losses(
         multilevel_anchors, multilevel_label_logits, multilevel_box_logits, masks):
     """
     Args:
-        multilevel_anchors: #lvl RPNAnchors
+        multilevel_anchors: #lvl RPNAnchors, or SparseRPNAnchors.
+            For the latter, the logits and masks of the sampled anchors are gathered by their indices.
         multilevel_label_logits: #lvl tensors of shape HxWxA
         multilevel_box_logits: #lvl tensors of shape HxWxAx4
+        masks: #lvl boolean tensors of shape HxWxA, the anchors to compute the losses on
 
     Returns:
         label_loss, box_loss
@@ -182,9 +187,11 @@ def multilevel_rpn_losses(
     with tf.compat.v1.name_scope('rpn_losses'):
         for lvl in range(num_lvl):
             anchors = multilevel_anchors[lvl]
+            label_logits, box_logits, mask = multilevel_label_logits[lvl], multilevel_box_logits[lvl], masks[lvl]
+            if isinstance(anchors, SparseRPNAnchors):
+                label_logits, box_logits, mask = [anchors.gather(k) for k in [label_logits, box_logits, mask]]
             label_loss, box_loss = rpn_losses(
-                anchors.gt_labels, anchors.encoded_gt_boxes(),
-                multilevel_label_logits[lvl], multilevel_box_logits[lvl], masks[lvl],
+                anchors.gt_labels, anchors.encoded_gt_boxes(), label_logits, box_logits, mask,
                 name_scope='level{}'.format(lvl + 2))
             losses.extend([label_loss, box_loss])
 
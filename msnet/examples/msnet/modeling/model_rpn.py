@@ -72,6 +72,8 @@ def rpn_losses_ori(anchor_labels, anchor_boxes, label_logits, box_logits):
         label_logits:  fHxfWxNA
         box_logits: fHxfWxNAx4
 
+        Or, all of them only for the K anchors sampled for the loss: K, Kx4, K, Kx4.
+
     Returns:
         label_loss, box_loss
     """
@@ -137,6 +139,8 @@ def rpn_losses(anchor_labels, anchor_boxes, label_logits, box_logits, mask):
         box_logits: fHxfWxNAx4
         mask: SxSxNUM_ratiosx1
 
+        Or, all of them only for the K anchors sampled for the loss: K, Kx4, K, Kx4, K.
+
     Returns:
         label_loss, box_loss
     """
@@ -5,9 +5,11 @@ import glob
 sys.path.append("")
 import argparse
 import itertools
+import json
 import numpy as np
 import os
 import shutil
+import time
 import tensorflow as tf
 import cv2
 import tqdm
@@ -22,7 +24,7 @@ from dataset import DatasetRegistry, register_coco, register_balloon
 from config import config as cfg
 from config import finalize_configs
 from data import get_eval_dataflow, get_train_dataflow
-from eval import DetectionResult, multithread_predict_dataflow, predict_image
+from eval import DetectionResult, multithread_predict_dataflow, predict_images, predict_stream, results_to_json
 from modeling.generalized_rcnn_hierachy_inner_03 import ResNetC4Model, ResNetFPNModel
 from viz import (
     draw_annotation, draw_final_outputs, draw_predictions,
@@ -92,14 +94,16 @@ def do_evaluate(pred_config, output_file):
         dataflows = [
             get_eval_dataflow(dataset, shard=k, num_shards=num_tower)
             for k in range(num_tower)]
-        all_results = multithread_predict_dataflow(dataflows, graph_funcs)
-        output = output_file + '-' + dataset
-        DatasetRegistry.get(dataset).eval_inference_results(all_results, output)
+        all_results = multithread_predict_dataflow(dataflows, graph_funcs, cfg.TEST.BATCH_SIZE)
+        root, ext = os.path.splitext(output_file)
+        output = root + '-' + dataset + ext
+        DatasetRegistry.get(dataset).eval_inference_results(
+            all_results, output, num_workers=cfg.TEST.EVAL_NUM_WORKERS)
 
 
 def do_predict(pred_func, input_file, output_path=None):
     img = cv2.imread(input_file, cv2.IMREAD_COLOR)
-    results = predict_image(img, pred_func)
+    results = predict_images([img], pred_func, cfg.TEST.BATCH_SIZE)[0]
     final = draw_final_outputs(img, results)
     viz = np.concatenate((img, final), axis=1)
     out_filename = input_file.split("/")[-1]
@@ -108,12 +112,79 @@ def do_predict(pred_func, input_file, output_path=None):
     logger.info("Inference output for {} written to output.png".format(input_file))
 
 
+def read_video_frames(video_file, stride=1):
+    """
+    Yields:
+        (frame, frame_index) for every `stride`-th frame of the video, starting from the first one.
+    """
+    cap = cv2.VideoCapture(video_file)
+    assert cap.isOpened(), "Cannot open video {}!".format(video_file)
+    try:
+        for idx in itertools.count():
+            if idx % stride:
+                # skip the frame without decoding it
+                if not cap.grab():
+                    return
+                continue
+            ok, frame = cap.read()
+            if not ok:
+                return
+            yield frame, idx
+    finally:
+        cap.release()
+
+
+def do_video(pred_func, video_file, output_file, stride=1, num_workers=4):
+    """
+    Run detection on every `stride`-th frame of a video, and stream the results to `output_file`.
+    If `output_file` ends with ".json", it is a list of COCO results whose image_id is the frame index.
+    Otherwise, each line of it is a json object of one frame: {"frame": index, "detections": [COCO results]}.
+    """
+    cap = cv2.VideoCapture(video_file)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    coco_format = output_file.endswith('.json')
+
+    timers = {}
+    num_frames = 0
+    start = time.perf_counter()
+    frames = read_video_frames(video_file, stride)
+    with open(output_file, 'w') as f, tqdm.tqdm(total=(total + stride - 1) // stride) as pbar:
+        if coco_format:
+            f.write('[')
+        first = True
+        for frame_idx, results in predict_stream(
+                frames, pred_func, cfg.TEST.BATCH_SIZE, num_workers=num_workers,
+                queue_size=max(16, 2 * cfg.TEST.BATCH_SIZE), timers=timers):
+            dets = results_to_json(results, frame_idx)
+            if coco_format:
+                for det in dets:
+                    f.write('\n' if first else ',\n')
+                    f.write(json.dumps(det))
+                    first = False
+            else:
+                f.write(json.dumps({'frame': frame_idx, 'detections': dets}) + '\n')
+            num_frames += 1
+            pbar.update()
+        if coco_format:
+            f.write('\n]\n')
+    elapsed = time.perf_counter() - start
+
+    logger.info("Processed {} frames of {} in {:.1f} seconds, {:.2f} frames/s. Results written to {}.".format(
+        num_frames, video_file, elapsed, num_frames / elapsed, output_file))
+    for stage, counter in timers.items():
+        if counter.count:
+            logger.info("{}: {:.1f} ms on average, {:.1f} ms at most.".format(
+                stage, counter.average * 1000, counter.max * 1000))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--load', help='load a model for evaluation.', required=True)
     parser.add_argument('--visualize', action='store_true', help='visualize intermediate results')
     parser.add_argument('--evaluate', help="Run evaluation. "
-                                           "This argument is the path to the output json evaluation file")
+                                           "This argument is the path to the output evaluation file, "
+                                           "a COCO json file or, if it ends with .npz, the arrays of DetectionResults")
     parser.add_argument('--predict', help="Run prediction on a given image. "
                                           "This argument is the path to the input image file", nargs='+')
     parser.add_argument('--benchmark', action='store_true', help="Benchmark the speed of the model + postprocessing")
@@ -123,6 +194,13 @@ if __name__ == '__main__':
     parser.add_argument('--output-serving', help='Save a model to serving file')
     parser.add_argument('--input-img', help="Output path for saving predicted images")
     parser.add_argument('--output-img', help='Save predicted image results')
+    parser.add_argument('--video', help="Run prediction on every frame of a video. "
+                                        "This argument is the path to the input video file")
+    parser.add_argument('--video-output', help="Output file for --video. Results are saved in COCO format "
+                                               "if it ends with .json, otherwise one json line per frame")
+    parser.add_argument('--video-stride', type=int, default=1, help="Only predict on every N-th frame of the video")
+    parser.add_argument('--video-workers', type=int, default=4,
+                        help="Number of threads to preprocess and postprocess video frames")
 
     args = parser.parse_args()
     if args.config:
@@ -130,7 +208,9 @@ if __name__ == '__main__':
     register_coco(cfg.DATA.BASEDIR)  # add COCO datasets to the registry
     # register_balloon(cfg.DATA.BASEDIR)
 
-    MODEL = ResNetFPNModel() if cfg.MODE_FPN else ResNetC4Model()
+    # visualization needs the training inputs, which the batched graph does not take
+    batch_size = 1 if args.visualize else cfg.TEST.BATCH_SIZE
+    MODEL = ResNetFPNModel(batch_size) if cfg.MODE_FPN else ResNetC4Model(batch_size)
 
     if not tf.test.is_gpu_available():
         from tensorflow.python.framework import test_util
@@ -160,17 +240,24 @@ if __name__ == '__main__':
             predictor = OfflinePredictor(predcfg)
             for image_file in args.predict:
                 do_predict(predictor, image_file)
+        elif args.video:
+            output_file = args.video_output or os.path.splitext(args.video)[0] + '.jsonl'
+            predictor = OfflinePredictor(predcfg)
+            do_video(predictor, args.video, output_file, args.video_stride, args.video_workers)
         elif args.evaluate:
-            assert args.evaluate.endswith('.json'), args.evaluate
+            assert args.evaluate.endswith(('.json', '.npz')), args.evaluate
             do_evaluate(predcfg, args.evaluate)
         elif args.benchmark:
             df = get_eval_dataflow(cfg.DATA.VAL[0])
             df.reset_state()
             predictor = OfflinePredictor(predcfg)
-            for _, img in enumerate(tqdm.tqdm(df, total=len(df), smoothing=0.5)):
-                # This includes post-processing time, which is done on CPU and not optimized
-                # To exclude it, modify `predict_image`.
-                predict_image(img[0], predictor)
+            df_iter = iter(df)
+            with tqdm.tqdm(total=len(df), smoothing=0.5) as pbar:
+                for batch in iter(lambda: list(itertools.islice(df_iter, cfg.TEST.BATCH_SIZE)), []):
+                    # This includes post-processing time, which is done on CPU and not optimized
+                    # To exclude it, modify `predict_images`.
+                    predict_images([dp[0] for dp in batch], predictor, cfg.TEST.BATCH_SIZE)
+                    pbar.update(len(batch))
         if args.input_img:
             input_path = args.input_img
             out_path = args.output_img
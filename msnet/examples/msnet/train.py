@@ -61,13 +61,14 @@ if __name__ == '__main__':
 
     # Compute the training schedule from the number of GPUs ...
     stepnum = cfg.TRAIN.STEPS_PER_EPOCH
+    total_batch = cfg.TRAIN.NUM_GPUS * cfg.TRAIN.IMAGES_PER_GPU
     # warmup is step based, lr is epoch based
-    init_lr = cfg.TRAIN.WARMUP_INIT_LR * min(8. / cfg.TRAIN.NUM_GPUS, 1.)
+    init_lr = cfg.TRAIN.WARMUP_INIT_LR * min(8. / total_batch, 1.)
     warmup_schedule = [(0, init_lr), (cfg.TRAIN.WARMUP, cfg.TRAIN.BASE_LR)]
     warmup_end_epoch = cfg.TRAIN.WARMUP * 1. / stepnum
     lr_schedule = [(int(warmup_end_epoch + 0.5), cfg.TRAIN.BASE_LR)]
 
-    factor = 8. / cfg.TRAIN.NUM_GPUS
+    factor = 8. / total_batch
     for idx, steps in enumerate(cfg.TRAIN.LR_SCHEDULE[:-1]):
         mult = 0.1 ** (idx + 1)
         lr_schedule.append(
@@ -76,7 +77,7 @@ if __name__ == '__main__':
     logger.info("LR Schedule (epochs, value): " + str(lr_schedule))
     train_dataflow = get_train_dataflow()
     # This is what's commonly referred to as "epochs"
-    total_passes = cfg.TRAIN.LR_SCHEDULE[-1] * 8 / train_dataflow.size()
+    total_passes = cfg.TRAIN.LR_SCHEDULE[-1] * 8 / (train_dataflow.size() * cfg.TRAIN.IMAGES_PER_GPU)
     logger.info("Total passes of the training set is: {:.5g}".format(total_passes))
 
     # Create callbacks ...
@@ -90,7 +91,7 @@ if __name__ == '__main__':
         ScheduledHyperParamSetter('learning_rate', lr_schedule),
         GPUMemoryTracker(),
         HostMemoryTracker(),
-        ThroughputTracker(samples_per_step=cfg.TRAIN.NUM_GPUS),
+        ThroughputTracker(samples_per_step=total_batch),
         EstimatedTimeLeft(median=True),
         SessionRunTimeout(60000),   # 1 minute timeout
         GPUUtilizationTracker()
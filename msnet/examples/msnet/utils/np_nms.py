@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# File: np_nms.py
+
+"""
+Suppression of overlapping detections, vectorized with numpy.
+"""
+
+import numpy as np
+
+from .np_box_ops import iou as np_iou
+
+
+def suppress_by_iou(ious, scores, iou_threshold):
+    """
+    Find the detections that overlap with another detection of a higher or equal score.
+
+    Unlike greedy NMS, a detection is suppressed even if the detection it overlaps with
+    is suppressed itself, and two overlapping detections of the same score are both suppressed.
+
+    Args:
+        ious: NxN float, pairwise IoU of the detections
+        scores: N float
+        iou_threshold (float): detections overlap when their IoU is larger than this
+
+    Returns:
+        N bool, whether each detection is suppressed
+    """
+    overlap = ious > iou_threshold
+    np.fill_diagonal(overlap, False)
+    higher = scores[:, None] >= scores[None, :]     # [i, j]: i scores no lower than j
+    return np.any(overlap & higher, axis=0)
+
+
+def box_suppression(boxes, scores, iou_threshold):
+    """
+    Args:
+        boxes: Nx4 floatbox
+        scores: N float
+        iou_threshold (float):
+
+    Returns:
+        N bool, see :func:`suppress_by_iou`.
+    """
+    boxes = np.asarray(boxes, dtype='float32').reshape((-1, 4))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ious = np_iou(boxes, boxes)     # nan for empty boxes, which never overlap
+    return suppress_by_iou(ious, np.asarray(scores), iou_threshold)
+
+
+def mask_suppression(rles, scores, iou_threshold):
+    """
+    Args:
+        rles: N masks in COCO's compressed RLE format, of the same image
+        scores: N float
+        iou_threshold (float):
+
+    Returns:
+        N bool, see :func:`suppress_by_iou`.
+    """
+    import pycocotools.mask as cocomask
+
+    rles = list(rles)
+    if len(rles) == 0:
+        return np.zeros((0,), dtype=bool)
+    ious = np.asarray(cocomask.iou(rles, rles, [0] * len(rles))).reshape((len(rles), len(rles)))
+    return suppress_by_iou(ious, np.asarray(scores), iou_threshold)
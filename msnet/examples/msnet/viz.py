@@ -2,6 +2,7 @@
 # File: viz.py
 
 import numpy as np
+import pycocotools.mask as cocomask
 
 from tensorpack.utils import viz
 from tensorpack.utils.palette import PALETTE_RGB
@@ -9,6 +10,7 @@ from tensorpack.utils.palette import PALETTE_RGB
 from config import config as cfg
 from utils.np_box_ops import area as np_area
 from utils.np_box_ops import iou as np_iou
+from utils.np_nms import box_suppression, mask_suppression
 from common import polygons_to_mask
 
 
@@ -68,115 +70,34 @@ def draw_predictions(img, boxes, scores):
     return viz.draw_boxes(img, boxes, tags)
 
 
-def cal_mask_iou(component1, component2):
-    component1 = np.array(component1, dtype=bool)
-    component2 = np.array(component2, dtype=bool)
-    overlap = component1 * component2  # Logical AND
-    union = component1 + component2  # Logical OR
-
-    IOU = overlap.sum() / float(union.sum())  # Treats "True" as 1,
-    return IOU
-
-
-# https://stackoverflow.com/questions/25349178/calculating-percentage-of-bounding-box-overlap-for-image-detector-evaluation
-def get_iou(bb1, bb2):
+def class_nms(results, sorted_inds, iou_th=0.1):
     """
-    Calculate the Intersection over Union (IoU) of two bounding boxes.
-
-    Parameters
-    ----------
-    bb1 : dict
-        Keys: {'x1', 'x2', 'y1', 'y2'}
-        The (x1, y1) position is at the top left corner,
-        the (x2, y2) position is at the bottom right corner
-    bb2 : dict
-        Keys: {'x1', 'x2', 'y1', 'y2'}
-        The (x1, y1) position is at the top left corner,
-        the (x2, y2) position is at the bottom right corner
-
-    Returns
-    -------
-    float
-        in [0, 1]
+    Returns:
+        list[int]: the indices in `sorted_inds` of the results whose masks overlap
+        with a higher-scored result. See :func:`utils.np_nms.suppress_by_iou`.
     """
-    assert bb1['x1'] < bb1['x2']
-    assert bb1['y1'] < bb1['y2']
-    assert bb2['x1'] < bb2['x2']
-    assert bb2['y1'] < bb2['y2']
-
-    # determine the coordinates of the intersection rectangle
-    x_left = max(bb1['x1'], bb2['x1'])
-    y_top = max(bb1['y1'], bb2['y1'])
-    x_right = min(bb1['x2'], bb2['x2'])
-    y_bottom = min(bb1['y2'], bb2['y2'])
-
-    if x_right < x_left or y_bottom < y_top:
-        return 0.0
-
-    # The intersection of two axis-aligned bounding boxes is always an
-    # axis-aligned bounding box
-    intersection_area = (x_right - x_left) * (y_bottom - y_top)
-
-    # compute the area of both AABBs
-    bb1_area = (bb1['x2'] - bb1['x1']) * (bb1['y2'] - bb1['y1'])
-    bb2_area = (bb2['x2'] - bb2['x1']) * (bb2['y2'] - bb2['y1'])
-
-    # compute the intersection over union by taking the intersection
-    # area and dividing it by the sum of prediction + ground-truth
-    # areas - the interesection area
-    iou = intersection_area / float(bb1_area + bb2_area - intersection_area)
-    assert iou >= 0.0
-    assert iou <= 1.0
-    return iou
-
-
-def class_nms(results, sorted_inds, iou_th = 0.1):
-    lst = []
-    for rst_id_1 in sorted_inds:
-        for rst_id_2 in sorted_inds:
-            if rst_id_1 != rst_id_2:
-                rst_1 = results[rst_id_1]
-                rst_2 = results[rst_id_2]
-                iou = cal_mask_iou(rst_1.mask, rst_2.mask)
-                if iou > iou_th:
-                    if rst_1.score > rst_2.score:
-                        lst.append(rst_id_2)
-                    else:
-                        lst.append(rst_id_1)
-    return list(set(lst))
-
-
-def cal_box_iou(box1, box2):
-    box1 = {'x1': box1[0], 'y1': box1[1], 'x2': box1[2], 'y2':box1[3]}
-    box2 = {'x1': box2[0], 'y1': box2[1], 'x2': box2[2], 'y2': box2[3]}
-    iou = get_iou(box1, box2)
-    return iou
-
-
-def box_class_nms(results, sorted_inds, iou_th = 0.1):
-    lst = []
-    for rst_id_1 in sorted_inds:
-        for rst_id_2 in sorted_inds:
-            if rst_id_1 != rst_id_2:
-                rst_1 = results[rst_id_1]
-                rst_2 = results[rst_id_2]
-                iou = cal_box_iou(rst_1.box, rst_2.box)
-                if iou > iou_th:
-                    if rst_1.score > rst_2.score:
-                        lst.append(rst_id_2)
-                    else:
-                        lst.append(rst_id_1)
-    return list(set(lst))
+    sorted_inds = np.asarray(sorted_inds)
+    suppressed = mask_suppression(
+        [results[k].mask for k in sorted_inds], [results[k].score for k in sorted_inds], iou_th)
+    return sorted_inds[suppressed].tolist()
 
 
+def box_class_nms(results, sorted_inds, iou_th=0.1):
+    """
+    Returns:
+        list[int]: the indices in `sorted_inds` of the results whose boxes overlap
+        with a higher-scored result. See :func:`utils.np_nms.suppress_by_iou`.
+    """
+    sorted_inds = np.asarray(sorted_inds)
+    suppressed = box_suppression(
+        [results[k].box for k in sorted_inds], [results[k].score for k in sorted_inds], iou_th)
+    return sorted_inds[suppressed].tolist()
 
-    # ttl_len = len(results)
-    # for i in range(ttl_len):
 
 def draw_final_outputs(img, results):
     """
     Args:
-        results: [DetectionResult]
+        results: [DetectionResult]. The masks, if any, are decoded from RLE here.
     """
     # new_results = []
     # for r in results:
@@ -225,7 +146,7 @@ def draw_final_outputs(img, results):
                 color = [0.000, 255.000, 0.000]
                 # color = (0, 255, 0)
                 print("error level!")
-            ret = draw_mask(ret, r.mask, color=None, color_id=color_id)
+            ret = draw_mask(ret, cocomask.decode(r.mask), color=None, color_id=color_id)
 
     for result_id in sorted_inds:
         if result_id in rm_lst:
@@ -256,9 +177,7 @@ def draw_final_outputs_blackwhite(img, results):
 
     all_masks = [r.mask for r in results]
     if all_masks[0] is not None:
-        m = all_masks[0] > 0
-        for m2 in all_masks[1:]:
-            m = m | (m2 > 0)
+        m = cocomask.decode(cocomask.merge(all_masks, intersect=False)) > 0
         img_bw[m] = img[m]
 
     tags = ["{},{:.2f}".format(cfg.DATA.CLASS_NAMES[r.class_id], r.score) for r in results]
@@ -2,12 +2,15 @@
 # File: format.py
 
 
+import json
 import numpy as np
 import os
 import six
+from six.moves import queue
 
 from ..utils import logger
 from ..utils.argtools import log_once
+from ..utils.concurrency import StoppableThread
 from ..utils.serialize import loads
 from ..utils.develop import create_dummy_class  # noqa
 from ..utils.loadcaffe import get_caffe_pb
@@ -16,7 +19,7 @@ from ..utils.utils import get_tqdm
 from .base import DataFlowReentrantGuard, RNGDataFlow
 from .common import MapData
 
-__all__ = ['HDF5Data', 'LMDBData', 'LMDBDataDecoder',
+__all__ = ['HDF5Data', 'LMDBData', 'ShardedLMDBData', 'LMDBDataDecoder',
            'CaffeLMDB', 'SVMLightData']
 
 """
@@ -155,6 +158,134 @@ class LMDBData(RNGDataFlow):
                     yield [k, v]
 
 
+class ShardedLMDBData(RNGDataFlow):
+    """
+    Read the lmdb shards written by :meth:`LMDBSerializer.save` with ``num_shards > 1``,
+    and produce (k,v) raw bytes pairs like :class:`LMDBData`.
+
+    Instead of reading the keys in random order, the keys of each shard are split into blocks
+    of consecutive keys. The blocks are read in random order, each one sequentially with a cursor,
+    and the datapoints of a few blocks are shuffled together. A thread reads the next blocks ahead.
+    This reads large contiguous parts of the files, which is friendly to spinning disks and network filesystems.
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path, shuffle=True, block_size=256, mix_blocks=4, readahead=4):
+        """
+        Args:
+            path (str): the directory of the shards.
+            shuffle (bool): shuffle the blocks and the datapoints in them.
+                Otherwise, produce the datapoints in the order they were saved.
+            block_size (int): number of consecutive keys in a block.
+            mix_blocks (int): number of blocks whose datapoints are shuffled together.
+            readahead (int): number of blocks to read ahead in a thread. 0 to read them when needed.
+        """
+        self._path = path
+        self._shuffle = shuffle
+        self._block_size = block_size
+        self._mix_blocks = mix_blocks
+        self._readahead = readahead
+        with open(os.path.join(path, self.INDEX_FILE)) as f:
+            index = json.load(f)
+        self._shard_paths = [os.path.join(path, k) for k in index['shards']]
+        self._size = sum(index['sizes'])
+
+        # the first key and the length of each block
+        self._blocks = []
+        for shard, shard_path in enumerate(self._shard_paths):
+            keys = LMDBData(shard_path, shuffle=True).keys
+            for start in range(0, len(keys), block_size):
+                self._blocks.append((shard, keys[start], min(block_size, len(keys) - start)))
+        logger.info("Found {} entries in {} shards in {}".format(self._size, len(self._shard_paths), path))
+
+    def reset_state(self):
+        self._guard = DataFlowReentrantGuard()
+        super(ShardedLMDBData, self).reset_state()
+        # open the LMDBs in the worker process
+        self._lmdbs = [lmdb.open(k, subdir=False, readonly=True, lock=False, readahead=True,
+                                 map_size=1099511627776 * 2, max_readers=100)
+                       for k in self._shard_paths]
+
+    def __len__(self):
+        return self._size
+
+    def _read_blocks(self, blocks):
+        txns = [k.begin() for k in self._lmdbs]
+        try:
+            cursors = [k.cursor() for k in txns]
+            for shard, first_key, length in blocks:
+                cursor = cursors[shard]
+                cursor.set_key(first_key)
+                block = []
+                for _ in range(length):
+                    block.append([cursor.key(), cursor.value()])
+                    cursor.next()
+                yield block
+        finally:
+            for txn in txns:
+                txn.abort()
+
+    def _read_blocks_ahead(self, blocks):
+        q = queue.Queue(maxsize=self._readahead)
+        blocks_iter = self._read_blocks(blocks)
+
+        class Reader(StoppableThread):
+            def run(self):
+                try:
+                    for block in blocks_iter:
+                        self.queue_put_stoppable(q, block)
+                        if self.stopped():
+                            break
+                    self.queue_put_stoppable(q, None)
+                except Exception as e:
+                    self.queue_put_stoppable(q, e)     # raise it in the main thread
+                finally:
+                    blocks_iter.close()     # the transactions belong to this thread
+
+        reader = Reader()
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                block = q.get()
+                if block is None:
+                    return
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+        finally:
+            reader.stop()
+
+    def __iter__(self):
+        with self._guard:
+            if not self._shuffle:
+                # the i-th datapoint is in the shard i % num_shards
+                txns = [k.begin() for k in self._lmdbs]
+                try:
+                    cursors = [iter(k.cursor()) for k in txns]
+                    for idx in range(self._size):
+                        yield list(next(cursors[idx % len(cursors)]))
+                finally:
+                    for txn in txns:
+                        txn.abort()
+                return
+
+            blocks = list(self._blocks)
+            self.rng.shuffle(blocks)
+            if self._readahead > 0:
+                blocks_iter = self._read_blocks_ahead(blocks)
+            else:
+                blocks_iter = self._read_blocks(blocks)
+            mixed = []
+            for k, block in enumerate(blocks_iter):
+                mixed.extend(block)
+                if (k + 1) % self._mix_blocks == 0 or k == len(blocks) - 1:
+                    self.rng.shuffle(mixed)
+                    yield from mixed
+                    mixed = []
+
+
 class LMDBDataDecoder(MapData):
     """ Read a LMDB database with a custom decoder and produce decoded outputs."""
     def __init__(self, lmdb_data, decoder):
@@ -237,5 +368,5 @@ except ImportError:
 try:
     import lmdb
 except ImportError:
-    for klass in ['LMDBData', 'LMDBDataDecoder', 'CaffeLMDB']:
+    for klass in ['LMDBData', 'ShardedLMDBData', 'LMDBDataDecoder', 'CaffeLMDB']:
         globals()[klass] = create_dummy_class(klass, 'lmdb')
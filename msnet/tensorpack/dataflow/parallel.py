@@ -301,12 +301,19 @@ class MultiProcessRunnerZMQ(_MultiProcessZMQDataFlow):
     """
 
     class _Worker(mp.Process):
-        def __init__(self, ds, conn_name, hwm, idx):
+        def __init__(self, ds, conn_name, hwm, idx, serializer=None):
             super(MultiProcessRunnerZMQ._Worker, self).__init__()
             self.ds = ds
             self.conn_name = conn_name
             self.hwm = hwm
             self.idx = idx
+            self.serializer = serializer
+
+        def send(self, socket, dp):
+            if self.serializer is None:
+                socket.send(dumps(dp), copy=False)
+            else:
+                socket.send_multipart(self.serializer.dumps_multipart(dp), copy=False)
 
         def run(self):
             enable_death_signal(_warn=self.idx == 0)
@@ -321,10 +328,10 @@ class MultiProcessRunnerZMQ(_MultiProcessZMQDataFlow):
                 while True:
                     try:
                         dp = next(itr)
-                        socket.send(dumps(dp), copy=False)
+                        self.send(socket, dp)
                     except Exception:
                         dp = _ExceptionWrapper(sys.exc_info()).pack()
-                        socket.send(dumps(dp), copy=False)
+                        self.send(socket, dp)
                         raise
             # sigint could still propagate here, e.g. when nested
             except KeyboardInterrupt:
@@ -333,12 +340,16 @@ class MultiProcessRunnerZMQ(_MultiProcessZMQDataFlow):
                 socket.close(0)
                 context.destroy(0)
 
-    def __init__(self, ds, num_proc=1, hwm=50, nr_proc=None):
+    def __init__(self, ds, num_proc=1, hwm=50, serializer=None, nr_proc=None):
         """
         Args:
             ds (DataFlow): input DataFlow.
             num_proc (int): number of processes to use.
             hwm (int): the zmq "high-water mark" (queue size) for both sender and receiver.
+            serializer: a serializer with ``dumps_multipart`` and ``loads_multipart``, e.g.
+                :class:`tensorpack.utils.serialize.ColumnarSerializer`, to send the datapoints
+                as multipart messages. Defaults to :mod:`tensorpack.utils.serialize`.
+                The arrays of a datapoint are sent without a copy, so `ds` must not modify them afterwards.
             nr_proc: deprecated
         """
         if nr_proc is not None:
@@ -349,6 +360,7 @@ class MultiProcessRunnerZMQ(_MultiProcessZMQDataFlow):
         self.ds = ds
         self.num_proc = num_proc
         self._hwm = hwm
+        self._serializer = serializer
 
         if num_proc > 1:
             logger.info("[MultiProcessRunnerZMQ] Will fork a dataflow more than one times. "
@@ -359,7 +371,10 @@ class MultiProcessRunnerZMQ(_MultiProcessZMQDataFlow):
             self._size = -1
 
     def _recv(self):
-        ret = loads(self.socket.recv(copy=False))
+        if self._serializer is None:
+            ret = loads(self.socket.recv(copy=False))
+        else:
+            ret = self._serializer.loads_multipart(self.socket.recv_multipart(copy=False))
         exc = _ExceptionWrapper.unpack(ret)
         if exc is not None:
             logger.error("Exception '{}' in worker:".format(str(exc.exc_type)))
@@ -385,7 +400,7 @@ class MultiProcessRunnerZMQ(_MultiProcessZMQDataFlow):
         pipename = _get_pipe_name('dataflow')
         _bind_guard(self.socket, pipename)
 
-        self._procs = [MultiProcessRunnerZMQ._Worker(self.ds, pipename, self._hwm, idx)
+        self._procs = [MultiProcessRunnerZMQ._Worker(self.ds, pipename, self._hwm, idx, self._serializer)
                        for idx in range(self.num_proc)]
         self._start_processes()
 
@@ -8,6 +8,7 @@ import threading
 import zmq
 from six.moves import queue
 
+from ..utils.argtools import log_once
 from ..utils.concurrency import StoppableThread, enable_death_signal
 from ..utils.serialize import dumps_once as dumps, loads_once as loads
 from ..utils.develop import log_deprecated
@@ -16,7 +17,7 @@ from .common import RepeatedData, BatchData
 from .parallel import _bind_guard, _get_pipe_name, _MultiProcessZMQDataFlow, _repeat_iter, _zmq_catch_error
 
 __all__ = ['MultiThreadMapData',
-           'MultiProcessMapData', 'MultiProcessMapDataZMQ',
+           'MultiProcessMapData', 'MultiProcessMapDataZMQ', 'MultiProcessMapDataSharedMemory',
            'MultiProcessMapAndBatchData', 'MultiProcessMapAndBatchDataZMQ']
 
 
@@ -235,12 +236,13 @@ class MultiProcessMapDataZMQ(_ParallelMapData, _MultiProcessZMQDataFlow):
     datapoints from the second pass of ``df.__iter__``.
     """
     class _Worker(mp.Process):
-        def __init__(self, identity, map_func, pipename, hwm):
+        def __init__(self, identity, map_func, pipename, hwm, serializer=None):
             super(MultiProcessMapDataZMQ._Worker, self).__init__()
             self.identity = identity
             self.map_func = map_func
             self.pipename = pipename
             self.hwm = hwm
+            self.serializer = serializer
 
         def run(self):
             enable_death_signal(_warn=self.identity == b'0')
@@ -251,11 +253,17 @@ class MultiProcessMapDataZMQ(_ParallelMapData, _MultiProcessZMQDataFlow):
             socket.connect(self.pipename)
 
             while True:
-                dp = loads(socket.recv(copy=False))
-                dp = self.map_func(dp)
-                socket.send(dumps(dp), copy=False)
+                if self.serializer is None:
+                    dp = loads(socket.recv(copy=False))
+                    dp = self.map_func(dp)
+                    socket.send(dumps(dp), copy=False)
+                else:
+                    dp = self.serializer.loads_multipart(socket.recv_multipart(copy=False))
+                    dp = self.map_func(dp)
+                    socket.send_multipart(self.serializer.dumps_multipart(dp), copy=False)
 
-    def __init__(self, ds, num_proc=None, map_func=None, buffer_size=200, strict=False, nr_proc=None):
+    def __init__(self, ds, num_proc=None, map_func=None, buffer_size=200, strict=False, serializer=None,
+                 nr_proc=None):
         """
         Args:
             ds (DataFlow): the dataflow to map
@@ -264,6 +272,10 @@ class MultiProcessMapDataZMQ(_ParallelMapData, _MultiProcessZMQDataFlow):
                 discard/skip the datapoint.
             buffer_size (int): number of datapoints in the buffer
             strict (bool): use "strict mode", see notes above.
+            serializer: a serializer with ``dumps_multipart`` and ``loads_multipart``, e.g.
+                :class:`tensorpack.utils.serialize.ColumnarSerializer`, to send the datapoints
+                as multipart messages. Defaults to :mod:`tensorpack.utils.serialize`.
+                With ColumnarSerializer, the produced arrays are views of the received messages.
             nr_proc: deprecated name
         """
         if nr_proc is not None:
@@ -282,10 +294,11 @@ class MultiProcessMapDataZMQ(_ParallelMapData, _MultiProcessZMQDataFlow):
         self.num_proc = num_proc
         self.map_func = map_func
         self._strict = strict
+        self._serializer = serializer
         self._procs = []
 
     def _create_worker(self, id, pipename, hwm):
-        return MultiProcessMapDataZMQ._Worker(id, self.map_func, pipename, hwm)
+        return MultiProcessMapDataZMQ._Worker(id, self.map_func, pipename, hwm, self._serializer)
 
     def reset_state(self):
         _MultiProcessZMQDataFlow.reset_state(self)
@@ -307,12 +320,18 @@ class MultiProcessMapDataZMQ(_ParallelMapData, _MultiProcessZMQDataFlow):
         self._fill_buffer()     # pre-fill the bufer
 
     def _send(self, dp):
-        msg = [b"", dumps(dp)]
+        if self._serializer is None:
+            msg = [b"", dumps(dp)]
+        else:
+            msg = [b""] + self._serializer.dumps_multipart(dp)
         self.socket.send_multipart(msg, copy=False)
 
     def _recv(self):
         msg = self.socket.recv_multipart(copy=False)
-        dp = loads(msg[1])
+        if self._serializer is None:
+            dp = loads(msg[1])
+        else:
+            dp = self._serializer.loads_multipart(msg[1:])
         return dp
 
     def __iter__(self):
@@ -320,6 +339,155 @@ class MultiProcessMapDataZMQ(_ParallelMapData, _MultiProcessZMQDataFlow):
             yield from super(MultiProcessMapDataZMQ, self).__iter__()
 
 
+# offsets of the arrays in a slab are aligned to this many bytes
+_SLAB_ALIGNMENT = 64
+
+
+def _write_to_slab(dp, slab):
+    """
+    Copy the numpy arrays which are components of dp into slab.
+
+    Returns:
+        dp: a shallow copy of dp, where the copied arrays are replaced by None
+        list: (key, offset, dtype, shape) of every copied array
+    """
+    if isinstance(dp, dict):
+        dp, keys = dict(dp), list(dp.keys())
+    elif isinstance(dp, (list, tuple)):
+        dp, keys = list(dp), range(len(dp))
+    else:
+        return dp, []
+    meta = []
+    offset = 0
+    for k in keys:
+        arr = dp[k]
+        if not isinstance(arr, np.ndarray) or arr.dtype.hasobject:
+            continue
+        if offset + arr.nbytes > len(slab):
+            log_once("A datapoint does not fit into the shared memory slab. "
+                     "The arrays that don't fit are serialized instead.", 'warn')
+            continue
+        np.copyto(slab[offset:offset + arr.nbytes].view(arr.dtype).reshape(arr.shape), arr)
+        meta.append((k, offset, arr.dtype.str, arr.shape))
+        dp[k] = None
+        offset += -(-arr.nbytes // _SLAB_ALIGNMENT) * _SLAB_ALIGNMENT
+    return dp, meta
+
+
+def _read_from_slab(dp, meta, slab):
+    """
+    Inverse of :func:`_write_to_slab`, but the arrays are views of slab.
+    """
+    for k, offset, dtype, shape in meta:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        dp[k] = slab[offset:offset + nbytes].view(dtype).reshape(shape)
+    return dp
+
+
+class MultiProcessMapDataSharedMemory(MultiProcessMapDataZMQ):
+    """
+    Same as :class:`MultiProcessMapDataZMQ`, but the numpy arrays in the datapoints
+    returned by `map_func` are not serialized. The worker copies them into a slab of shared memory,
+    and only sends their dtype, shape and offset through the ZMQ pipe, together with the rest of the datapoint.
+    This is more efficient when the arrays are large, e.g. images.
+
+    There is one slab for each datapoint in the buffer, and one for the datapoint that was produced last,
+    so this uses `(buffer_size + 1) * slab_size` bytes of shared memory.
+
+    Note:
+        1. The arrays in a produced datapoint are read-only views of its slab,
+           and are only valid until the next datapoint is requested, when the slab gets reused.
+           Consumers which keep the arrays for longer must copy them, e.g. :class:`BatchData`,
+           and also :class:`QueueInput`: TF may feed contiguous and aligned arrays to the queue
+           without copying them, so the tensors in the queue would point into the reused slabs.
+        2. Only numpy arrays which are components of a list or dict datapoint are put into the slab.
+           Arrays which don't fit into the remaining space of the slab are serialized as usual.
+    """
+    class _Worker(mp.Process):
+        def __init__(self, identity, map_func, pipename, hwm, slabs):
+            super(MultiProcessMapDataSharedMemory._Worker, self).__init__()
+            self.identity = identity
+            self.map_func = map_func
+            self.pipename = pipename
+            self.hwm = hwm
+            self.slabs = slabs
+
+        def run(self):
+            enable_death_signal(_warn=self.identity == b'0')
+            ctx = zmq.Context()
+            socket = ctx.socket(zmq.REP)
+            socket.setsockopt(zmq.IDENTITY, self.identity)
+            socket.set_hwm(self.hwm)
+            socket.connect(self.pipename)
+            slabs = [np.frombuffer(s, dtype=np.uint8) for s in self.slabs]
+
+            while True:
+                slab_id, dp = loads(socket.recv(copy=False))
+                dp = self.map_func(dp)
+                meta = []
+                if dp is not None:
+                    dp, meta = _write_to_slab(dp, slabs[slab_id])
+                socket.send(dumps([slab_id, meta, dp]), copy=False)
+
+    def __init__(self, ds, num_proc, map_func, slab_size, buffer_size=20, strict=False):
+        """
+        Args:
+            ds (DataFlow): the dataflow to map
+            num_proc(int): number of processes to use
+            map_func (callable): datapoint -> datapoint | None. Return None to
+                discard/skip the datapoint.
+            slab_size (int): size in bytes of each slab. It should fit the arrays of any datapoint.
+            buffer_size (int): number of datapoints in the buffer
+            strict (bool): use "strict mode", see notes in :class:`MultiProcessMapDataZMQ`.
+        """
+        super(MultiProcessMapDataSharedMemory, self).__init__(
+            ds, num_proc, map_func, buffer_size=buffer_size, strict=strict)
+        self.slab_size = int(slab_size)
+        self._slabs = []
+
+    def _create_worker(self, id, pipename, hwm):
+        return MultiProcessMapDataSharedMemory._Worker(id, self.map_func, pipename, hwm, self._slabs)
+
+    def reset_state(self):
+        self._slabs = [mp.RawArray(ctypes.c_uint8, self.slab_size) for _ in range(self._buffer_size + 1)]
+        self._slab_arrays = []
+        for s in self._slabs:
+            arr = np.frombuffer(s, dtype=np.uint8)
+            arr.flags.writeable = False
+            self._slab_arrays.append(arr)
+        self._free_slabs = list(range(len(self._slabs)))
+        self._slab_in_use = None    # the slab of the datapoint that was produced last
+        super(MultiProcessMapDataSharedMemory, self).reset_state()
+
+    def _send(self, dp):
+        msg = [b"", dumps([self._free_slabs.pop(), dp])]
+        self.socket.send_multipart(msg, copy=False)
+
+    def _recv(self):
+        msg = self.socket.recv_multipart(copy=False)
+        slab_id, meta, dp = loads(msg[1])
+        if dp is None:
+            self._free_slabs.append(slab_id)
+            return None
+        assert self._slab_in_use is None
+        self._slab_in_use = slab_id
+        return _read_from_slab(dp, meta, self._slab_arrays[slab_id])
+
+    def _release_slab(self):
+        if self._slab_in_use is not None:
+            self._free_slabs.append(self._slab_in_use)
+            self._slab_in_use = None
+
+    def __iter__(self):
+        with self._guard, _zmq_catch_error(type(self).__name__):
+            # the previous datapoint is no longer used once the next one is requested
+            self._release_slab()
+            for dp in _ParallelMapData.__iter__(self):
+                yield dp
+                self._release_slab()
+
+
 class MultiProcessMapAndBatchDataZMQ(_MultiProcessZMQDataFlow):
     """
     Similar to :class:`MultiProcessMapDataZMQ`, except that this DataFlow
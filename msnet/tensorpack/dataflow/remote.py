@@ -22,7 +22,7 @@ else:
     __all__ = ['send_dataflow_zmq', 'RemoteDataZMQ']
 
 
-def send_dataflow_zmq(df, addr, hwm=50, format=None, bind=False):
+def send_dataflow_zmq(df, addr, hwm=50, format=None, bind=False, serializer=None):
     """
     Run DataFlow and send data to a ZMQ socket addr.
     It will serialize and send each datapoint to this address with a PUSH socket.
@@ -38,11 +38,16 @@ def send_dataflow_zmq(df, addr, hwm=50, format=None, bind=False):
              An alternate format is 'zmq_ops', used by https://github.com/tensorpack/zmq_ops
              and :class:`input_source.ZMQInput`.
         bind (bool): whether to bind or connect to the endpoint address.
+        serializer: a serializer with ``dumps_multipart`` and ``loads_multipart``, e.g.
+            :class:`tensorpack.utils.serialize.ColumnarSerializer`, to send each datapoint as a multipart message
+            without copying its arrays. The receiver has to use the same one, see :class:`RemoteDataZMQ`.
+            Only for the default format.
     """
     assert format in [None, 'zmq_op', 'zmq_ops']
     if format is None:
         dump_fn = dumps
     else:
+        assert serializer is None, "A serializer can only be used with the default format!"
         from zmq_ops import dump_arrays
         dump_fn = dump_arrays
 
@@ -70,7 +75,10 @@ def send_dataflow_zmq(df, addr, hwm=50, format=None, bind=False):
             with tqdm.trange(total, **tqdm_args) as pbar:
                 for dp in df:
                     start = time.time()
-                    socket.send(dump_fn(dp), copy=False)
+                    if serializer is None:
+                        socket.send(dump_fn(dp), copy=False)
+                    else:
+                        socket.send_multipart(serializer.dumps_multipart(dp), copy=False)
                     q.append(time.time() - start)
                     pbar.update(1)
                     if pbar.n % INTERVAL == 0:
@@ -94,7 +102,7 @@ class RemoteDataZMQ(DataFlow):
     Attributes:
         cnt1, cnt2 (int): number of data points received from addr1 and addr2
     """
-    def __init__(self, addr1, addr2=None, hwm=50, bind=True):
+    def __init__(self, addr1, addr2=None, hwm=50, bind=True, serializer=None):
         """
         Args:
             addr1,addr2 (str): addr of the zmq endpoint to connect to.
@@ -102,6 +110,7 @@ class RemoteDataZMQ(DataFlow):
                 I don't think you'll ever need 3.
             hwm (int): ZMQ high-water mark (buffer size)
             bind (bool): whether to connect or bind the endpoint
+            serializer: the serializer given to :func:`send_dataflow_zmq`, if any.
         """
         assert addr1
         self._addr1 = addr1
@@ -109,11 +118,17 @@ class RemoteDataZMQ(DataFlow):
         self._hwm = int(hwm)
         self._guard = DataFlowReentrantGuard()
         self._bind = bind
+        self._serializer = serializer
 
     def reset_state(self):
         self.cnt1 = 0
         self.cnt2 = 0
 
+    def _recv(self, socket):
+        if self._serializer is None:
+            return loads(socket.recv(copy=False))
+        return self._serializer.loads_multipart(socket.recv_multipart(copy=False))
+
     def bind_or_connect(self, socket, addr):
         if self._bind:
             socket.bind(addr)
@@ -130,7 +145,7 @@ class RemoteDataZMQ(DataFlow):
                     self.bind_or_connect(socket, self._addr1)
 
                     while True:
-                        dp = loads(socket.recv(copy=False))
+                        dp = self._recv(socket)
                         yield dp
                         self.cnt1 += 1
                 else:
@@ -149,7 +164,7 @@ class RemoteDataZMQ(DataFlow):
                     while True:
                         evts = poller.poll()
                         for sock, evt in evts:
-                            dp = loads(sock.recv(copy=False))
+                            dp = self._recv(sock)
                             yield dp
                             if sock == socket1:
                                 self.cnt1 += 1
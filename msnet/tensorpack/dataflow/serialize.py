@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # File: serialize.py
 
+import json
 import numpy as np
 import os
 import platform
@@ -12,7 +13,8 @@ from ..utils.develop import create_dummy_class  # noqa
 from ..utils.utils import get_tqdm
 from .base import DataFlow
 from .common import FixedSizeData, MapData
-from .format import HDF5Data, LMDBData
+from .format import HDF5Data, LMDBData, ShardedLMDBData
+from .parallel_map import MultiProcessMapDataZMQ
 from .raw import DataFromGenerator, DataFromList
 
 __all__ = ['LMDBSerializer', 'NumpySerializer', 'TFRecordSerializer', 'HDF5Serializer']
@@ -27,6 +29,72 @@ def _reset_df_and_get_size(df):
     return sz
 
 
+class _LMDBWriter(object):
+    """
+    Write values to a new lmdb database under the given keys, and the list of keys under ``__keys__``.
+    """
+    def __init__(self, path, write_frequency):
+        isdir = os.path.isdir(path)
+        if isdir:
+            assert not os.path.isfile(os.path.join(path, 'data.mdb')), "LMDB file exists!"
+        else:
+            assert not os.path.isfile(path), "LMDB file {} exists!".format(path)
+        # It's OK to use super large map_size on Linux, but not on other platforms
+        # See: https://github.com/NVIDIA/DIGITS/issues/206
+        map_size = 1099511627776 * 2 if platform.system() == 'Linux' else 128 * 10**6
+        self.db = lmdb.open(path, subdir=isdir,
+                            map_size=map_size, readonly=False,
+                            meminit=False, map_async=True)    # need sync() at the end
+        self.write_frequency = write_frequency
+        self.keys = []
+        # LMDB transaction is not exception-safe!
+        # although it has a context manager interface
+        self.txn = self.db.begin(write=True)
+
+    def _put_or_grow(self, key, value):
+        # put data into lmdb, and doubling the size if full.
+        # Ref: https://github.com/NVIDIA/DIGITS/pull/209/files
+        while True:
+            try:
+                self.txn.put(key, value)
+                return
+            except lmdb.MapFullError:
+                pass
+            self.txn.abort()
+            new_size = self.db.info()['map_size'] * 2
+            logger.info("Doubling LMDB map_size to {:.2f}GB".format(new_size / 10**9))
+            self.db.set_mapsize(new_size)
+            self.txn = self.db.begin(write=True)
+
+    def put(self, key, value):
+        self._put_or_grow(key, value)
+        self.keys.append(key)
+        if len(self.keys) % self.write_frequency == 0:
+            self.txn.commit()
+            self.txn = self.db.begin(write=True)
+
+    def close(self):
+        self.txn.commit()
+        self.txn = self.db.begin(write=True)
+        self._put_or_grow(b'__keys__', dumps(self.keys))
+        self.txn.commit()
+        logger.info("Flushing database ...")
+        self.db.sync()
+        self.db.close()
+
+
+class _SerializeMapper(object):
+    def __init__(self, map_func, dumps):
+        self.map_func = map_func
+        self.dumps = dumps
+
+    def __call__(self, dp):
+        if self.map_func is not None:
+            dp = self.map_func(dp)
+        # the datapoints discarded by map_func become empty bytes, as strict mode doesn't allow None
+        return b'' if dp is None else self.dumps(dp)
+
+
 class LMDBSerializer():
     """
     Serialize a Dataflow to a lmdb database, where the keys are indices and values
@@ -41,78 +109,91 @@ class LMDBSerializer():
         LMDBSerializer.save(my_df, "output.lmdb")
 
         new_df = LMDBSerializer.load("output.lmdb", shuffle=True)
+
+    The datapoints can also be written to several lmdb files (shards) in a directory,
+    and be mapped and serialized by several processes:
+
+    .. code-block:: python
+
+        LMDBSerializer.save(keys_df, "output_dir", num_shards=8, num_proc=16, map_func=expensive_func)
+
+        new_df = LMDBSerializer.load("output_dir", shuffle=True)   # see ShardedLMDBData
     """
     @staticmethod
-    def save(df, path, write_frequency=5000):
+    def save(df, path, write_frequency=5000, num_shards=1, num_proc=0, map_func=None, serializer=None):
         """
         Args:
             df (DataFlow): the DataFlow to serialize.
             path (str): output path. Either a directory or an lmdb file.
+                If num_shards > 1, a directory which will have the shards and an index,
+                and will be created if it does not exist.
             write_frequency (int): the frequency to write back data to disk.
                 A smaller value reduces memory usage.
+            num_shards (int): write the i-th datapoint to the shard i % num_shards.
+            num_proc (int): if > 0, map and serialize the datapoints in this many processes.
+                Datapoints have to be sent to the processes, so this pays off when the
+                datapoints of `df` are small, and `map_func` produces the expensive ones.
+            map_func (callable): datapoint -> datapoint | None, applied to the datapoints
+                of `df` before they are saved. Return None to discard the datapoint.
+            serializer: a serializer from :mod:`tensorpack.utils.serialize`, e.g. ``ColumnarSerializer``.
+                Defaults to :func:`tensorpack.utils.serialize.dumps`. Use the same one in :meth:`load`.
         """
         assert isinstance(df, DataFlow), type(df)
-        isdir = os.path.isdir(path)
-        if isdir:
-            assert not os.path.isfile(os.path.join(path, 'data.mdb')), "LMDB file exists!"
+        assert num_shards >= 1, num_shards
+        if num_shards > 1:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            assert not os.path.isfile(os.path.join(path, ShardedLMDBData.INDEX_FILE)), \
+                "Sharded LMDB in {} exists!".format(path)
+            shard_files = ['shard-{:05d}-of-{:05d}.lmdb'.format(k, num_shards) for k in range(num_shards)]
+            writers = [_LMDBWriter(os.path.join(path, f), write_frequency) for f in shard_files]
         else:
-            assert not os.path.isfile(path), "LMDB file {} exists!".format(path)
-        # It's OK to use super large map_size on Linux, but not on other platforms
-        # See: https://github.com/NVIDIA/DIGITS/issues/206
-        map_size = 1099511627776 * 2 if platform.system() == 'Linux' else 128 * 10**6
-        db = lmdb.open(path, subdir=isdir,
-                       map_size=map_size, readonly=False,
-                       meminit=False, map_async=True)    # need sync() at the end
-        size = _reset_df_and_get_size(df)
+            writers = [_LMDBWriter(path, write_frequency)]
 
-        # put data into lmdb, and doubling the size if full.
-        # Ref: https://github.com/NVIDIA/DIGITS/pull/209/files
-        def put_or_grow(txn, key, value):
-            try:
-                txn.put(key, value)
-                return txn
-            except lmdb.MapFullError:
-                pass
-            txn.abort()
-            curr_size = db.info()['map_size']
-            new_size = curr_size * 2
-            logger.info("Doubling LMDB map_size to {:.2f}GB".format(new_size / 10**9))
-            db.set_mapsize(new_size)
-            txn = db.begin(write=True)
-            txn = put_or_grow(txn, key, value)
-            return txn
+        mapper = _SerializeMapper(map_func, dumps if serializer is None else serializer.dumps)
+        if num_proc > 0:
+            df = MultiProcessMapDataZMQ(df, num_proc, mapper, buffer_size=num_proc * 8, strict=True)
+        else:
+            df = MapData(df, mapper)
+        size = _reset_df_and_get_size(df)
 
         with get_tqdm(total=size) as pbar:
-            idx = -1
-
-            # LMDB transaction is not exception-safe!
-            # although it has a context manager interface
-            txn = db.begin(write=True)
-            for idx, dp in enumerate(df):
-                txn = put_or_grow(txn, u'{:08}'.format(idx).encode('ascii'), dumps(dp))
+            idx = 0
+            for value in df:
                 pbar.update()
-                if (idx + 1) % write_frequency == 0:
-                    txn.commit()
-                    txn = db.begin(write=True)
-            txn.commit()
-
-            keys = [u'{:08}'.format(k).encode('ascii') for k in range(idx + 1)]
-            with db.begin(write=True) as txn:
-                txn = put_or_grow(txn, b'__keys__', dumps(keys))
-
-            logger.info("Flushing database ...")
-            db.sync()
-        db.close()
+                if not value:   # discarded by map_func
+                    continue
+                writers[idx % num_shards].put(u'{:08}'.format(idx).encode('ascii'), value)
+                idx += 1
+            for writer in writers:
+                writer.close()
+        if num_proc > 0:
+            del df  # stop the processes
+
+        if num_shards > 1:
+            with open(os.path.join(path, ShardedLMDBData.INDEX_FILE), 'w') as f:
+                json.dump({'shards': shard_files, 'sizes': [len(w.keys) for w in writers]}, f)
 
     @staticmethod
-    def load(path, shuffle=True):
+    def load(path, shuffle=True, serializer=None):
         """
+        Args:
+            path (str): the path given to :meth:`save`.
+            shuffle (bool): shuffle the datapoints or not.
+                Datapoints written in shards are shuffled block by block, see :class:`ShardedLMDBData`.
+            serializer: the serializer given to :meth:`save`, if any.
+
         Note:
             If you found deserialization being the bottleneck, you can use :class:`LMDBData` as the reader
-            and run deserialization as a mapper in parallel.
+            (or :class:`ShardedLMDBData` for shards) and run deserialization as a mapper in parallel.
         """
-        df = LMDBData(path, shuffle=shuffle)
-        return MapData(df, LMDBSerializer._deserialize_lmdb)
+        if os.path.isfile(os.path.join(path, ShardedLMDBData.INDEX_FILE)):
+            df = ShardedLMDBData(path, shuffle=shuffle)
+        else:
+            df = LMDBData(path, shuffle=shuffle)
+        if serializer is None:
+            return MapData(df, LMDBSerializer._deserialize_lmdb)
+        return MapData(df, lambda dp: serializer.loads(dp[1]))
 
     @staticmethod
     def _deserialize_lmdb(dp):
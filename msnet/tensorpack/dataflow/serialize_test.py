@@ -6,8 +6,10 @@ import numpy as np
 import os
 import unittest
 
-from tensorpack.dataflow import HDF5Serializer, LMDBSerializer, NumpySerializer, TFRecordSerializer
+from tensorpack.dataflow import (
+    HDF5Serializer, LMDBSerializer, MapData, NumpySerializer, ShardedLMDBData, TFRecordSerializer)
 from tensorpack.dataflow.base import DataFlow
+from tensorpack.utils.serialize import ColumnarSerializer
 
 
 def delete_file_if_exists(fn):
@@ -69,6 +71,65 @@ class SerializerTest(unittest.TestCase):
                 {}, {'shuffle': False},
                 'Skip test_lmdb, no lmdb available')
 
+    def test_lmdb_sharded(self):
+        with tempfile.TemporaryDirectory() as f:
+            self.run_write_read_test(
+                os.path.join(f, 'test_shards'),
+                LMDBSerializer,
+                {}, {'num_shards': 3, 'write_frequency': 4},
+                {}, {'shuffle': False},
+                'Skip test_lmdb_sharded, no lmdb available')
+
+    def test_lmdb_sharded_shuffle(self):
+        try:
+            with tempfile.TemporaryDirectory() as f:
+                path = os.path.join(f, 'test_shards')
+                LMDBSerializer.save(SeededFakeDataFlow(), path, num_shards=3)
+                ds_actual = MapData(ShardedLMDBData(path, block_size=4, mix_blocks=2, readahead=2),
+                                    LMDBSerializer._deserialize_lmdb)
+
+                ds_actual.reset_state()
+                ds_expected = SeededFakeDataFlow()
+                ds_expected.reset_state()
+                expected = [dp[1].sum() for dp in ds_expected]
+                actual = [dp[1].sum() for dp in ds_actual]
+                self.assertEqual(len(ds_actual), len(expected))
+                self.assertFalse(np.allclose(actual, expected))
+                self.assertTrue(np.allclose(sorted(actual), sorted(expected)))
+        except ImportError:
+            print('Skip test_lmdb_sharded_shuffle, no lmdb available')
+
+    def test_lmdb_columnar(self):
+        with tempfile.TemporaryDirectory() as f:
+            self.run_write_read_test(
+                os.path.join(f, 'test.lmdb'),
+                LMDBSerializer,
+                {}, {'serializer': ColumnarSerializer},
+                {}, {'shuffle': False, 'serializer': ColumnarSerializer},
+                'Skip test_lmdb_columnar, no lmdb available')
+
+    def test_columnar(self):
+        arr = np.random.rand(4, 6).astype('float32')
+        dp = {'image': arr, 'views': [arr.T, arr[:, ::2]], 'empty': np.zeros((0, 4)),
+              'names': np.asarray(['a', 'bc']), 'label': 3, 'path': 'a.jpg'}
+        buf = ColumnarSerializer.dumps(dp)
+        frames = ColumnarSerializer.dumps_multipart(dp)
+        for dp_actual in [ColumnarSerializer.loads(buf), ColumnarSerializer.loads(bytes(buf)),
+                          ColumnarSerializer.loads_multipart(frames)]:
+            self.assertEqual(sorted(dp_actual.keys()), sorted(dp.keys()))
+            self.assertTrue(np.array_equal(dp_actual['image'], arr))
+            self.assertTrue(np.array_equal(dp_actual['views'][0], arr.T))
+            self.assertTrue(np.array_equal(dp_actual['views'][1], arr[:, ::2]))
+            self.assertEqual(dp_actual['empty'].shape, (0, 4))
+            self.assertEqual(list(dp_actual['names']), ['a', 'bc'])
+            self.assertEqual((dp_actual['label'], dp_actual['path']), (3, 'a.jpg'))
+        # the arrays are views of the buffers, at aligned offsets
+        dp_actual = ColumnarSerializer.loads(buf)
+        base = np.frombuffer(buf, dtype=np.uint8)
+        self.assertTrue(np.shares_memory(dp_actual['image'], base))
+        self.assertEqual((dp_actual['image'].ctypes.data - base.ctypes.data) % ColumnarSerializer.ALIGNMENT, 0)
+        self.assertTrue(np.shares_memory(ColumnarSerializer.loads_multipart(frames)['image'], arr))
+
     def test_tfrecord(self):
         with tempfile.TemporaryDirectory() as f:
             self.run_write_read_test(
@@ -2,6 +2,7 @@
 # File: serialize.py
 
 import os
+import struct
 
 import pickle
 from multiprocessing.reduction import ForkingPickler
@@ -93,6 +94,76 @@ class PickleSerializer(object):
         return pickle.loads(buf)
 
 
+class ColumnarSerializer(object):
+    """
+    Serialize objects which contain numpy arrays, e.g. dicts or lists of arrays, to a small header
+    and the raw buffers of the arrays, using pickle protocol 5 with out-of-band buffers.
+    Neither :meth:`dumps_multipart` nor the loads functions copy the arrays:
+    the arrays are sent as they are, and the arrays produced are views of the received buffers.
+
+    :meth:`dumps_multipart` returns a list of frames, to be sent with e.g. ``zmq.Socket.send_multipart``.
+    :meth:`dumps` puts the header and the buffers, at aligned offsets, into a single bytes-like object,
+    e.g. to be saved in a database.
+
+    Note:
+        The arrays produced by the loads functions are read-only if the given buffers are, e.g. bytes.
+    """
+
+    ALIGNMENT = 64
+
+    @staticmethod
+    def dumps_multipart(obj):
+        """
+        Returns:
+            list: the header and the buffers of the arrays, as bytes or memoryview.
+        """
+        buffers = []
+        header = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        return [header] + [b.raw() for b in buffers]
+
+    @staticmethod
+    def loads_multipart(frames):
+        """
+        Args:
+            frames: the output of `dumps_multipart`, or the ``zmq.Frame`` which were sent from it.
+        """
+        frames = [getattr(k, 'buffer', k) for k in frames]
+        return pickle.loads(frames[0], buffers=frames[1:])
+
+    @staticmethod
+    def dumps(obj):
+        """
+        Returns:
+            bytearray, with: the number of frames, the offset and length of each frame, then the frames.
+        """
+        frames = ColumnarSerializer.dumps_multipart(obj)
+        table = struct.Struct('<{}Q'.format(1 + 2 * len(frames)))
+        align = ColumnarSerializer.ALIGNMENT
+        offsets, end = [], table.size
+        for f in frames:
+            offset = (end + align - 1) // align * align
+            offsets.append(offset)
+            end = offset + len(f)
+
+        buf = bytearray(end)
+        table.pack_into(buf, 0, len(frames), *[v for k in zip(offsets, map(len, frames)) for v in k])
+        for offset, f in zip(offsets, frames):
+            buf[offset:offset + len(f)] = f
+        return buf
+
+    @staticmethod
+    def loads(buf):
+        """
+        Args:
+            buf: the output of `dumps`.
+        """
+        buf = memoryview(buf)
+        num_frames, = struct.unpack_from('<Q', buf)
+        table = struct.unpack_from('<{}Q'.format(2 * num_frames), buf, 8)
+        return ColumnarSerializer.loads_multipart(
+            [buf[offset:offset + length] for offset, length in zip(table[::2], table[1::2])])
+
+
 # Define the default serializer to be used that dumps data to bytes
 _DEFAULT_S = os.environ.get('TENSORPACK_SERIALIZE', 'pickle')
 
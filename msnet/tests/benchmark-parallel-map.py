@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import argparse
+from tensorpack.utils import logger
+from tensorpack.dataflow import (
+    DataFromGenerator, TestDataSpeed, MultiProcessMapDataZMQ, MultiProcessMapDataSharedMemory)
+
+
+def fake_detection_data(image_shape, image_dtype):
+    """
+    A datapoint of about the size of a training datapoint of Mask R-CNN with FPN:
+    an image, anchor labels and boxes of 5 levels, groundtruth boxes and packed masks.
+    """
+    h, w = image_shape[:2]
+    dp = {
+        'image': np.random.randint(0, 255, size=image_shape).astype(image_dtype),
+        'gt_boxes': np.random.rand(50, 4).astype('float32'),
+        'gt_labels': np.random.randint(1, 4, size=(50,)).astype('int64'),
+        'gt_masks_packed': np.random.randint(0, 255, size=(50, h, w // 8)).astype('uint8'),
+    }
+    for lvl, stride in enumerate([4, 8, 16, 32, 64]):
+        shape = (h // stride, w // stride, 3)
+        dp['anchor_labels_lvl{}'.format(lvl + 2)] = np.random.randint(-1, 2, size=shape).astype('int32')
+        dp['anchor_boxes_lvl{}'.format(lvl + 2)] = np.random.rand(*shape, 4).astype('float32')
+    return dp
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-proc', type=int, default=4)
+    parser.add_argument('--num', type=int, default=200, help='number of datapoints to fetch')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[800, 1333])
+    parser.add_argument('--float', action='store_true', help='use float32 images')
+    args = parser.parse_args()
+
+    template = fake_detection_data(tuple(args.image_size) + (3,), 'float32' if args.float else 'uint8')
+    nbytes = sum(v.nbytes for v in template.values())
+    logger.info("Each datapoint has {:.1f} MB of arrays.".format(nbytes / 1024 ** 2))
+
+    def map_func(_):
+        # copy, so that the workers produce new arrays like a real map_func does
+        return {k: v.copy() for k, v in template.items()}
+
+    buffer_size = args.num_proc * 4
+    for name in ['zmq', 'shared-memory']:
+        ds = DataFromGenerator(lambda: iter(range(1 << 30)))
+        if name == 'zmq':
+            ds = MultiProcessMapDataZMQ(ds, args.num_proc, map_func, buffer_size=buffer_size)
+        else:
+            ds = MultiProcessMapDataSharedMemory(
+                ds, args.num_proc, map_func, slab_size=nbytes + (1 << 20), buffer_size=buffer_size)
+        logger.info("Benchmarking {} ...".format(name))
+        TestDataSpeed(ds, args.num, warmup=args.num_proc * 2).start()
+        del ds  # stop the workers
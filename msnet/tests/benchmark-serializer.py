@@ -11,6 +11,7 @@ from tensorpack.utils.serialize import (
     PyarrowSerializer,
     PickleSerializer,
     ForkingPickler,
+    ColumnarSerializer,
 )
 from tensorpack.utils.timer import Timer
 
@@ -55,6 +56,25 @@ def benchmark_all(name, serializers, data, num=30):
     display_results(name, results)
 
 
+def fake_msnet_data(h=800, w=1333):
+    """
+    A training datapoint of MSNet: an image, sparse anchor inputs of 5 levels for the
+    house and damage branches, groundtruth boxes and packed masks.
+    """
+    dp = {
+        'image': np.random.randint(0, 255, size=(h, w, 3)).astype('uint8'),
+        'gt_labels': np.random.randint(1, 4, size=(50,)).astype('int64'),
+        'gt_masks_packed': np.random.randint(0, 255, size=(50, h, w // 8)).astype('uint8'),
+    }
+    for branch in ['house', 'damage']:
+        dp['gt_boxes_' + branch] = np.random.rand(50, 4).astype('float32')
+        for lvl in range(2, 7):
+            dp['anchor_labels_lvl{}_{}'.format(lvl, branch)] = np.random.randint(0, 2, size=(256,)).astype('int32')
+            dp['anchor_boxes_lvl{}_{}'.format(lvl, branch)] = np.random.rand(256, 4).astype('float32')
+            dp['anchor_inds_lvl{}_{}'.format(lvl, branch)] = np.random.randint(0, 200, size=(256, 3)).astype('int32')
+    return dp
+
+
 def fake_json_data():
     return {
         'words': """
@@ -82,11 +102,15 @@ if __name__ == '__main__':
         ("pyarrow-bytes", PyarrowSerializer.dumps_bytes, PyarrowSerializer.loads),
         ("pickle", PickleSerializer.dumps, PickleSerializer.loads),
         ("forking-pickle", ForkingPickler.dumps, ForkingPickler.loads),
+        ("columnar", ColumnarSerializer.dumps, ColumnarSerializer.loads),
+        ("columnar-multipart", ColumnarSerializer.dumps_multipart, ColumnarSerializer.loads_multipart),
     ]
 
     if args.task == "numpy":
         numpy_data = [np.random.rand(64, 224, 224, 3).astype("float32"), np.random.rand(64).astype('int32')]
         benchmark_all("numpy data", serializers, numpy_data)
+    elif args.task == "msnet":
+        benchmark_all("msnet data", serializers, fake_msnet_data())
     elif args.task == "json":
         benchmark_all("json data", serializers, fake_json_data(), num=50)
     elif args.task == "torch":